@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+"""
+******************************************************************************
+language		: python
+requirement		: numpy, h5py (and the hardware requirements with --hardware)
+authors			: Ricki Chairil, Chemical Engineering, University of Southern California
+function		: end-to-end timing of the reactor loop.
+				  runs mrf_405.pl_abs, ir_mux and the post-pass FWHM statistics
+				  (fwhm_stats, fed channel by channel)
+				  for a number of passes, on the simulated hardware by default,
+				  and breaks every pass down into stage motion, solenoid, lamp,
+				  integration, USB transfer, analysis, disk I/O, IR and settling.
+				  the results go into a JSON file (commit, settings, every pass)
+				  that --compare puts side by side with an earlier run.
+				  e.g.	python benchmark.py --passes 5 --speedup 20 --out before.json
+						python benchmark.py --passes 5 --speedup 20 --compare before.json
+				  times are real (perf_counter) seconds; with the simulation the
+				  device waits are shortened by the speedup while the python work
+				  (analysis, disk I/O, transfer) runs at its real cost.
+******************************************************************************
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import datetime
+import tempfile
+import subprocess
+
+# breakdown of a pass, in report order
+CATEGORIES = ['stage', 'solenoid', 'lamp', 'integration', 'usb_transfer', 'analysis', 'disk_io', 'ir', 'settle']
+# sequencer step kinds that are not split further
+KIND_CATEGORY = {'stage': 'stage', 'solenoid': 'solenoid', 'lamp': 'lamp', 'analysis': 'analysis', 'io': 'disk_io'}
+
+
+def git_commit():
+	try:
+		return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output = True, text = True,
+							cwd = os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+	except OSError:
+		return ''
+
+
+def breakdown(timings, duration, exposure_time, time_scale):
+	# Splits the wall-clock time of one pass over the categories. Steps overlap, so every
+	# interval is shared equally by the steps running in it; intervals with nothing
+	# running are settling. An exposure step is integration (the exposure itself, on the
+	# hardware clock) plus transfer (reading the frame out and waiting for it).
+	segments = []	# (start, end, category)
+	for rec in timings:
+		if rec['kind'] == 'acquire':
+			integration = min(exposure_time(rec['name']) / time_scale, rec['duration'])
+			segments.append((rec['start'], rec['start'] + integration, 'integration'))
+			segments.append((rec['start'] + integration, rec['end'], 'usb_transfer'))
+		else:
+			segments.append((rec['start'], rec['end'], KIND_CATEGORY.get(rec['kind'], rec['kind'])))
+
+	wall = dict.fromkeys(CATEGORIES, 0.0)
+	busy = dict.fromkeys(CATEGORIES, 0.0)
+	edges = sorted({0.0, duration} | {t for seg in segments for t in seg[:2] if t <= duration})
+	for t0, t1 in zip(edges[:-1], edges[1:]):
+		active = [cat for start, end, cat in segments if start <= t0 and end >= t1 and end > start]
+		if not active:
+			wall['settle'] += t1 - t0
+		for cat in active:
+			wall[cat] = wall.get(cat, 0.0) + (t1 - t0) / len(active)
+	for start, end, cat in segments:
+		busy[cat] = busy.get(cat, 0.0) + end - start
+	return wall, busy
+
+
+def run_pass(mrf, archive, stats, k, args, time_scale):
+	from hardwares import flame_s
+	t_pass = time.perf_counter()
+	meta = {'P1': 300, 'P3': 200, 'P4': 300, 'PL_time': flame_s.PL_time,
+			'Cs1_int_time': flame_s.Cs1_int_time, 'Cs4_int_time': flame_s.Cs4_int_time}
+	result = mrf.pl_abs(archive, meta, 'peaks_bench.out', 'fwhms_bench.out', stats = stats)
+	t_optics = time.perf_counter() - t_pass
+
+	t0 = time.perf_counter()
+	confidence = stats.end_pass()['confidence'] # updated channel by channel during the pass
+	t_stats = time.perf_counter() - t0
+
+	t_ir = 0.0
+	if args.ir != 'none':
+		t0 = time.perf_counter()
+		mrf.ir_mux('IR_bench_'+str(k)+'.npy', args.ir == 'burst')
+		t_ir = time.perf_counter() - t0
+	duration = time.perf_counter() - t_pass
+
+	def exposure_time(step_name): # s, from the step name, e.g. 'PL_spectra3'
+		name = step_name.rstrip('0123456789')
+		return flame_s.exposures[name][0] / 1e6
+
+	timings = result['timings']
+	seq_end = max(rec['end'] for rec in timings)
+	wall, busy = breakdown(timings, seq_end, exposure_time, time_scale)
+	# after the sequencer: the spectra flush and the text files, then the statistics
+	wall['disk_io'] += t_optics - seq_end
+	wall['analysis'] += t_stats
+	wall['ir'] += t_ir
+	return {'pass': k, 'duration': duration, 'optics': t_optics, 'ir': t_ir, 'stats': t_stats,
+			'wall': wall, 'busy': busy, 'confidence': float(confidence),
+			'channels': [int(c) for c in result['channels']], 'steps': timings}
+
+
+def summarise(passes):
+	summary = {'duration': sum(p['duration'] for p in passes) / len(passes), 'wall': {}}
+	for cat in CATEGORIES:
+		summary['wall'][cat] = sum(p['wall'].get(cat, 0.0) for p in passes) / len(passes)
+	return summary
+
+
+def report(summary, other = None, label = 'this run', other_label = ''):
+	print('------------- mean time per pass (s) -------------')
+	if other is None:
+		for cat in CATEGORIES:
+			print('%-13s %8.3f' %(cat, summary['wall'][cat]))
+		print('%-13s %8.3f' %('total', summary['duration']))
+		return
+	print('%-13s %10s %10s %8s' %('', other_label[-10:], label[-10:], 'change'))
+	rows = [(cat, other['wall'].get(cat, 0.0), summary['wall'][cat]) for cat in CATEGORIES]
+	rows.append(('total', other['duration'], summary['duration']))
+	for cat, before, after in rows:
+		change = '' if before == 0 else '%+.0f%%' %(100 * (after - before) / before)
+		print('%-13s %10.3f %10.3f %8s' %(cat, before, after, change))
+
+
+def main(argv = None):
+	parser = argparse.ArgumentParser(description = 'time full 16-channel reactor passes')
+	parser.add_argument('--passes', type = int, default = 3)
+	parser.add_argument('--speedup', type = float, default = 20, help = 'simulated clock speedup')
+	parser.add_argument('--ir', choices = ['burst', 'poll', 'none'], default = 'burst', help = 'IR scan after each pass')
+	parser.add_argument('--no-stream', action = 'store_true', help = 'read spectra synchronously instead of streaming')
+	parser.add_argument('--hardware', action = 'store_true', help = 'use the real instruments instead of the simulation')
+	parser.add_argument('--out', default = None, help = 'JSON file, default bench_<commit>.json')
+	parser.add_argument('--compare', default = None, help = 'JSON file of an earlier run')
+	args = parser.parse_args(argv)
+
+	from hardwares import simulated
+	if not args.hardware:
+		simulated.enable(speedup = args.speedup)
+	import mrf_405 as mrf
+	from hardwares import flame_s
+	from hardwares.board_registry import registry
+	from hardwares.spectra_archive import SpectraArchive
+	from fwhm_stats import FWHMStats
+
+	mrf.check_hardware()
+	mrf.file_dir = tempfile.mkdtemp(prefix = 'mrf_bench_')
+	time_scale = simulated.reactor().clock.speedup if simulated.enabled() else 1
+	archive = SpectraArchive(os.path.join(mrf.file_dir, 'spectra_archive.h5'),
+				meta = ('P1', 'P3', 'P4', 'PL_time', 'Cs1_int_time', 'Cs4_int_time'), n_pixel = len(flame_s.wave))
+	stats = FWHMStats()
+	passes = []
+	try:
+		if not args.no_stream:
+			flame_s.start_streaming()
+		for k in range(args.passes):
+			passes.append(run_pass(mrf, archive, stats, k, args, time_scale))
+			print('pass %i: %.2f s' %(k, passes[-1]['duration']))
+	finally:
+		flame_s.stop_streaming()
+		archive.close()
+		registry.close_all()
+
+	commit = git_commit()
+	record = {'commit': commit, 'date': datetime.datetime.now().isoformat(timespec = 'seconds'),
+			'settings': {'passes': args.passes, 'ir': args.ir, 'stream': not args.no_stream,
+						'simulated': simulated.enabled(), 'speedup': time_scale, 'python': sys.version.split()[0]},
+			'summary': summarise(passes), 'passes': passes}
+	out = args.out or 'bench_'+(commit or 'run')+'.json'
+	with open(out, 'w') as f:
+		json.dump(record, f, indent = 1)
+	print('results in '+out)
+
+	if args.compare:
+		with open(args.compare) as f:
+			other = json.load(f)
+		report(record['summary'], other['summary'], commit or out, other.get('commit') or args.compare)
+	else:
+		report(record['summary'])
+	return record
+
+
+if __name__ == "__main__":
+	main()
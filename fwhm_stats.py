@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+"""
+******************************************************************************
+language		: python
+requirement		: numpy
+authors			: Ricki Chairil, Chemical Engineering, University of Southern California
+function		: streaming statistics of the PL FWHMs, so the confidence is
+				  known after every channel instead of after reloading the
+				  fwhms_*.out file at the end of a pass.
+				  - within a pass: Welford mean/variance of the channels
+				    measured so far; a re-measured channel replaces its value.
+				    confidence() applies the rule of the whole-pass confidence
+				    (more than 2 channels without a FWHM count as 60 nm, then
+				    mean + 1.96 SE, optimizers.campaign.group_confidence) and
+				    gives the same numbers at the end.
+				  - across passes: Welford mean/variance and an exponentially
+				    weighted moving average (EWMA) per channel, and an EWMA of the
+				    pass mean.
+				  - drift: a two-sided CUSUM and an EWMA control limit on the
+				    pass mean, against the mean of the first warmup passes after
+				    reset_drift(). call that whenever the set points change.
+******************************************************************************
+"""
+import threading
+import numpy as np
+
+NAN_FWHM = 60		# nm counted for a channel without a FWHM, once more than NAN_LIMIT are missing
+NAN_LIMIT = 2
+
+
+class Welford:
+	# running count, mean and sum of squared deviations; remove() undoes an add()
+	def __init__(self):
+		self.n = 0
+		self.mean = 0.0
+		self.m2 = 0.0
+
+	def add(self, x):
+		self.n += 1
+		delta = x - self.mean
+		self.mean += delta / self.n
+		self.m2 += delta * (x - self.mean)
+
+	def remove(self, x):
+		if self.n <= 1:
+			self.n, self.mean, self.m2 = 0, 0.0, 0.0
+			return
+		delta = x - self.mean
+		self.mean -= delta / (self.n - 1)
+		self.m2 = max(self.m2 - delta * (x - self.mean), 0.0)
+		self.n -= 1
+
+	def merged(self, n, mean, m2 = 0.0):
+		# count, mean and m2 of these values together with n others (Chan et al.)
+		total = self.n + n
+		if total == 0:
+			return 0, float('nan'), 0.0
+		delta = mean - self.mean
+		return total, self.mean + delta * n / total, self.m2 + m2 + delta**2 * self.n * n / total
+
+	def var(self):
+		# population variance, as np.nanstd
+		return self.m2 / self.n if self.n else float('nan')
+
+
+class FWHMStats:
+	# alpha: EWMA weight of the newest pass
+	# cusum_k: nm of slack per pass, cusum_h: nm of accumulated shift that is a drift
+	# ewma_limit: EWMA control limit in standard deviations of the pass means
+	# warmup: passes after reset_drift() that set the reference
+	def __init__(self, n_channels = 16, alpha = 0.3, cusum_k = 0.5, cusum_h = 4, ewma_limit = 3, warmup = 3):
+		self.n_channels = n_channels
+		self.alpha = alpha
+		self.cusum_k = cusum_k
+		self.cusum_h = cusum_h
+		self.ewma_limit = ewma_limit
+		self.warmup = warmup
+		self._lock = threading.Lock()	# channels are recorded from the sequencer threads
+		self.listeners = []				# callables (chan, summary), called after every channel
+
+		# across passes, per channel
+		self.channel = [Welford() for _ in range(n_channels)]
+		self.channel_ewma = np.full(n_channels, np.nan)
+		# across passes, the pass mean
+		self.passes = 0
+		self.pass_ewma = None
+		self.history = []				# summary of every finished pass
+		self.reset_drift()
+		self.new_pass()
+
+	# ------------------------------ one pass ------------------------------
+	def new_pass(self):
+		with self._lock:
+			self.values = np.full(self.n_channels, np.nan)	# FWHM per channel, NaN: none
+			self.measured = np.zeros(self.n_channels, bool)
+			self._pass = Welford()							# the channels with a FWHM
+			self._n_nan = 0
+
+	def add(self, chan, fwhm):
+		# FWHM of one channel (NaN if none was found), replaces an earlier value of the pass
+		with self._lock:
+			if self.measured[chan]:
+				if np.isnan(self.values[chan]):
+					self._n_nan -= 1
+				else:
+					self._pass.remove(self.values[chan])
+			self.measured[chan] = True
+			self.values[chan] = fwhm
+			if np.isnan(fwhm):
+				self._n_nan += 1
+			else:
+				self._pass.add(float(fwhm))
+			summary = self._summary()
+		for listener in self.listeners:
+			listener(chan, summary)
+		return summary
+
+	def confidence(self):
+		# (mean, standard error, mean + 1.96 SE) of the channels measured so far
+		with self._lock:
+			return self._confidence()
+
+	def _confidence(self):
+		n, mean, m2 = self._pass.n, self._pass.mean, self._pass.m2
+		if self._n_nan > NAN_LIMIT:
+			n, mean, m2 = self._pass.merged(self._n_nan, NAN_FWHM)
+		if n == 0:
+			return float('nan'), float('nan'), float('nan')
+		stand_err = np.sqrt(m2 / n) / np.sqrt(n)
+		return mean, stand_err, mean + 1.96 * stand_err
+
+	def _summary(self):
+		mean, stand_err, confidence = self._confidence()
+		return {'pass': self.passes, 'measured': int(self.measured.sum()), 'missing': self._n_nan,
+				'mean': mean, 'stand_err': stand_err, 'confidence': confidence}
+
+	def summary(self):
+		with self._lock:
+			return self._summary()
+
+	# ------------------------------ across passes ------------------------------
+	def end_pass(self):
+		# folds the pass into the per-channel and per-pass statistics, checks for drift,
+		# returns the pass summary, 'drift' is True once the CUSUM or the EWMA limit is crossed
+		with self._lock:
+			summary = self._summary()
+			for chan in np.flatnonzero(self.measured & ~np.isnan(self.values)):
+				x = self.values[chan]
+				self.channel[chan].add(x)
+				old = self.channel_ewma[chan]
+				self.channel_ewma[chan] = x if np.isnan(old) else self.alpha * x + (1 - self.alpha) * old
+			x = summary['mean']
+			if not np.isnan(x):
+				self.pass_ewma = x if self.pass_ewma is None else self.alpha * x + (1 - self.alpha) * self.pass_ewma
+				self._drift_update(x, summary['stand_err'])
+			self.passes += 1
+			summary.update(ewma = self.pass_ewma, cusum = (self.cusum_high, self.cusum_low), drift = self.drift)
+			self.history.append(summary)
+		self.new_pass()
+		return summary
+
+	def reset_drift(self):
+		# the next pass becomes the reference, e.g. after new set points
+		self.reference = None
+		self.cusum_high = 0.0
+		self.cusum_low = 0.0
+		self.drift_ewma = None
+		self._since_reset = Welford()	# pass means since the reset
+		self._stand_err = Welford()		# and their standard errors
+		self.drift = False
+
+	def _drift_update(self, x, stand_err):
+		self._since_reset.add(x)
+		if not np.isnan(stand_err):
+			self._stand_err.add(stand_err)
+		if self._since_reset.n <= self.warmup:
+			self.reference = self._since_reset.mean
+			self.drift_ewma = self.reference
+			return
+		self.cusum_high = max(0.0, self.cusum_high + x - self.reference - self.cusum_k)
+		self.cusum_low = max(0.0, self.cusum_low + self.reference - x - self.cusum_k)
+		self.drift_ewma = self.alpha * x + (1 - self.alpha) * self.drift_ewma
+		# spread of a pass mean: the standard error within a pass, or the spread between the passes once known
+		sigma = self._stand_err.mean if self._stand_err.n else 0.0
+		if self._since_reset.n >= 5:
+			sigma = max(sigma, np.sqrt(self._since_reset.var()))
+		# the limit includes the uncertainty of the reference itself
+		limit = self.ewma_limit * sigma * np.sqrt(self.alpha / (2 - self.alpha) + 1 / self.warmup)
+		ewma_out = sigma > 0 and abs(self.drift_ewma - self.reference) > limit
+		self.drift = self.drift or self.cusum_high > self.cusum_h or self.cusum_low > self.cusum_h or ewma_out
+
+	def channel_stats(self):
+		# per channel across the passes: (count, mean, standard deviation, EWMA)
+		with self._lock:
+			return [(w.n, w.mean if w.n else float('nan'), np.sqrt(w.var()), e)
+					for w, e in zip(self.channel, self.channel_ewma)]
@@ -10,7 +10,7 @@ Arduino_SN = {
 
 # A dictionary of ArduinoMega boards
 ArduinoMega_SN = {
-	# '95530343235351605281' : 'Mega_1',		# used for IR reading, not control
+	'95530343235351605281' : 'Mega_1',			# used for IR reading, not control
 	'55739323637351517151' : 'Mega_2',			# used for controlling linear stage
 	'95530343235351900242' : 'Mega_3'}			# used for controlling optical devices
 
@@ -6,6 +6,7 @@ Updated on Thu May 12 2022
 hardware		: Arduino Uno/Mega
 language		: python
 requirement		: the Arduino boards must be loaded with Firmata file (Arduino IDE)
+				  the stage board (Mega_2) with ConfigurableFirmata for hardware stepping
 author			: Lu Wang, Chemical Engineering, University of Southern California
 				: Ricki Chairil, Chemical Engineering, University of Southern California
 function		: Integrate all the Arduino control, include:
@@ -14,74 +15,94 @@ function		: Integrate all the Arduino control, include:
 				  optical switches
 ******************************************************************************
 """
-import serial
-from serial.tools.list_ports import comports
+import threading
 
-from pyfirmata import ArduinoMega	# for connecting to ArduinoMega
-from pyfirmata import Arduino		# for connecting to ArduinoUno
-
-
-import time
-
-from hardwares import arduino_boards		
 # changed the directory name from "hardwares" in the original Github link
-# import the Arduino board serial numbers
-
+# the boards are found by their serial numbers in arduino_boards.py
+from hardwares.board_registry import registry
+from hardwares.stepper import FirmataStepper
+from hardwares import simulated
+from hardwares.simulated import clock	# time()/sleep(), on the simulated clock under MRF_SIMULATE=1
 
 
-# =============== connect to all the Arduino boards, and ===================
-# ============ create a dictionary of board name and board class ==========
 
-Arduino_SN = arduino_boards.Arduino_SN
-ArduinoMega_SN = arduino_boards.ArduinoMega_SN
-
-Arduinos = {}			# Initialize the board dictionary
-for comport in comports():
-	# print(comport.vid)			# 9025 (type: int)
-	# print(comport.serial_number)	# "95530343235351605281" (type: str)
-	# print(comport.device)			# "COM4" (type: str)
-	# print(comport)				# "COM4 - USB Serial Device (COM4)" (type: class)
-	SN = comport.serial_number
-	
-	if SN in ArduinoMega_SN.keys():
-		board_name = ArduinoMega_SN[SN]
-		print(board_name, ':', comport.device)
-		# adding the 'timeout' to prevent raising writeTimeout Error, it's None by default
-		board = ArduinoMega(comport.device, timeout = 0)
-		# time.sleep(0.5)		# Wait for communication to get established
-		Arduinos[board_name] = board
-		
-	elif SN in Arduino_SN.keys():
-		board_name = Arduino_SN[SN]
-		print(board_name, ':',  comport.device)
-		board = Arduino(comport.device)
-		# time.sleep(0.5)		# Wait for communication to get established
-		Arduinos[board_name] = board
+# Stage moves timed by the board (AccelStepperFirmata); stage_move falls back to stepping
+# from python when the board runs plain StandardFirmata
+STAGE_MAX_SPEED = 4000		# steps/s
+STAGE_ACCELERATION = 16000	# steps/s^2
 
+# boards and pins, set by connect()
+mega_2 = None
+mega_3 = None
+stage_direct = None
+stage_step = None
+stage_stepper = None
+uv_vis_pin = None
+led_pin = None
+optic_switch = []
+connected = False
+_connect_lock = threading.Lock()
 
 
 # =================== assign pins for each board ====================
-# Define each board
-# uno_1 = Arduinos['Uno_1']
-# mega_1 = Arduinos['Mega_1']
-mega_2 = Arduinos['Mega_2']
-mega_3 = Arduinos['Mega_3']
-
-
-# Define pins for stage moving (mega_2)
-stage_direct = mega_2.get_pin('d:7:o')
-stage_step = mega_2.get_pin('d:8:o')
-
-
-# Define pins for light sources (mega_3)
-uv_vis_pin = mega_3.get_pin('d:13:o')
-led_pin = mega_3.get_pin('d:53:o')
-
-# Define a list of pins for optic switches (mega_3)
-optic_switch = [mega_3.get_pin('d:41:o'),
-				mega_3.get_pin('d:43:o'),
-				mega_3.get_pin('d:45:o'),
-				mega_3.get_pin('d:47:o')]
+# Called by the control functions on first use, or explicitly at the start of a run
+def connect():
+	global mega_2, mega_3, stage_direct, stage_step, stage_stepper, uv_vis_pin, led_pin, optic_switch, connected
+	global STAGE_SETTLE, SOLENOID_SETTLE, LED_SETTLE, UV_VIS_SETTLE
+	if connected:
+		return
+	with _connect_lock: # the first use may come from several worker threads at once
+		if connected:
+			return
+		# Define each board, opened once by the registry and shared with the other modules
+		# uno_1 = registry.get('Uno_1')
+		# mega_1 = registry.get('Mega_1')	# IR board, used in mrf_405.ir_mux
+		mega_2 = registry.get('Mega_2')
+		mega_3 = registry.get('Mega_3')
+
+		# Define pins for stage moving (mega_2)
+		stage_direct = mega_2.get_pin('d:7:o')
+		stage_step = mega_2.get_pin('d:8:o')
+
+		registry.start_iterator('Mega_2')	# processes the move-complete replies
+		with registry.lock('Mega_2'): # the probe is a request and its reply
+			stage_stepper = FirmataStepper(mega_2, step_pin = 8, dir_pin = 7,
+											max_speed = STAGE_MAX_SPEED, acceleration = STAGE_ACCELERATION)
+			probed = stage_stepper.probe()
+		if not probed:
+			print('Mega_2 : no AccelStepperFirmata, stepping the stage from python')
+			stage_stepper = None
+
+		# Define pins for light sources (mega_3)
+		uv_vis_pin = mega_3.get_pin('d:13:o')
+		led_pin = mega_3.get_pin('d:53:o')
+
+		# Define a list of pins for optic switches (mega_3)
+		optic_switch = [mega_3.get_pin('d:41:o'),
+						mega_3.get_pin('d:43:o'),
+						mega_3.get_pin('d:45:o'),
+						mega_3.get_pin('d:47:o')]
+		# simulated hardware settles on the faster simulated clock; scaled from the real-time
+		# values, so connecting again does not shorten them further
+		speedup = simulated.reactor().clock.speedup if simulated.enabled() else 1
+		STAGE_SETTLE, SOLENOID_SETTLE, LED_SETTLE, UV_VIS_SETTLE = [t / speedup for t in _REAL_SETTLE]
+		connected = True
+
+
+
+# Minimum settle times (s) after each action, used by the pass sequencer instead of fixed 1 s sleeps
+# tune on the rig: the spectrum is taken right after these have elapsed
+STAGE_SETTLE = 0.3		# stage vibration after a one-block move
+SOLENOID_SETTLE = 0.1	# optical switch actuation
+LED_SETTLE = 0.05		# 405 nm LED reaches steady output
+UV_VIS_SETTLE = 0.5		# UV-vis lamp output after switching on
+_REAL_SETTLE = (STAGE_SETTLE, SOLENOID_SETTLE, LED_SETTLE, UV_VIS_SETTLE)	# real time, scaled by connect()
+
+
+# Stage position in steps away from the motor, block 0 (channels 0-3) is 0.
+# Set at the start of a run (stage_set_home) and updated by every stage_move.
+STAGE_BLOCK_STEPS = 4060	# steps motor need to go to travel one block
+stage_position = 0
 
 
 
@@ -90,43 +111,92 @@ optic_switch = [mega_3.get_pin('d:41:o'),
 def stage_move(n,direction):
 # n: number of blocks the stage need to move
 # direction: "towards motor"==1, "away from motor"==0
-	pulse_width = 2/1000000.0 # 2 microseconds
-	sec_between_steps = 1/1000000.0 # larger number results in slower steps
-	block_steps = 4060 	# steps motor need to go to travel one block
+	global stage_position
+	connect()
+	block_steps = STAGE_BLOCK_STEPS
 	if direction == "towards motor":
-		stage_direct.write(1)
+		stage_position -= n*block_steps
 	elif direction == "away from motor":
-		stage_direct.write(0)
-
-	for step in range (n*block_steps):
-		stage_step.write(1)
-		time.sleep(pulse_width)
-		stage_step.write(0)
-		time.sleep(sec_between_steps)
+		stage_position += n*block_steps
+
+	# one move at a time on Mega_2: the move command and its reply, or the whole pulse train
+	with registry.lock('Mega_2'):
+		if stage_stepper is not None:
+			# one command, the board ramps and times the steps and reports when it is done
+			if direction == "towards motor":
+				stage_stepper.move(n*block_steps)
+			elif direction == "away from motor":
+				stage_stepper.move(-n*block_steps)
+			return
+
+		pulse_width = 2/1000000.0 # 2 microseconds
+		sec_between_steps = 1/1000000.0 # larger number results in slower steps
+		if direction == "towards motor":
+			stage_direct.write(1)
+		elif direction == "away from motor":
+			stage_direct.write(0)
+
+		for step in range (n*block_steps):
+			stage_step.write(1)
+			clock.sleep(pulse_width)
+			stage_step.write(0)
+			clock.sleep(sec_between_steps)
+
+
+# The stage is at its initial position (block 0), e.g. after custom_move_stage
+def stage_set_home():
+	global stage_position
+	stage_position = 0
+
+
+def stage_block():
+	return round(stage_position / STAGE_BLOCK_STEPS)
+
+
+# Move the stage to block 0-3 from wherever it is, returns the number of blocks travelled
+def stage_goto(block):
+	blocks = block - stage_block()
+	if blocks > 0:
+		stage_move(blocks, 'away from motor')
+	elif blocks < 0:
+		stage_move(-blocks, 'towards motor')
+	return abs(blocks)
+
+
+# Move stage and choose optical switch according to channel number, in any order
+def goto_chan(chan):
+	blocks = stage_goto(chan // 4)	# stage_pos: i in the flow chart
+	# open optical switches accordingly
+	optical_switch(chan, 1)			# optic_pos: j in the flow chart (remainer)
+	return blocks
 
 
-# Move stage and choose optical switch according to channel number
+# Kept for the old 0..15 sweep: with the tracked position it is the same as goto_chan
 def choose_chan(chan): #, init_count):
-	
-	stage_pos = chan // 4	# stage_pos: i in the flow chart
-	optic_pos = chan % 4	# optic_pos: j in the flow chart (remainer)
-
-	if optic_pos == 0:	# this means it's time to start a new stage location
-		if stage_pos > 0:	# stage should be at 2/3/4th location
-			# Move stage to the next location
-			stage_move(1,'away from motor')
-		# else:	# stage should stay at the 1st location and not moving
-			
-	#else: # it's in the process of switching optical swtiches, no need to move stage
-	
-	# open optical switches accordingly
-	optical_switch(chan, 1)
+	goto_chan(chan)
+
+
+# Order a set of channels for the least stage travel from the current block.
+# The blocks lie on a line, so the shortest path sweeps them once starting from the
+# nearer end; consecutive passes therefore run serpentine (0..15, then 15..0) and
+# the 3-block return is never needed. Returns (channels in order, blocks travelled).
+def plan_channels(channels, start_block = None):
+	if start_block is None:
+		start_block = stage_block()
+	channels = sorted(set(channels))
+	if not channels:
+		return [], 0
+	first, last = channels[0] // 4, channels[-1] // 4
+	if abs(start_block - last) < abs(start_block - first):
+		channels.reverse()
+	travel = min(abs(start_block - first), abs(start_block - last)) + last - first
+	return channels, travel
 
 
 # Move stage back to the first position
 def stage_return():
-	# Move stage from location 4 to location 1
-	stage_move(3,'towards motor')
+	# Move stage to location 1 from wherever it is
+	stage_goto(0)
 
 
 # Moving stage according to user input
@@ -190,33 +260,37 @@ def custom_move_stage():
 
 
 def light_source(on_light = None):
-	if on_light == None:
-		#print("Turn off both lights")
-		led_pin.write(0)
-		uv_vis_pin.write(0)
-	elif on_light == "LED":
-		#print("Turn on LED light source")
-		uv_vis_pin.write(0)
-		led_pin.write(1)
-	elif on_light == "UV-vis":
-		#print("Turn on UV-vis light source")
-		led_pin.write(0)
-		uv_vis_pin.write(1)
+	connect()
+	with registry.lock('Mega_3'): # both lamp pins change together
+		if on_light == None:
+			#print("Turn off both lights")
+			led_pin.write(0)
+			uv_vis_pin.write(0)
+		elif on_light == "LED":
+			#print("Turn on LED light source")
+			uv_vis_pin.write(0)
+			led_pin.write(1)
+		elif on_light == "UV-vis":
+			#print("Turn on UV-vis light source")
+			led_pin.write(0)
+			uv_vis_pin.write(1)
 
 
 # Switch jth solenoid on/off
 def optical_switch(chan,status):
 # status: on=1, off=0
+	connect()
 	optic_pos = chan % 4	# optic_pos: j in the flow chart (remainer)
 
-	if status == 1:
-		optic_switch[optic_pos].write(1)
-	elif status == 0:
-		optic_switch[optic_pos].write(0)
+	with registry.lock('Mega_3'):
+		if status == 1:
+			optic_switch[optic_pos].write(1)
+		elif status == 0:
+			optic_switch[optic_pos].write(0)
 
 
 def exit_boards():
-	for board in boards:	# board is key in the dictionary, boards is not defined
-		boards[board].exit()
-		print(board)
+	global connected
+	registry.close_all()
+	connected = False
 
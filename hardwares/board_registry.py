@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+"""
+******************************************************************************
+hardware		: Arduino Uno/Mega
+language		: python
+requirement		: pyfirmata, pyserial, the boards loaded with Firmata (Arduino IDE)
+author			: Ricki Chairil, Chemical Engineering, University of Southern California
+function		: one place that finds and opens the Arduino boards.
+				  the serial ports are enumerated once, a board is only opened
+				  (and pays the Firmata handshake) the first time it is asked
+				  for by its name in arduino_boards.py, e.g. 'Mega_1', and the
+				  same connection is then shared by every module and thread.
+				  close_all() exits every open board at the end of a run.
+				  a thread that writes several pins in a row (multiplexer select
+				  and read, stage SysEx and its reply, the lamp pins) holds
+				  lock(name) for the whole sequence.
+******************************************************************************
+"""
+import threading
+
+from hardwares import arduino_boards
+from hardwares import simulated	# stand-in boards, MRF_SIMULATE=1
+
+
+class BoardRegistry:
+	def __init__(self, mega_sn = None, uno_sn = None):
+		self.mega_sn = arduino_boards.ArduinoMega_SN if mega_sn is None else mega_sn
+		self.uno_sn = arduino_boards.Arduino_SN if uno_sn is None else uno_sn
+		self._lock = threading.Lock()	# guards the dictionaries below
+		self._ports = None		# board name: serial device, e.g. 'COM5'
+		self._boards = {}		# board name: open pyfirmata board
+		self._board_locks = {}	# board name: lock shared by the threads using that board
+		self._iterators = {}	# board name: pyfirmata iterator thread
+
+	def discover(self, refresh = False):
+		# board name: serial device of every known board that is plugged in
+		with self._lock:
+			if self._ports is None or refresh:
+				ports = {}
+				if simulated.enabled(): # every board is 'plugged in'
+					for name in list(self.mega_sn.values()) + list(self.uno_sn.values()):
+						ports[name] = 'SIM'
+				else:
+					from serial.tools.list_ports import comports	# imported on first use, like the boards
+					for comport in comports():
+						SN = comport.serial_number
+						if SN in self.mega_sn:
+							ports[self.mega_sn[SN]] = comport.device
+						elif SN in self.uno_sn:
+							ports[self.uno_sn[SN]] = comport.device
+				self._ports = ports
+			return dict(self._ports)
+
+	def port(self, name):
+		ports = self.discover()
+		if name not in ports:
+			raise KeyError('Arduino board '+name+' is not connected')
+		return ports[name]
+
+	def get(self, name):
+		# the open board, connected on first use
+		port = self.port(name)
+		with self._lock:
+			if name not in self._boards:
+				if simulated.enabled():
+					board = simulated.FakeBoard(name)
+				elif name in self.mega_sn.values():
+					from pyfirmata import ArduinoMega
+					# adding the 'timeout' to prevent raising writeTimeout Error, it's None by default
+					board = ArduinoMega(port, timeout = 0)
+				else:
+					from pyfirmata import Arduino
+					board = Arduino(port)
+				print(name, ':', port)
+				self._boards[name] = board
+				self._board_locks[name] = threading.RLock()
+			return self._boards[name]
+
+	def lock(self, name):
+		# hold this around a sequence of calls that must not interleave with another thread
+		self.get(name)
+		return self._board_locks[name]
+
+	def start_iterator(self, name):
+		# one iterator thread per board, needed for reading inputs and SysEx replies
+		board = self.get(name)
+		with self._lock:
+			if name not in self._iterators:
+				if getattr(board, 'simulated', False): # replies are delivered directly
+					self._iterators[name] = None
+					return None
+				from pyfirmata import util
+				it = util.Iterator(board)
+				it.daemon = True
+				it.start()
+				self._iterators[name] = it
+			return self._iterators[name]
+
+	def is_open(self, name):
+		return name in self._boards
+
+	def close(self, name):
+		with self._lock:
+			board = self._boards.pop(name, None)
+			self._board_locks.pop(name, None)
+			self._iterators.pop(name, None)
+		if board is not None:
+			board.exit()
+
+	def close_all(self):
+		for name in list(self._boards):
+			self.close(name)
+
+
+# shared by all the modules of a run
+registry = BoardRegistry()
@@ -0,0 +1,135 @@
+/*
+******************************************************************************
+hardware		: Arduino Mega (Mega_1, IR board) with two 16-channel analogue multiplexers
+language		: Arduino C++
+requirement		: Firmata library (Arduino IDE library manager)
+author			: Ricki Chairil, Chemical Engineering, University of Southern California
+function		: Firmata firmware for the IR board with a buffered burst mode.
+				  the usual Firmata messages used by pyfirmata still work
+				  (pin modes, digital writes, analog reporting), so the polling
+				  path in multiplexer.py is unchanged. in addition, the IR_BURST
+				  SysEx selects one multiplexer channel, samples its analog pin
+				  N times on a fixed period timed by micros(), and sends the
+				  samples back in a few SysEx messages (see hardwares/ir_burst.py).
+******************************************************************************
+*/
+#include <Firmata.h>
+
+#define IR_BURST 0x01					// user-defined SysEx command (0x00-0x0F are free)
+#define MAX_SAMPLES 2000				// 4 kB of the Mega's 8 kB RAM
+#define SAMPLES_PER_MESSAGE 24
+#define MUX_SETTLE_MS 10				// same settle as multiplexer.SwitchMUX
+
+const byte selectPins[2][4] = {{30, 31, 32, 33}, {40, 41, 42, 43}};
+const byte signalPins[2] = {3, 4};		// analog inputs A3, A4
+
+uint16_t samples[MAX_SAMPLES];
+byte pinIsOutput[TOTAL_PINS];
+uint16_t analogReportMask = 0;
+unsigned int samplingInterval = 19;		// ms, Firmata default
+unsigned long previousMillis = 0;
+
+
+// ------------------------- standard Firmata handling --------------------------
+void setPinModeCallback(byte pin, int mode) {
+	if (pin >= TOTAL_PINS) return;
+	pinIsOutput[pin] = (mode == OUTPUT);
+	if (mode == OUTPUT) pinMode(PIN_TO_DIGITAL(pin), OUTPUT);
+	else if (mode == INPUT) pinMode(PIN_TO_DIGITAL(pin), INPUT);
+}
+
+void digitalWriteCallback(byte port, int value) {
+	// one message sets all the output pins of an 8-pin port
+	for (byte i = 0; i < 8; i++) {
+		byte pin = port * 8 + i;
+		if (pin < TOTAL_PINS && pinIsOutput[pin]) digitalWrite(PIN_TO_DIGITAL(pin), (value >> i) & 1);
+	}
+}
+
+void reportAnalogCallback(byte analogPin, int value) {
+	if (analogPin >= TOTAL_ANALOG_PINS) return;
+	if (value) analogReportMask |= (1 << analogPin);
+	else analogReportMask &= ~(1 << analogPin);
+}
+
+// 16-bit / 32-bit little-endian packing, Firmata.sendSysex splits every byte into two 7-bit bytes
+byte put16(byte *buf, byte i, uint16_t v) { buf[i] = v & 0xFF; buf[i + 1] = v >> 8; return i + 2; }
+byte put32(byte *buf, byte i, uint32_t v) { i = put16(buf, i, v & 0xFFFF); return put16(buf, i, v >> 16); }
+
+
+// ------------------------------- burst sampling -------------------------------
+// request (7-bit bytes): mux (0/1), channel (0-15), n (2 bytes, LSB first), period in us (2 bytes)
+// reply: header  [0, mux, channel, n(16), period(16), t_start(32), t_end(32)]
+//        samples [1, mux, channel, offset(16), count, value(16) x count], 10-bit ADC values
+void burst(byte mux, byte chan, uint16_t n, uint16_t period) {
+	if (mux > 1 || chan > 15) return;
+	if (n > MAX_SAMPLES) n = MAX_SAMPLES;
+
+	for (byte i = 0; i < 4; i++) digitalWrite(selectPins[mux][i], (chan >> i) & 1);
+	delay(MUX_SETTLE_MS);
+
+	unsigned long tStart = micros();
+	unsigned long next = tStart;
+	for (uint16_t k = 0; k < n; k++) {
+		while ((long)(micros() - next) < 0) {}
+		samples[k] = analogRead(signalPins[mux]);
+		next += period;
+	}
+	unsigned long tEnd = micros();
+
+	byte msg[6 + 2 * SAMPLES_PER_MESSAGE];
+	byte i = 0;
+	msg[i++] = 0; msg[i++] = mux; msg[i++] = chan;
+	i = put16(msg, i, n);
+	i = put16(msg, i, period);
+	i = put32(msg, i, tStart);
+	i = put32(msg, i, tEnd);
+	Firmata.sendSysex(IR_BURST, i, msg);
+
+	for (uint16_t offset = 0; offset < n; offset += SAMPLES_PER_MESSAGE) {
+		byte count = min((uint16_t)SAMPLES_PER_MESSAGE, (uint16_t)(n - offset));
+		i = 0;
+		msg[i++] = 1; msg[i++] = mux; msg[i++] = chan;
+		i = put16(msg, i, offset);
+		msg[i++] = count;
+		for (byte k = 0; k < count; k++) i = put16(msg, i, samples[offset + k]);
+		Firmata.sendSysex(IR_BURST, i, msg);
+	}
+}
+
+void sysexCallback(byte command, byte argc, byte *argv) {
+	if (command == IR_BURST && argc >= 6) {
+		burst(argv[0], argv[1], argv[2] | (argv[3] << 7), argv[4] | (argv[5] << 7));
+	}
+	else if (command == SAMPLING_INTERVAL && argc >= 2) {
+		samplingInterval = argv[0] | (argv[1] << 7);
+	}
+}
+
+
+void setup() {
+	Firmata.setFirmwareVersion(FIRMATA_FIRMWARE_MAJOR_VERSION, FIRMATA_FIRMWARE_MINOR_VERSION);
+	Firmata.attach(SET_PIN_MODE, setPinModeCallback);
+	Firmata.attach(DIGITAL_MESSAGE, digitalWriteCallback);
+	Firmata.attach(REPORT_ANALOG, reportAnalogCallback);
+	Firmata.attach(START_SYSEX, sysexCallback);
+	for (byte mux = 0; mux < 2; mux++) {
+		for (byte i = 0; i < 4; i++) {
+			pinMode(selectPins[mux][i], OUTPUT);
+			pinIsOutput[selectPins[mux][i]] = 1;
+		}
+	}
+	Firmata.begin(57600);
+}
+
+void loop() {
+	while (Firmata.available()) Firmata.processInput();
+
+	unsigned long currentMillis = millis();
+	if (currentMillis - previousMillis >= samplingInterval) {
+		previousMillis = currentMillis;
+		for (byte pin = 0; pin < TOTAL_ANALOG_PINS; pin++) {
+			if (analogReportMask & (1 << pin)) Firmata.sendAnalog(pin, analogRead(pin));
+		}
+	}
+}
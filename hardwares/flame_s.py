@@ -5,29 +5,60 @@ Revised on Tues May 24 2022
 ******************************************************************************
 hardware		: FlameS spectrometer, Ocean Optics - 200 um slit
 language		: python
-requirement		: install python-seabreeze (https://github.com/ap--/python-seabreeze), a CSV file called "PL_spectra.csv" in directory
+requirement		: install python-seabreeze (https://github.com/ap--/python-seabreeze)
 authors			: Lu Wang, Chemical Engineering, University of Southern California
 				: Ricki Chairil, Chemical Engineering, University of Southern California
 function		: grab spectrum information from FlameS and process the
 				  PL data and UV-vis data in real-time
+				  the spectrometer is opened by connect() or on first use, so the
+				  FWHM and absorbance functions can be imported without it
 ******************************************************************************
 """
 
-import seabreeze.spectrometers as sb	# Ocean optics
 import numpy as np
-from scipy.signal import savgol_filter	# Savitzky-Golay filter for smoothing uv-vis specs
-import time
-import pandas as pd 					# export spectra into csv's
-
-# spectrometer initialization
-spectrometers = sb.list_devices()			# recognize devices
-print(spectrometers)
-flames = sb.Spectrometer(spectrometers[0])	# get specification from first device
-# start reading
-wave = flames.wavelengths()			# return an array containing all wavelengths
-# test spectrometer
-flames.intensities()
-spectrum = flames.intensities()
+from hardwares.savgol import savgol_smooth	# Savitzky-Golay filter with cached kernels for smoothing uv-vis specs
+import threading
+import itertools
+from enum import IntEnum
+
+from hardwares.spectra_store import SpectraStore	# in-memory pass buffer for spectra
+from hardwares.flame_stream import SpectrometerStreamer	# background acquisition thread
+from hardwares import simulated	# stand-in spectrometer, MRF_SIMULATE=1
+from hardwares.simulated import clock	# time()/sleep(), on the simulated clock under MRF_SIMULATE=1
+
+flames = None		# the spectrometer, set by connect()
+wave = None			# array containing all wavelengths, set by connect()
+# channel x pixel buffers of one pass, filled by get_PL/get_abs and written once by flush_spectra()
+store = None
+
+_connect_lock = threading.Lock()
+
+# spectrometer initialization, does nothing once connected
+def connect():
+	global flames, wave, store
+	if flames is not None:
+		return flames
+	with _connect_lock: # the first use may come from several worker threads at once
+		if flames is None:
+			if simulated.enabled():
+				sb = simulated
+			else:
+				import seabreeze.spectrometers as sb	# Ocean optics
+			spectrometers = sb.list_devices()			# recognize devices
+			print(spectrometers)
+			device = sb.Spectrometer(spectrometers[0])	# get specification from first device
+			# start reading
+			wave = device.wavelengths()			# return an array containing all wavelengths
+			# test spectrometer
+			device.intensities()
+			device.intensities()
+			store = SpectraStore(16, len(wave), ['PL_spectra', 'Abs_spectra_100ms', 'Abs_spectra_150ms'])
+			flames = device
+	return flames
+
+def get_wave():
+	connect()
+	return wave
 
 # If there is a blank sample (standard sample) of 16 channels available
 # toluene_object = np.load('Toluene.npy', allow_pickle = True)	# a transmittance spec when only pure toluene in tube
@@ -37,89 +68,137 @@ Cs1_int_time = 100000 # integration time for Cs1 in us (200 um slit)
 Cs4_int_time = 150000 # integration time for Cs4 in us (200 um slit)
 PL_time = 100000 # integration time for PL detection
 
+# exposures taken at every channel, name (pass buffer): (integration time in us, light source)
+exposures = {'PL_spectra': (PL_time, 'LED'),
+			'Abs_spectra_100ms': (Cs1_int_time, 'UV-vis'),
+			'Abs_spectra_150ms': (Cs4_int_time, 'UV-vis')}
+itime_changes = 0 # integration time commands actually sent to the device (synchronous reads)
+
+# background acquisition, see start_streaming()
+streamer = None
+
+def start_streaming(n_slots = 32):
+	# read spectra continuously on a dedicated thread; read_spectrum() then picks frames from its ring buffer
+	global streamer
+	connect()
+	if streamer is None:
+		streamer = SpectrometerStreamer(flames, PL_time, n_slots)
+		streamer.start()
+	return streamer
+
+def stop_streaming():
+	global streamer
+	if streamer is not None:
+		streamer.stop()
+		streamer = None
+
+# Return the start time and intensities of one exposure at int_time (us)
+# while streaming, this is the first frame that started after the call, so it never
+# contains light from before a lamp or optical switch change made by the caller
+current_int_time = None
+
+def read_spectrum(int_time):
+	global current_int_time, itime_changes
+	connect()
+	if streamer is None:
+		if int_time != current_int_time: # every change is a USB round trip and restarts the exposure
+			flames.integration_time_micros(int_time)
+			current_int_time = int_time
+			itime_changes += 1
+		return clock.time(), flames.intensities()
+	since = clock.time()
+	streamer.set_integration_time(int_time)
+	t, _, spec = streamer.wait_for_new(since, int_time)
+	return t, spec
+
 def direct_read():
-	flames.integration_time_micros(Cs4_int_time) # integration time depends on slit size
-	spec = flames.intensities()
+	_, spec = read_spectrum(Cs4_int_time) # integration time depends on slit size
 	return spec
 
-def get_PL(i): # obtain fluorescent spectra 
-	if i == 0: # if it's the first channel
-		
-		# clear the contents of the previous file
-		filename = "PL_spectra.csv"
-		f = open(filename, "w+")
-		f.close()
-
-		# obtain intensities at current location
-		flames.integration_time_micros(PL_time)
-		spec = flames.intensities()
-
-		# write results to a file
-		df = pd.DataFrame(spec)
-		df.to_csv("PL_spectra.csv")
-
-	else:
-		# obtain intensities at current location
-		flames.integration_time_micros(PL_time)
-		spec = flames.intensities()
+# Take one PL spectrum of channel chan, store it in the pass buffer and return (time, spectrum)
+# the same array is used for the FWHM analysis, so stored and analysed spectra are identical
+def acquire_pl(chan):
+	connect()
+	if chan == 0: # if it's the first channel, clear the previous pass
+		store.clear('PL_spectra')
+
+	pl_time, spec = read_spectrum(PL_time)
+	store.fill('PL_spectra', chan, spec) # written to disk by flush_spectra()
+	return pl_time, spec
+
+# Take the two absorbance exposures of channel chan, store them and return (time, 100 ms, 150 ms spectrum)
+def acquire_abs(chan):
+	connect()
+	if chan == 0: # if it's the first channel, clear the previous pass
+		store.clear('Abs_spectra_100ms')
+		store.clear('Abs_spectra_150ms')
+
+	abs_time, spec_Cs1 = read_spectrum(Cs1_int_time) # for Cs1
+	store.fill('Abs_spectra_100ms', chan, spec_Cs1)
+	_, spec_Cs4 = read_spectrum(Cs4_int_time) # for Cs4
+	store.fill('Abs_spectra_150ms', chan, spec_Cs4)
+	return abs_time, spec_Cs1, spec_Cs4
+
+# Take exposure 'name' (key of exposures) of channel chan, store it and return (time, spectrum)
+def acquire(chan, name):
+	acq_time, spec = read_spectrum(exposures[name][0])
+	store.fill(name, chan, spec)
+	return acq_time, spec
+
+# Order the exposures of every channel so that consecutive exposures share integration time
+# and light source, carrying the last setting over from one channel to the next: e.g.
+# PL, Abs 100ms, Abs 150ms on one channel and Abs 150ms, Abs 100ms, PL on the next.
+# Returns [(chan, [exposure names])] and the integration time changes of the plan and of
+# the fixed order (naive), so the saving can be reported.
+def plan_exposures(channels, names = None):
+	if names is None:
+		names = list(exposures)
+
+	def cost(order, int_time, light):
+		itime_switches = 0
+		light_switches = 0
+		for name in order:
+			itime_switches += exposures[name][0] != int_time
+			light_switches += exposures[name][1] != light
+			int_time, light = exposures[name]
+		return itime_switches, light_switches, int_time, light
+
+	plan = []
+	planned = 0
+	naive = 0
+	int_time, light = current_int_time, None
+	naive_time, naive_light = current_int_time, None
+	for chan in channels:
+		best = None
+		for order in itertools.permutations(names):	# first one is the fixed order, kept on ties
+			c = cost(order, int_time, light)
+			if best is None or c[0] + c[1] < best[1][0] + best[1][1]:
+				best = (list(order), c)
+		order, (itime_switches, _, int_time, light) = best
+		plan.append((chan, order))
+		planned += itime_switches
+
+		itime_switches, _, naive_time, naive_light = cost(names, naive_time, naive_light)
+		naive += itime_switches
+	return plan, {'planned': planned, 'naive': naive, 'saved': naive - planned}
 
-		# import the previous channel's spectral data then append them columnwise to the current set
-		df_prev = pd.read_csv("PL_spectra.csv")
-		df_curr = pd.DataFrame(spec)
-		df = pd.concat([df_prev,df_curr], axis=1)
-		df.to_csv("PL_spectra.csv")
-	# return spec
+def get_PL(i): # obtain fluorescent spectra 
+	acquire_pl(i)
 
 def get_abs(i): # obtain absorbance spectra 
-	if i == 0: # if it's the first channel
-		
-		# clear the contents of the previous file
-		filename = "Abs_spectra_100ms.csv"
-		f = open(filename, "w+")
-		f.close()
-
-		filename = "Abs_spectra_150ms.csv"
-		f = open(filename, "w+")
-		f.close()
+	acquire_abs(i)
 
-		# obtain intensities at current location at different integration times
-		flames.integration_time_micros(Cs1_int_time) # for Cs1
-		spec = flames.intensities()
+def clear_spectra():
+	# start a new pass in the buffers, channels that are not measured stay 'nan'
+	connect()
+	store.clear()
 
-		# write results to a file
-		df = pd.DataFrame(spec)
-		df.to_csv("Abs_spectra_100ms.csv")
-
-		# obtain intensities at current location
-		flames.integration_time_micros(Cs4_int_time) # for Cs4
-		spec = flames.intensities()
-
-		# write results to a file
-		df = pd.DataFrame(spec)
-		df.to_csv("Abs_spectra_150ms.csv")
-
-	else:
-		# obtain intensities at current location
-		flames.integration_time_micros(Cs1_int_time)
-		spec = flames.intensities()
-
-		# import the previous channel's spectral data then append them columnwise to the current set
-		df_prev = pd.read_csv("Abs_spectra_100ms.csv")
-		df_curr = pd.DataFrame(spec)
-		df = pd.concat([df_prev,df_curr], axis=1)
-		df.to_csv("Abs_spectra_100ms.csv")
-
-		# obtain intensities at current location
-		flames.integration_time_micros(Cs4_int_time)
-		spec = flames.intensities()
-
-		# import the previous channel's spectral data then append them columnwise to the current set
-		df_prev = pd.read_csv("Abs_spectra_150ms.csv")
-		df_curr = pd.DataFrame(spec)
-		df = pd.concat([df_prev,df_curr], axis=1)
-		df.to_csv("Abs_spectra_150ms.csv")
-
-	# return spec
+def flush_spectra(directory = ''):
+	# write the PL and Abs buffers of the whole pass at once, call after the last channel
+	# files: PL_spectra.npy, Abs_spectra_100ms.npy, Abs_spectra_150ms.npy (pixel x channel),
+	# written into directory, the data folder of the run
+	connect()
+	return store.flush(directory)
 
 
 
@@ -129,21 +208,19 @@ def read_pl(start = 760):
 	# define wavelength range of interest (ROI) by index numbers
 	# so that we can eliminate the tall peak around 405 nm, which is excitation wavelength
 	
-	# set integration time in microseconds (us)
-	flames.integration_time_micros(PL_time)
-	
-	realtime_pl = time.time()
-	# read spectrum
-	pl_spec = flames.intensities()
+	# read spectrum, integration time in microseconds (us)
+	realtime_pl, pl_spec = read_spectrum(PL_time)
 	# determine fwhm
 	peak, fwhm = FWHM(pl_spec,start)
 
 	return realtime_pl, pl_spec, peak, fwhm
 
 
-# Determine FWHM
-def FWHM(pl_spec,start = 760):
-	pl_smooth = savgol_filter(pl_spec, 101, 2) # window size 101, polynomial order 2
+# Determine FWHM, wavelengths: the spectrometer's unless given (e.g. for offline analysis)
+def FWHM(pl_spec,start = 760, wavelengths = None):
+	if wavelengths is None:
+		wavelengths = get_wave()
+	pl_smooth = savgol_smooth(pl_spec, 101, 2) # window size 101, polynomial order 2
 	
 	peak_intensity = max(pl_smooth[start:])
 	baseline = pl_smooth[-750:].mean()
@@ -193,13 +270,13 @@ def FWHM(pl_spec,start = 760):
 		peak = len(pl_spec) - start
 	
 	# now determine peak wavelength and fwhm
-	peak_wave = wave[peak]
+	peak_wave = wavelengths[peak]
 	if len(fwhm_index) > 1:
 		print('fwhm_index more than one elements')
-		fwhm_2 = wave[fwhm_index[-1]] - wave[fwhm_index[-2]]
+		fwhm_2 = wavelengths[fwhm_index[-1]] - wavelengths[fwhm_index[-2]]
 	elif len(fwhm_index) == 1:
 		print('fwhm_index only one element')
-		fwhm_2 = 2 * (wave[fwhm_index[0]] - wave[peak])
+		fwhm_2 = 2 * (wavelengths[fwhm_index[0]] - wavelengths[peak])
 	elif len(fwhm_index) == 0:
 		print('fwhm_index is empty now, wavy baseline')
 		return float('nan'), float('nan')
@@ -207,16 +284,113 @@ def FWHM(pl_spec,start = 760):
 	return peak_wave, fwhm_2
 
 
+# Status codes of FWHM_batch, one per message printed by FWHM
+class FWHMStatus(IntEnum):
+	OK = 0					# 'fwhm_index more than one elements'
+	ONE_CROSSING = 1		# 'fwhm_index only one element', fwhm is twice the half width
+	WAVY_BASELINE = 2		# 'wavy baseline', nan
+	SUBTLE_PEAK = 3			# 'subtle peak', nan
+	LOCAL_MIN_MAX = 4		# 'fwhm cuts local min or max', peak re-defined
+	THREE_CROSSINGS = 5		# 'fwhm has three elements', peak re-defined
+	NO_CROSSING = 6			# 'fwhm_index is empty now, wavy baseline', nan
+
+
+# Determine peak wavelength and FWHM of many spectra at once (n_spec x pixel)
+# Same decisions as FWHM but as array operations along axis 1, returns arrays of
+# peak wavelength, fwhm and FWHMStatus codes. interpolate = True places the
+# half-max crossings between pixels instead of on the left pixel.
+def FWHM_batch(spectra, start = 760, wavelengths = None, interpolate = False, block = 4096):
+	if wavelengths is None:
+		wavelengths = get_wave()
+	wavelengths = np.asarray(wavelengths, dtype = float)
+	spectra = np.atleast_2d(np.asarray(spectra, dtype = float))
+
+	peak_wave = np.empty(len(spectra))
+	fwhm = np.empty(len(spectra))
+	status = np.empty(len(spectra), dtype = np.int8)
+	# work through large archives in blocks to bound the temporary arrays
+	for i in range(0, len(spectra), block):
+		peak_wave[i:i+block], fwhm[i:i+block], status[i:i+block] = _fwhm_block(
+			spectra[i:i+block], start, wavelengths, interpolate)
+	return peak_wave, fwhm, status
+
+
+def _fwhm_block(spectra, start, wavelengths, interpolate):
+	n_spec, n_pixel = spectra.shape
+	rows = np.arange(n_spec)
+	cols = np.arange(n_pixel)
+
+	pl_smooth = savgol_smooth(spectra, 101, 2) # window size 101, polynomial order 2
+	roi = pl_smooth[:, start:]
+	peak_intensity = roi.max(axis = 1)
+	baseline = pl_smooth[:, -750:].mean(axis = 1)
+	peak = start + roi.argmax(axis = 1)
+
+	half_max = (peak_intensity-baseline)/2
+	spec_cut_half = roi - (half_max + baseline)[:, None]
+	crossing = np.diff(np.sign(spec_cut_half), axis = 1) != 0
+	n_cross = crossing.sum(axis = 1)
+
+	# first, second-to-last and last crossing of each row, as absolute pixel indices
+	n_diff = crossing.shape[1]
+	first = start + crossing.argmax(axis = 1)
+	last_rel = n_diff - 1 - crossing[:, ::-1].argmax(axis = 1)
+	crossing[rows, last_rel] = False
+	second_rel = n_diff - 1 - crossing[:, ::-1].argmax(axis = 1)
+	last = start + last_rel
+	second = start + second_rel
+
+	# maximum from 405nm excitation, re-define peak (mirrors FWHM, index handling included)
+	excitation = peak < start + 50
+	two = excitation & (n_cross == 2)
+	three = excitation & (n_cross == 3)
+
+	window = (cols >= first[:, None]) & (cols < last[:, None])
+	windowed = np.where(window, pl_smooth, -np.inf)
+	two_peak = np.where(windowed.max(axis = 1) > pl_smooth[rows, first],
+						windowed.argmax(axis = 1) - first, last)
+
+	window = (cols >= second[:, None]) & (cols < last[:, None])
+	three_peak = start + np.where(window, pl_smooth, -np.inf).argmax(axis = 1)
+
+	peak = np.where(two, two_peak, peak)
+	peak = np.where(three, three_peak, peak)
+	peak = np.minimum(peak, n_pixel - start)
+
+	# wavelength of a crossing, optionally interpolated between the two pixels around it
+	def crossing_wave(index):
+		if not interpolate:
+			return wavelengths[index]
+		left = spec_cut_half[rows, index - start]
+		right = spec_cut_half[rows, index - start + 1]
+		with np.errstate(divide = 'ignore', invalid = 'ignore'):
+			frac = np.nan_to_num(left/(left - right))
+		return wavelengths[index] + frac*(wavelengths[index + 1] - wavelengths[index])
+
+	peak_wave = wavelengths[peak]
+	fwhm = np.where(n_cross > 1, crossing_wave(last) - crossing_wave(second),
+					2 * (crossing_wave(first) - peak_wave))
+
+	status = np.full(n_spec, FWHMStatus.OK, dtype = np.int8)
+	status[n_cross == 1] = FWHMStatus.ONE_CROSSING
+	status[n_cross == 0] = FWHMStatus.NO_CROSSING
+	status[two] = FWHMStatus.LOCAL_MIN_MAX
+	status[three] = FWHMStatus.THREE_CROSSINGS
+	status[excitation & (n_cross == 1)] = FWHMStatus.SUBTLE_PEAK
+	status[n_cross > 3] = FWHMStatus.WAVY_BASELINE
+
+	failed = np.isin(status, [FWHMStatus.WAVY_BASELINE, FWHMStatus.SUBTLE_PEAK, FWHMStatus.NO_CROSSING])
+	peak_wave[failed] = np.nan
+	fwhm[failed] = np.nan
+	return peak_wave, fwhm, status
+
+
 # Read UV-vis absorption spectrum with Flame-S-UV-vis
 # Corrected with control sample of pure toluene, return the time and spectrum
 def read_abs(chan, left_standard = 975, right_standard = 1010):
 	# define wavelength range of interest (ROI) by index numbers
 
-	flames.integration_time_micros(Cs1_int_time
-		)
-	
-	realtime_abs = time.time() 
-	uv_vis_spec = flames.intensities() # read spectrum
+	realtime_abs, uv_vis_spec = read_spectrum(Cs1_int_time) # read spectrum
 
 	# If there is a blank sample (standard sample) of 16 channels available
 	# uv_vis_spec = process_abs(chan, uv_vis_spec)
@@ -227,8 +401,8 @@ def read_abs(chan, left_standard = 975, right_standard = 1010):
 
 def process_abs(chan, sample_spec, left_standard = 975,stop = 1010):
 	tol = raw_tol['Chan'+str(chan+1)]
-	tol_smooth = savgol_filter(tol, 301, 2)
-	sample_smooth = savgol_filter(sample_spec, 301, 2)
+	tol_smooth = savgol_smooth(tol, 301, 2)
+	sample_smooth = savgol_smooth(sample_spec, 301, 2)
 	# match ranges
 	tol_match, sample_match = match_range(tol_smooth,sample_smooth,left_standard, right_standard)
 	
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+"""
+******************************************************************************
+hardware		: FlameS spectrometer, Ocean Optics
+language		: python
+requirement		: python-seabreeze, numpy
+author			: Ricki Chairil, Chemical Engineering, University of Southern California
+function		: continuous acquisition on a dedicated thread.
+				  the thread keeps reading spectra into a preallocated ring
+				  buffer of (timestamp, integration time, spectrum), so analysis
+				  and file writes in the caller never hold up the USB read loop.
+				  only the streaming thread talks to the spectrometer while it runs.
+******************************************************************************
+"""
+import threading
+import numpy as np
+from hardwares.simulated import clock	# time()/sleep(), on the simulated clock under MRF_SIMULATE=1
+
+
+class SpectrometerStreamer:
+	# spectrometer: a seabreeze.spectrometers.Spectrometer
+	# n_slots: frames kept in the ring buffer
+	def __init__(self, spectrometer, integration_time, n_slots = 32):
+		self.spectrometer = spectrometer
+		self.n_slots = n_slots
+		n_pixel = len(spectrometer.wavelengths())
+		self.spectra = np.zeros((n_slots, n_pixel))
+		self.timestamps = np.zeros(n_slots)		# clock.time() when the exposure was started
+		self.int_times = np.zeros(n_slots, dtype = np.int64)
+		self.count = 0								# frames written so far, slot = count % n_slots
+
+		self.integration_time = None				# set on the device by the thread before the first read
+		self._pending_time = integration_time		# applied by the thread between two reads
+		self._cond = threading.Condition()
+		self._stop = threading.Event()
+		self._thread = None
+		self.error = None							# exception that ended the read loop
+		self.stopped = False						# stop() was called, no more frames will come
+		self.itime_changes = 0						# integration time commands sent to the device
+
+	def start(self):
+		self._stop.clear()
+		self.stopped = False
+		self._thread = threading.Thread(name = 'FlameS-stream', target = self._run, daemon = True)
+		self._thread.start()
+
+	def stop(self):
+		self._stop.set()
+		with self._cond: # wake up the waiting consumers, nothing will notify them any more
+			self.stopped = True
+			self._cond.notify_all()
+		if self._thread is not None:
+			self._thread.join()
+			self._thread = None
+
+	def __enter__(self):
+		self.start()
+		return self
+
+	def __exit__(self, *exc):
+		self.stop()
+
+	def set_integration_time(self, int_time):
+		# takes effect from the next exposure, frames keep their own integration time
+		with self._cond:
+			self._pending_time = int_time
+
+	def _run(self):
+		while not self._stop.is_set():
+			with self._cond:
+				int_time = self._pending_time
+			try:
+				if int_time != self.integration_time:
+					self.spectrometer.integration_time_micros(int_time)
+					self.integration_time = int_time
+					self.itime_changes += 1
+
+				t = clock.time()
+				spec = self.spectrometer.intensities()
+			except Exception as e:
+				# wake up the waiting consumers instead of leaving them blocked
+				with self._cond:
+					self.error = e
+					self._cond.notify_all()
+				return
+
+			with self._cond:
+				slot = self.count % self.n_slots
+				self.spectra[slot, :] = spec
+				self.timestamps[slot] = t
+				self.int_times[slot] = int_time
+				self.count += 1
+				self._cond.notify_all()
+
+	def _newest(self, since, int_time):
+		# newest frame started after 'since' with the requested integration time, or None
+		for k in range(self.count - 1, max(self.count - self.n_slots, 0) - 1, -1):
+			slot = k % self.n_slots
+			if since is not None and self.timestamps[slot] <= since:
+				return None
+			if int_time is None or self.int_times[slot] == int_time:
+				return self.timestamps[slot], int(self.int_times[slot]), self.spectra[slot].copy()
+		return None
+
+	def latest(self):
+		# most recent frame, never blocks; None before the first frame
+		with self._cond:
+			return self._newest(None, None)
+
+	def wait_for_new(self, since = None, integration_time = None, timeout = None):
+		# block until a frame that started after 'since' (and at 'integration_time') is available
+		# returns (timestamp, integration time, spectrum), or None on timeout;
+		# raises RuntimeError once the streamer has stopped or failed
+		if since is None:
+			since = clock.time()
+		with self._cond:
+			frame = self._newest(since, integration_time)
+			deadline = None if timeout is None else clock.time() + timeout
+			while frame is None:
+				if self.error is not None:
+					raise RuntimeError('spectrometer streaming stopped') from self.error
+				if self.stopped:
+					raise RuntimeError('spectrometer streaming was stopped')
+				remaining = None if deadline is None else deadline - clock.time()
+				if remaining is not None and remaining <= 0:
+					return None
+				self._cond.wait(remaining)
+				frame = self._newest(since, integration_time)
+			return frame
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+"""
+******************************************************************************
+hardware		: Arduino Mega (Mega_1, IR board) with two analogue multiplexers
+language		: python
+requirement		: pyfirmata, numpy, the IR board flashed with firmware/ir_burst/ir_burst.ino
+author			: Ricki Chairil, Chemical Engineering, University of Southern California
+function		: buffered IR sampling. instead of polling the last value pyfirmata
+				  received, the board is asked for a burst of N samples of one
+				  multiplexer channel at a fixed period; it samples into its own
+				  RAM and sends the block back, decoded here into numpy arrays
+				  with a true, measured sample rate.
+				  an iterator thread (pyfirmata.util.Iterator) must be running
+				  so that the replies are processed.
+******************************************************************************
+"""
+import threading
+import numpy as np
+
+IR_BURST = 0x01		# SysEx command, must match the firmware
+ADC_MAX = 1023		# 10-bit ADC
+V_REF = 5			# V
+
+
+class BurstReader:
+	def __init__(self, board):
+		self.board = board
+		self._cond = threading.Condition()
+		self._bursts = {}	# (mux, chan): dict of header values and sample array
+		board.add_cmd_handler(IR_BURST, self._handler)
+
+	def _handler(self, *data):
+		# every payload byte arrives as two 7-bit bytes, LSB first
+		raw = bytes(data[i] | (data[i + 1] << 7) for i in range(0, len(data) - 1, 2))
+		kind, mux, chan = raw[0], raw[1], raw[2]
+		with self._cond:
+			if kind == 0:
+				n = int.from_bytes(raw[3:5], 'little')
+				self._bursts[(mux, chan)] = {
+					'n': n,
+					'period': int.from_bytes(raw[5:7], 'little'),
+					't_start': int.from_bytes(raw[7:11], 'little'),
+					't_end': int.from_bytes(raw[11:15], 'little'),
+					'values': np.zeros(n, dtype = np.uint16),
+					'received': 0}
+			elif kind == 1 and (mux, chan) in self._bursts:
+				burst = self._bursts[(mux, chan)]
+				offset = int.from_bytes(raw[3:5], 'little')
+				count = raw[5]
+				burst['values'][offset:offset + count] = np.frombuffer(raw[6:6 + 2*count], dtype = '<u2')
+				burst['received'] += count
+			self._cond.notify_all()
+
+	def request(self, mux, chan, n = 2000, period_us = 1000):
+		# mux: 0 for channels 1-16, 1 for channels 17-32; chan: 0-15 on that multiplexer
+		with self._cond:
+			self._bursts.pop((mux, chan), None)
+		self.board.send_sysex(IR_BURST, [mux, chan, n & 0x7F, n >> 7, period_us & 0x7F, period_us >> 7])
+
+	def wait(self, mux, chan, timeout = 10):
+		# returns (time in s from the first sample, voltage) of a requested burst
+		with self._cond:
+			done = self._cond.wait_for(lambda: (mux, chan) in self._bursts and
+							self._bursts[(mux, chan)]['received'] >= self._bursts[(mux, chan)]['n'], timeout)
+			if not done:
+				raise TimeoutError('no IR burst from multiplexer '+str(mux)+' channel '+str(chan))
+			burst = self._bursts.pop((mux, chan))
+		# the board timed the whole burst, so the real sample period is known
+		elapsed = ((burst['t_end'] - burst['t_start']) % 2**32) / 1e6
+		t = np.arange(burst['n']) * elapsed / burst['n']
+		return t, burst['values'] * (V_REF / ADC_MAX)
+
+	def read(self, mux, chan, n = 2000, period_us = 1000, timeout = 10):
+		self.request(mux, chan, n, period_us)
+		return self.wait(mux, chan, timeout)
+
+	def read_all(self, n = 2000, period_us = 1000, timeout = 10):
+		# all 32 channels, returns (32 x n) arrays of time and voltage, channel order as in ir_mux
+		times = np.zeros((32, n))
+		volts = np.zeros((32, n))
+		for k in range(32):
+			times[k], volts[k] = self.read(k // 16, k % 16, n, period_us, timeout)
+		return times, volts
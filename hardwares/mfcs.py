@@ -9,14 +9,21 @@ function		: communicate with the pressure regulator, include:
 				  obtain regulator status
 				  read pressures
 				  set pressures
+				  MFCSController: thread-safe batched set/read and a background
+				  poller, so the control loop never waits on the dll
 note: this file is not required if manual control of the MFCS_EZ is used.      
+	  the dll is loaded by connect() or on first use, not at import.
 ******************************************************************************
 """
 from __future__ import print_function	# Used for "print" function compatibility between Python 2.x and 3.x versions
 import platform							# Library used for x64 or x86 detection
 import time								# Time library, use of sleep function
 import ctypes							# Used for variable definition types
+import threading						# Lock and poller thread of MFCSController
+import numpy as np						# Ring buffer of MFCSController
 from ctypes import *					# Used to load dynamic linked libraries
+from hardwares import simulated			# stand-in for the dll, MRF_SIMULATE=1
+from hardwares.simulated import clock	# time()/sleep(), on the simulated clock under MRF_SIMULATE=1
 
 
 # This function uses "raw_input" for Python 2.x versions and "input" for Python 3.x versions
@@ -37,16 +44,32 @@ mfcs_status = c_char()
 pressure = c_float()
 chrono = c_ushort(0)
  
-# Load dll into memory
-# lib_mfcs = ctypes.WinDLL('mfcs_32.dll')
-lib_mfcs = ctypes.WinDLL('mfcs_64.dll')
-# Initialize the first MFCS-EZ in Windows enumeration list 
-mfcsHandle = lib_mfcs.mfcsez_initialisation(0)
-# After initialization a short delay (at least 500ms) are required to make sure that 
-#	the USB communication is properly established
-time.sleep(1)
+lib_mfcs = None
+
+_connect_lock = threading.Lock()
+
+def connect():
+	global lib_mfcs, mfcsHandle
+	if lib_mfcs is not None:
+		return lib_mfcs
+	with _connect_lock:	# the first use may come from several threads at once
+		if lib_mfcs is None:
+			# Load dll into memory
+			# lib = ctypes.WinDLL('mfcs_32.dll')
+			if simulated.enabled():
+				lib = simulated.FakeMFCSLib()
+			else:
+				lib = ctypes.WinDLL('mfcs_64.dll')
+			# Initialize the first MFCS-EZ in Windows enumeration list 
+			mfcsHandle = lib.mfcsez_initialisation(0)
+			# After initialization a short delay (at least 500ms) are required to make sure that 
+			#	the USB communication is properly established
+			clock.sleep(1)
+			lib_mfcs = lib	# set last, the other threads only see a ready session
+	return lib_mfcs
 
 def init_mfcs():
+	connect()
 	
 	# Print status on MFCS initialization
 	if (mfcsHandle != 0):
@@ -81,25 +104,168 @@ def init_mfcs():
 	# myinput("Please confirm that the chamber is closed (press 'ENTER')")
 
 
-def read_pressure():	# channel number 1-4
-	pressure_reading = []
-	for channel in range(1,5):
-		channel_char = c_char(channel)
-		C_error = lib_mfcs.mfcs_read_chan(mfcsHandle,channel_char,
-			byref(pressure),byref(chrono))
-		print('Channel %i: %f mbar' %(channel, pressure.value))
-		pressure_reading.append(pressure.value)
-	return pressure_reading
+# single calls through the session's MFCSController, i.e. under its lock and with its buffers
+def read_pressure():	# pressures of channels 1-4 (mbar)
+	pressures = controller().read_all()
+	return [pressures[channel] for channel in range(1,5)]
 
 def set_pressure(channel,p_set):
-	channel_char = c_char(channel)
-	pressure_set = c_float(p_set)
-	C_error = lib_mfcs.mfcs_set_auto(mfcsHandle,channel_char,pressure_set)
-	# time.sleep(20)
-	print('Setting channel %i: %f mbar' %(channel, p_set))
+	controller().set_pressures({channel: p_set})
+
+
+
+class MFCSController:
+	# One MFCS-EZ session shared by threads. Every instance has its own ctypes buffers, and
+	# one lock serialises the dll calls. With the poller running, set_pressures() only
+	# queues the set points and latest() returns the newest sample from the ring buffer,
+	# so neither blocks on the dll; the poller thread makes all the calls.
+	def __init__(self, channels = (1, 2, 3, 4), n_slots = 600):
+		connect()
+		self.lib = lib_mfcs
+		self.handle = mfcsHandle
+		self.channels = list(channels)
+		# per-instance ctypes buffers, created once
+		self._chan_char = {chan: c_char(chan) for chan in self.channels}
+		self._pressure = c_float()
+		self._chrono = c_ushort(0)
+		self._set_value = c_float()
+		self._lock = threading.Lock()			# one dll call sequence at a time
+
+		# ring buffer of polled samples, row = one read of all channels
+		self.n_slots = n_slots
+		self.times = np.full(n_slots, np.nan)	# clock.time() of every sample
+		self.values = np.full((n_slots, len(self.channels)), np.nan)
+		self.count = 0
+		self._cond = threading.Condition()
+		self._pending = {}						# set points waiting for the poller
+		self.set_points = {}					# last set point sent per channel
+		self._stop = threading.Event()
+		self._thread = None
+		self.error = None						# exception that ended the poller
+
+	def _read(self):
+		values = []
+		with self._lock:
+			for chan in self.channels:
+				self.lib.mfcs_read_chan(self.handle, self._chan_char[chan], byref(self._pressure), byref(self._chrono))
+				values.append(self._pressure.value)
+		return values
+
+	def _set(self, pressures):
+		with self._lock:
+			for chan, p_set in pressures.items():
+				self._set_value.value = p_set
+				self.lib.mfcs_set_auto(self.handle, self._chan_char[chan], self._set_value)
+				self.set_points[chan] = p_set
+
+	def read_all(self):
+		# {channel: pressure in mbar}, read now
+		return dict(zip(self.channels, self._read()))
+
+	def set_pressures(self, pressures):
+		# pressures: {channel: mbar}, e.g. {1: p1, 3: p3, 4: p4}
+		if self.polling():
+			with self._cond:
+				self._pending.update(pressures)
+			return
+		self._set(pressures)
+
+	def polling(self):
+		return self._thread is not None and self._thread.is_alive()
+
+	def start_polling(self, rate = 10):
+		# read every channel rate times per second into the ring buffer
+		if self.polling():
+			return
+		self._stop.clear()
+		self._thread = threading.Thread(name = 'MFCS-poll', target = self._poll, args = (1 / rate,), daemon = True)
+		self._thread.start()
+
+	def stop_polling(self):
+		self._stop.set()
+		if self._thread is not None:
+			self._thread.join()
+			self._thread = None
+		with self._cond:
+			pending, self._pending = self._pending, {}
+		if pending:
+			self._set(pending)
+
+	def _poll(self, period):
+		next_time = clock.time()
+		while not self._stop.is_set():
+			try:
+				with self._cond:
+					pending, self._pending = self._pending, {}
+				if pending:
+					self._set(pending)
+				t = clock.time()
+				values = self._read()
+			except Exception as e:
+				with self._cond:
+					self.error = e
+					self._cond.notify_all()
+				return
+			with self._cond:
+				slot = self.count % self.n_slots
+				self.times[slot] = t
+				self.values[slot, :] = values
+				self.count += 1
+				self._cond.notify_all()
+			next_time += period
+			self._stop.wait(max(next_time - clock.time(), 0))
+
+	def latest(self):
+		# (time, {channel: pressure}) of the newest sample, None before the first; never calls the dll
+		with self._cond:
+			if self.count == 0:
+				return None
+			slot = (self.count - 1) % self.n_slots
+			return float(self.times[slot]), dict(zip(self.channels, self.values[slot].tolist()))
+
+	def history(self, since = None):
+		# samples in the ring buffer, oldest first: times (n,) and values (n x channels)
+		with self._cond:
+			n = min(self.count, self.n_slots)
+			order = (np.arange(self.count - n, self.count)) % self.n_slots
+			times, values = self.times[order], self.values[order]
+		if since is not None:
+			keep = times > since
+			times, values = times[keep], values[keep]
+		return times, values
+
+	def wait_for_sample(self, since = None, timeout = None):
+		# block until the poller has a sample taken after 'since', returns latest() or None on timeout
+		since = clock.time() if since is None else since
+		with self._cond:
+			done = self._cond.wait_for(lambda: self.error is not None or
+						(self.count > 0 and self.times[(self.count - 1) % self.n_slots] > since), timeout)
+			if self.error is not None:
+				raise RuntimeError('MFCS polling stopped') from self.error
+		return self.latest() if done else None
+
+
+_controller = None
+_controller_lock = threading.Lock()
+
+def controller():
+	# the MFCSController of this session, created on first use
+	global _controller
+	if _controller is None:
+		with _controller_lock:	# one controller even if several threads ask first
+			if _controller is None:
+				_controller = MFCSController()
+	return _controller
 
 	
-def exit_mfcs(lib_mfcs = lib_mfcs):
+def exit_mfcs():
+	global lib_mfcs, _controller
+	if lib_mfcs is None: # never connected
+		return
+	with _controller_lock:
+		if _controller is not None:
+			_controller.stop_polling()
+			_controller = None
 
 	print('Setting zero pressure in channels')
 	for channel in range(1,5):
@@ -114,8 +280,9 @@ def exit_mfcs(lib_mfcs = lib_mfcs):
 		print ('Failed to close USB connection')
 	
 	# Release the DLL
-	ctypes.windll.kernel32.FreeLibrary(lib_mfcs._handle)
-	del lib_mfcs
+	if not getattr(lib_mfcs, 'simulated', False):
+		ctypes.windll.kernel32.FreeLibrary(lib_mfcs._handle)
+	lib_mfcs = None
 	print ('MFCS library unloaded')
 		
 	# # Exit application 
@@ -11,6 +11,8 @@ function		: used in main script for reading IR signals.
 ******************************************************************************
 """
 import time
+from array import array
+from hardwares.simulated import clock	# time()/sleep(), on the simulated clock under MRF_SIMULATE=1
 
 
 muxChannels = {}			# Pre-define a list of S0-S3 status.
@@ -35,36 +37,186 @@ def DefinePin(board, switch_pin_nums, sig_pin_num):
 		PinS.append(board.get_pin('d:'+ str(pin) + ':o'))
 	PinSig = board.get_pin('a:'+ str(sig_pin_num) +':i')
 	PinSig.enable_reporting()
-	time.sleep(0.5)
+	clock.sleep(0.5)
 	return PinS, PinSig
 
 
+# Set output pins with one Firmata DIGITAL_MESSAGE per 8-pin port instead of one per pin.
+# pyfirmata's Port.write() sends the state of the whole port, so the pin values are set
+# first and each changed port is written once. Pins 40-43 share port 5 (one frame),
+# pins 30-33 span ports 3 and 4 (at most two frames). Returns the number of frames sent.
+def WritePins(pins, values):
+	ports = []
+	for pin, value in zip(pins, values):
+		if pin.value != value:
+			pin.value = value
+			if pin.port not in ports:
+				ports.append(pin.port)
+	for port in ports:
+		port.write()
+	return len(ports)
+
+
 def ReadMUX(PinS, PinSig, n):
-	S = Chan(n)
-	for i in range(4):
-		PinS[i].write(S[i])
-		# time.sleep(1)
-	time.sleep(1/100)
+	WritePins(PinS, Chan(n))
+	clock.sleep(1/100)
 	# time.sleep(1/45)
 	sig = format(PinSig.read()*5, '.4f') #conver to voltage (0-5V) and format digits
 	return sig
 
 def SwitchMUX(PinS, n):
-	S = Chan(n)
-	for i in range(4):
-		PinS[i].write(S[i])
-		# time.sleep(1)
-	time.sleep(1/100)
+	WritePins(PinS, Chan(n))
+	clock.sleep(1/100)
 	
 
 def Read(PinSig):
 	return format(PinSig.read()*5, '.4f')
 
 
+# Numeric read, voltage as a float without the string round trip ('nan' before the first report)
+def read_volts(PinSig):
+	value = PinSig.read()
+	if value is None:
+		return float('nan')
+	return value*5
+
+
+SPIN_NS = 200000	# ns before a paced read that are spun instead of slept, covers the sleep overshoot
+
+
+# Read n voltages into out (array('d') or numpy array, allocated if None) and the
+# perf_counter_ns() stamp of every read (simulated clock under MRF_SIMULATE=1) into times (array('q') if None).
+# period_ns paces the reads (e.g. 1000000 for 1 ms); the wait sleeps and only spins for
+# the last SPIN_NS, so an IR scan does not keep a core busy.
+def read_n(PinSig, n, out = None, times = None, period_ns = None):
+	if out is None:
+		out = array('d', bytes(8*n))
+	if times is None:
+		times = array('q', bytes(8*n))
+	read = PinSig.read				# local names, this loop runs 64000 times per IR pass
+	source = clock.source()		# time, or the simulated clock
+	now_ns = source.perf_counter_ns
+	sleep = source.sleep
+	nan = float('nan')
+	next_ns = now_ns()
+	for m in range(n):
+		if period_ns is not None:
+			remaining = next_ns - now_ns()
+			if remaining > SPIN_NS: # sleep through most of the interval, spin only for the end
+				sleep((remaining - SPIN_NS) / 1e9)
+			while now_ns() < next_ns:
+				sleep(0)
+			next_ns += period_ns
+		times[m] = now_ns()
+		value = read()
+		out[m] = nan if value is None else value*5
+	return out, times
+
+
+# Same as read_n for the two multiplexers at once: both signal pins are read back to back
+# in every iteration, so channel n and n+16 come from the same Firmata reporting cycle
+def read_pair_n(PinSig, PinSig2, n, out = None, out2 = None, times = None, period_ns = None):
+	if out is None:
+		out = array('d', bytes(8*n))
+	if out2 is None:
+		out2 = array('d', bytes(8*n))
+	if times is None:
+		times = array('q', bytes(8*n))
+	read = PinSig.read
+	read2 = PinSig2.read
+	source = clock.source()		# time, or the simulated clock
+	now_ns = source.perf_counter_ns
+	sleep = source.sleep
+	nan = float('nan')
+	next_ns = now_ns()
+	for m in range(n):
+		if period_ns is not None:
+			remaining = next_ns - now_ns()
+			if remaining > SPIN_NS: # sleep through most of the interval, spin only for the end
+				sleep((remaining - SPIN_NS) / 1e9)
+			while now_ns() < next_ns:
+				sleep(0)
+			next_ns += period_ns
+		times[m] = now_ns()
+		value = read()
+		value2 = read2()
+		out[m] = nan if value is None else value*5
+		out2[m] = nan if value2 is None else value2*5
+	return out, out2, times
+
+
 
 
 
 if __name__ == "__main__":
 	
 	[S0, S1, S2, S3] = Chan(2)
-	print(S0, '&', S1, '&', S2, '&', S3)
\ No newline at end of file
+	print(S0, '&', S1, '&', S2, '&', S3)
+
+	# micro-benchmark of the string and numeric read paths against a fake pin
+	class FakePin:
+		value = 0.5
+		def read(self):
+			return self.value
+
+	pin = FakePin()
+	n = 64000	# samples in one IR pass
+	t0 = time.perf_counter()
+	v = []
+	t = []
+	for m in range(n):
+		t.append(time.time())
+		v.append(float(Read(pin)))
+	t_string = time.perf_counter() - t0
+
+	t0 = time.perf_counter()
+	read_n(pin, n)
+	t_array = time.perf_counter() - t0
+
+	try:
+		import numpy as np
+		out = np.empty(n)
+		t0 = time.perf_counter()
+		read_n(pin, n, out)
+		t_numpy = time.perf_counter() - t0
+	except ImportError:
+		t_numpy = float('nan')
+
+	print('%i reads: string path %.1f ms (%.2f us/read), read_n array %.1f ms (%.2f us/read), read_n numpy %.1f ms'
+		%(n, t_string*1e3, t_string/n*1e6, t_array*1e3, t_array/n*1e6, t_numpy*1e3))
+
+	# select-line switching: per-pin writes vs port-level writes, with pyfirmata's Pin/Port
+	# behaviour and the serial time of a 3-byte frame at 57600 baud
+	frame_time = 3*10/57600
+	class FakePort:
+		def __init__(self, number):
+			self.number = number
+			self.frames = 0
+		def write(self):
+			self.frames += 1
+			time.sleep(frame_time)
+	class FakeOutPin:
+		def __init__(self, number, ports):
+			self.value = 0
+			self.port = ports.setdefault(number // 8, FakePort(number // 8))
+		def write(self, value):		# pyfirmata: a changed pin sends its whole port
+			if value != self.value:
+				self.value = value
+				self.port.write()
+
+	for pin_nums in [[30,31,32,33], [40,41,42,43]]:
+		result = []
+		for method in ['per pin', 'per port']:
+			ports = {}
+			pins = [FakeOutPin(p, ports) for p in pin_nums]
+			t0 = time.perf_counter()
+			for _ in range(10):
+				for chan in list(range(16)) + [0]:
+					if method == 'per pin':
+						for i in range(4):
+							pins[i].write(Chan(chan)[i])
+					else:
+						WritePins(pins, Chan(chan))
+			frames = sum(port.frames for port in ports.values()) / 170
+			result.append('%s %.2f frames, %.2f ms' %(method, frames, (time.perf_counter() - t0)/170*1e3))
+		print('select pins '+str(pin_nums)+' per channel switch: '+', '.join(result))
\ No newline at end of file
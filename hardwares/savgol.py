@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+"""
+******************************************************************************
+hardware		: --
+language		: python
+requirement		: numpy, scipy
+author			: Ricki Chairil, Chemical Engineering, University of Southern California
+function		: Savitzky-Golay smoothing with precomputed kernels.
+				  scipy.signal.savgol_filter solves the least-squares problem for
+				  the coefficients and polyfits both edges on every call; here the
+				  interior kernel and the edge projections are computed once per
+				  (window, polyorder, deriv, pixel count) and reused, for one
+				  spectrum or a whole stack (spectra along the last axis).
+				  output is the same as savgol_filter(x, window, polyorder, deriv)
+				  with the default mode = 'interp'.
+******************************************************************************
+"""
+import math
+import time
+import numpy as np
+# scipy takes most of a second to import, so it is only imported when a kernel
+# is first built or a spectrum smoothed, not by importing this module
+
+
+class SavgolKernel:
+	def __init__(self, window_length, polyorder, deriv, n_pixel):
+		self.window_length = window_length
+		self.half = window_length // 2
+		self.n_pixel = n_pixel
+		from scipy.signal import savgol_coeffs
+		from scipy import fft
+		# interior: plain convolution with the Savitzky-Golay coefficients
+		self.coeffs = savgol_coeffs(window_length, polyorder, deriv, use = 'conv')
+
+		# edges: polynomial fitted to the first/last window and evaluated (deriv-th derivative)
+		# at the edge pixels, written as a fixed linear map of the window samples
+		t = np.arange(window_length, dtype = float)
+		vander = t[:, None] ** np.arange(polyorder + 1)
+		deriv_vander = np.zeros_like(vander)
+		for k in range(deriv, polyorder + 1):
+			deriv_vander[:, k] = math.factorial(k) / math.factorial(k - deriv) * t ** (k - deriv)
+		projection = deriv_vander @ np.linalg.pinv(vander)
+		self.left = projection[:self.half]
+		self.right = projection[window_length - self.half:]
+
+		# spectrum of the kernel for the FFT path, zero padded for linear convolution
+		self.n_fft = fft.next_fast_len(n_pixel + window_length - 1, real = True)
+		self.coeffs_fft = fft.rfft(self.coeffs, self.n_fft)
+
+
+# module level cache, key: (window_length, polyorder, deriv, n_pixel)
+_kernels = {}
+
+def savgol_kernel(window_length, polyorder, deriv = 0, n_pixel = 2048):
+	key = (window_length, polyorder, deriv, n_pixel)
+	if key not in _kernels:
+		_kernels[key] = SavgolKernel(window_length, polyorder, deriv, n_pixel)
+	return _kernels[key]
+
+
+# Smooth one spectrum or a stack of spectra (pixels along the last axis)
+# method: 'fft' (cached kernel spectrum, fastest for the 101/301 windows used here) or 'direct' convolution
+def savgol_smooth(spectra, window_length, polyorder, deriv = 0, method = 'fft'):
+	x = np.asarray(spectra, dtype = float)
+	n_pixel = x.shape[-1]
+	kern = savgol_kernel(window_length, polyorder, deriv, n_pixel)
+	half = kern.half
+
+	if method == 'fft':
+		from scipy import fft
+		y = fft.irfft(fft.rfft(x, kern.n_fft, axis = -1) * kern.coeffs_fft, kern.n_fft, axis = -1)
+		y = y[..., half:half + n_pixel]
+	else:
+		from scipy.ndimage import convolve1d
+		y = convolve1d(x, kern.coeffs, axis = -1, mode = 'constant')
+
+	y[..., :half] = x[..., :window_length] @ kern.left.T
+	y[..., n_pixel - half:] = x[..., n_pixel - window_length:] @ kern.right.T
+	return y
+
+
+# Benchmark against scipy on 2048-pixel FLAME-S sized data
+if __name__ == "__main__":
+	from scipy.signal import savgol_filter
+
+	rng = np.random.default_rng(0)
+	pixels = np.arange(2048)
+	stack = 1000 + 800*np.exp(-0.5*((pixels - 1100)/40)**2) + rng.normal(0, 20, (16, 2048))
+	repeats = 200
+
+	for window in [101, 301]:
+		t0 = time.perf_counter()
+		for _ in range(repeats):
+			ref = savgol_filter(stack[0], window, 2)
+		t_scipy = (time.perf_counter() - t0) / repeats
+
+		savgol_smooth(stack[0], window, 2)	# fill the cache
+		for method in ['direct', 'fft']:
+			t0 = time.perf_counter()
+			for _ in range(repeats):
+				out = savgol_smooth(stack[0], window, 2, method = method)
+			t_single = (time.perf_counter() - t0) / repeats
+
+			t0 = time.perf_counter()
+			for _ in range(repeats):
+				out_stack = savgol_smooth(stack, window, 2, method = method)
+			t_stack = (time.perf_counter() - t0) / repeats / len(stack)
+
+			err = max(np.abs(out - ref).max(), np.abs(out_stack - savgol_filter(stack, window, 2, axis = 1)).max())
+			print('window %i, %-6s: scipy %.1f us, cached %.1f us (%.1fx), 16-stack %.1f us/spectrum (%.1fx), max diff %.1e'
+				%(window, method, t_scipy*1e6, t_single*1e6, t_scipy/t_single, t_stack*1e6, t_scipy/t_stack, err))
@@ -0,0 +1,454 @@
+# -*- coding: utf-8 -*-
+"""
+******************************************************************************
+hardware		: simulated FlameS, Arduino boards (Firmata) and MFCS-EZ
+language		: python
+requirement		: numpy
+author			: Ricki Chairil, Chemical Engineering, University of Southern California
+function		: drop-in stand-ins for the reactor hardware, so that mrf_405,
+				  the stage logic and the IR scans run on a laptop.
+				  selected with the environment variable MRF_SIMULATE=1 (or
+				  enable() before the first connect), then flame_s, the board
+				  registry and mfcs open these instead of the devices:
+				  - list_devices()/Spectrometer(): seabreeze-like spectrometer
+				    with synthetic PL and absorbance spectra of the channel the
+				    stage and optical switches point at, under the lamp that is on
+				  - FakeBoard: pyfirmata-like board with pins, the stage stepper
+				    SysEx (AccelStepperFirmata) and the IR burst SysEx, analog
+				    inputs give droplet-like IR waveforms
+				  - FakeMFCSLib: mfcs_64.dll functions, pressures settle with a
+				    first-order lag
+				  all device delays run on a SimClock that is MRF_SIM_SPEEDUP
+				  (default 10) times faster than real time. the reactor modules
+				  sleep and take timestamps through 'clock', which follows the
+				  SimClock while simulating; time.time, time.sleep and
+				  time.perf_counter stay real, so perf_counter measures the real cost.
+******************************************************************************
+"""
+import os
+import math
+import time
+import threading
+import numpy as np
+
+from hardwares import stepper
+from hardwares import ir_burst
+
+
+_enabled = False
+_config = {}
+_reactor = None
+
+
+def enabled():
+	return _enabled or os.environ.get('MRF_SIMULATE', '') not in ('', '0')
+
+
+def enable(**config):
+	# config: speedup and any SimReactor argument, e.g. enable(speedup = 50, noise = 5)
+	global _enabled
+	_enabled = True
+	_config.update(config)
+
+
+def reactor():
+	# the one simulated reactor shared by all the fake devices, created on first use
+	global _reactor
+	if _reactor is None:
+		config = dict(_config)
+		speedup = config.pop('speedup', float(os.environ.get('MRF_SIM_SPEEDUP', 10)))
+		seed = config.pop('seed', int(os.environ.get('MRF_SIM_SEED', 0)))
+		_reactor = SimReactor(SimClock(speedup), seed = seed, **config)
+	return _reactor
+
+
+class Clock:
+	# time() and sleep() for the reactor modules (flame_s, flame_stream, arduino_control, mfcs,
+	# multiplexer, settling, mrf_405): those of the SimClock while simulating, else the real ones
+	def source(self):
+		# the time module or the SimClock, for loops that look up the clock only once
+		return reactor().clock if enabled() else time
+
+	def time(self):
+		return reactor().clock.time() if enabled() else time.time()
+
+	def sleep(self, seconds):
+		if enabled():
+			reactor().clock.sleep(seconds)
+		else:
+			time.sleep(seconds)
+
+
+clock = Clock()
+
+
+def group_driver(channels):
+	# set point function of a channel group with its own pressures, see optimizers.campaign
+	def apply(set_points):
+		for chan in channels:
+			reactor().channel_pressures[chan] = dict(set_points)
+	return apply
+
+
+class SimClock:
+	# simulated time runs speedup times faster than real time
+	def __init__(self, speedup = 10):
+		self.speedup = speedup
+		self._sleep = time.sleep
+		self._perf = time.perf_counter
+		self._t0 = time.time()
+		self._perf0 = time.perf_counter()
+		self._perf0_ns = time.perf_counter_ns()
+
+	def time(self):
+		return self._t0 + (self._perf() - self._perf0) * self.speedup
+
+	def perf_counter_ns(self):
+		return int((time.perf_counter_ns() - self._perf0_ns) * self.speedup)
+
+	def sleep(self, seconds):
+		self._sleep(seconds / self.speedup if seconds > 0 else 0)
+
+
+class SimReactor:
+	# the millifluidic reactor seen by the instruments
+	# pressures (mbar, MFCS channel: value) set the product: the FWHM is smallest at
+	# best_pressures and grows quadratically away from it, the peak red-shifts with
+	# the Cs-Pb/Br ratio and along the 16 channels
+	def __init__(self, clock, seed = 0, peak = 515, fwhm = 22, best_pressures = None, curvature = 12,
+				noise = 20, dark = 1500, pl_counts = 20000, lamp_counts = 30000, failed_channels = ()):
+		self.clock = clock
+		self.rng = np.random.default_rng(seed)
+		self.peak = peak
+		self.fwhm = fwhm
+		self.best_pressures = best_pressures or {1: 350, 3: 250, 4: 380}
+		self.curvature = curvature
+		self.noise = noise
+		self.dark = dark
+		self.pl_counts = pl_counts
+		self.lamp_counts = lamp_counts
+		self.failed_channels = set(failed_channels)	# channels without a PL peak, e.g. a blocked tube
+		self.wavelengths = np.linspace(200, 850, 2048)	# FlameS-UV-vis range
+		self.boards = {}
+		self.mfcs = None
+		self.channel_pressures = {}	# channel: pressures of its own, for channel groups run at other conditions
+		self._lock = threading.Lock()	# the random generator is shared by the device threads
+
+	# ------------------------------ reactor state ------------------------------
+	def pressures(self):
+		if self.mfcs is None:
+			return {1: 300, 2: 0, 3: 200, 4: 300}	# pressures of the main script when the MFCS is not used
+		return self.mfcs.pressures()
+
+	def product(self, chan, pressures = None):
+		# peak wavelength and FWHM (nm) of channel chan
+		p = pressures or self.channel_pressures.get(chan) or self.pressures()
+		best = self.best_pressures
+		distance = sum(((p[k] - best[k]) / 100)**2 for k in best)
+		peak = self.peak + 0.05 * (p[1] - p[4]) + 0.5 * chan
+		fwhm = self.fwhm + self.curvature * distance + 0.2 * chan
+		return peak, fwhm
+
+	def droplets(self, ir_chan, pressures = None):
+		# droplet frequency (Hz) and liquid fraction of IR channel 0-31
+		p = self.pressures() if pressures is None else pressures
+		liquid = p[1] + p[4]
+		freq = 0.5 + liquid / 400 + 0.02 * (ir_chan % 16)
+		duty = liquid / (liquid + p[3] + 1)
+		return freq, duty
+
+	def channel(self):
+		# channel the optics point at: stage block and the open optical switch, None if no switch is open
+		stage = self.boards.get('Mega_2')
+		optics = self.boards.get('Mega_3')
+		if stage is None or optics is None:
+			return None
+		block = round(-stage.stage_position / 4060)	# positive steps are towards the motor
+		for j, pin in enumerate([41, 43, 45, 47]):
+			if optics.pin_value('d', pin):
+				return 4 * block + j
+		return None
+
+	def light(self):
+		optics = self.boards.get('Mega_3')
+		if optics is None:
+			return None
+		if optics.pin_value('d', 53):
+			return 'LED'
+		if optics.pin_value('d', 13):
+			return 'UV-vis'
+		return None
+
+	# --------------------------------- signals ---------------------------------
+	def spectrum(self, chan, light, int_time):
+		# counts for one exposure of int_time (us), before noise
+		w = self.wavelengths
+		scale = int_time / 100000
+		spec = np.full(len(w), float(self.dark))
+		if chan is None or light is None:
+			return spec
+		peak, fwhm = self.product(chan)
+		if light == 'LED':
+			spec += scale * 4 * self.pl_counts * np.exp(-0.5 * ((w - 405) / 3)**2)	# scattered excitation
+			if chan not in self.failed_channels:
+				sigma = fwhm / (2 * math.sqrt(2 * math.log(2)))
+				spec += scale * self.pl_counts * np.exp(-0.5 * ((w - peak) / sigma)**2)
+		elif light == 'UV-vis':
+			lamp = self.lamp_counts * np.exp(-0.5 * ((w - 550) / 180)**2)
+			absorbance = 1.5 / (1 + np.exp((w - peak - 10) / 8))
+			spec += scale * lamp * 10**(-absorbance)
+		return spec
+
+	def noisy(self, spec):
+		with self._lock:
+			noise = self.rng.normal(0, self.noise, len(spec))
+		return np.clip(spec + noise, 0, 65535)
+
+	def ir_voltage(self, ir_chan, t):
+		# analog value (0-1 of 5 V) of IR channel 0-31 at times t (s), low while a droplet passes
+		freq, duty = self.droplets(ir_chan)
+		phase = (np.asarray(t) * freq + 0.13 * ir_chan) % 1
+		value = np.where(phase < duty, 0.3, 0.8)
+		with self._lock:
+			noise = self.rng.normal(0, 0.01, np.shape(value))
+		return np.clip(value + noise, 0, 1)
+
+
+# ========================== FlameS, seabreeze interface ==========================
+def list_devices():
+	return ['SimulatedFlameS']
+
+
+class Spectrometer:
+	def __init__(self, device):
+		self.device = device
+		self.sim = reactor()
+		self.int_time = 100000	# us
+
+	def wavelengths(self):
+		return self.sim.wavelengths.copy()
+
+	def integration_time_micros(self, int_time):
+		self.int_time = int_time
+
+	def intensities(self):
+		# the light that reached the detector during the exposure: average of the
+		# state at its start and end, so a lamp or switch change shows up as a mix
+		int_time = self.int_time
+		before = self.sim.spectrum(self.sim.channel(), self.sim.light(), int_time)
+		self.sim.clock.sleep(int_time / 1e6)
+		after = self.sim.spectrum(self.sim.channel(), self.sim.light(), int_time)
+		return self.sim.noisy((before + after) / 2)
+
+
+# ============================ Arduino, pyfirmata interface ============================
+class FakePort:
+	def __init__(self, number):
+		self.number = number
+		self.frames = 0		# DIGITAL_MESSAGEs sent
+
+	def write(self):
+		self.frames += 1
+
+
+class FakePin:
+	def __init__(self, board, kind, number, mode):
+		self.board = board
+		self.type = kind
+		self.pin_number = number
+		self.mode = mode
+		self.value = 0
+		self.reporting = False
+		self.port = board.port(number // 8) if kind == 'd' else None
+
+	def write(self, value):
+		if value != self.value:
+			self.value = value
+			self.board.pin_written(self)
+
+	def read(self):
+		if self.type == 'a':
+			return self.board.analog_value(self.pin_number)
+		return self.value
+
+	def enable_reporting(self):
+		self.reporting = True
+
+	def disable_reporting(self):
+		self.reporting = False
+
+
+class FakeBoard:
+	simulated = True	# the board registry starts no iterator thread for it
+
+	def __init__(self, name):
+		self.name = name
+		self.sim = reactor()
+		self.sim.boards[name] = self
+		self.pins = {}		# (kind, number): FakePin
+		self.ports = {}
+		self.handlers = {}
+		self.stage_position = 0			# steps, AccelStepper position or counted step pulses
+		self.stepper_speed = 4000		# steps/s
+		self.stepper_acceleration = 16000	# steps/s^2
+
+	def port(self, number):
+		return self.ports.setdefault(number, FakePort(number))
+
+	def get_pin(self, pin_def):
+		kind, number, mode = pin_def.split(':')
+		key = (kind, int(number))
+		if key not in self.pins:
+			self.pins[key] = FakePin(self, kind, int(number), mode)
+		return self.pins[key]
+
+	def pin_value(self, kind, number):
+		pin = self.pins.get((kind, number))
+		return 0 if pin is None else pin.value
+
+	def pin_written(self, pin):
+		# bit-banged stage: count rising edges of the step pin (8) in the direction of pin 7
+		if self.name == 'Mega_2' and pin.type == 'd' and pin.pin_number == 8 and pin.value:
+			self.stage_position += 1 if self.pin_value('d', 7) else -1
+
+	def mux_channel(self, select_pins):
+		return sum(self.pin_value('d', p) << i for i, p in enumerate(select_pins))
+
+	def analog_value(self, number):
+		# IR board: analog 3 and 4 are the two multiplexers, sampled on the simulated clock like the bursts
+		if self.name != 'Mega_1' or number not in (3, 4):
+			return 0.0
+		mux = number - 3
+		chan = self.mux_channel([30, 31, 32, 33] if mux == 0 else [40, 41, 42, 43])
+		return float(self.sim.ir_voltage(16 * mux + chan, self.sim.clock.time()))
+
+	def add_cmd_handler(self, cmd, func):
+		self.handlers[cmd] = func
+
+	def send_sysex(self, cmd, data = []):
+		if cmd == stepper.ACCELSTEPPER_DATA:
+			self._stepper(list(data))
+		elif cmd == ir_burst.IR_BURST:
+			mux, chan = data[0], data[1]
+			n = data[2] | (data[3] << 7)
+			period = data[4] | (data[5] << 7)
+			threading.Thread(target = self._burst, args = (mux, chan, n, period), daemon = True).start()
+
+	def _reply(self, cmd, data):
+		if cmd in self.handlers:
+			self.handlers[cmd](*data)
+
+	def _stepper(self, data):
+		command, device = data[0], data[1]
+		if command == stepper.SET_SPEED:
+			self.stepper_speed = _decode_float(data[2:6])
+		elif command == stepper.SET_ACCELERATION:
+			self.stepper_acceleration = _decode_float(data[2:6])
+		elif command == stepper.ZERO:
+			self.stage_position = 0
+		elif command == stepper.REPORT_POSITION:
+			self._reply(stepper.ACCELSTEPPER_DATA, [stepper.REPORT_POSITION, device] + stepper.encode_int(self.stage_position))
+		elif command == stepper.STEP:
+			steps = stepper.decode_int(data[2:7])
+			threading.Thread(target = self._move, args = (device, steps), daemon = True).start()
+
+	def _move(self, device, steps):
+		ramp = self.stepper_speed**2 / self.stepper_acceleration
+		if abs(steps) < ramp:
+			duration = 2 * math.sqrt(abs(steps) / self.stepper_acceleration)
+		else:
+			duration = self.stepper_speed / self.stepper_acceleration + abs(steps) / self.stepper_speed
+		self.sim.clock.sleep(duration)
+		self.stage_position += steps
+		self._reply(stepper.ACCELSTEPPER_DATA, [stepper.MOVE_COMPLETE, device] + stepper.encode_int(self.stage_position))
+
+	def _burst(self, mux, chan, n, period):
+		# the board samples on its own clock, i.e. simulated time
+		n = min(n, 2000)
+		t_start = self.sim.clock.time()
+		self.sim.clock.sleep(n * period / 1e6)
+		t = t_start + np.arange(n) * period / 1e6
+		values = np.round(self.sim.ir_voltage(16 * mux + chan, t) * ir_burst.ADC_MAX).astype(np.uint16)
+		t_us = int(t_start * 1e6) % 2**32
+		header = bytes([0, mux, chan]) + n.to_bytes(2, 'little') + period.to_bytes(2, 'little') + \
+				t_us.to_bytes(4, 'little') + ((t_us + n * period) % 2**32).to_bytes(4, 'little')
+		self._reply(ir_burst.IR_BURST, _split7(header))
+		for offset in range(0, n, 24):
+			count = min(24, n - offset)
+			block = bytes([1, mux, chan]) + offset.to_bytes(2, 'little') + bytes([count]) + \
+					values[offset:offset + count].astype('<u2').tobytes()
+			self._reply(ir_burst.IR_BURST, _split7(block))
+
+	def exit(self):
+		self.sim.boards.pop(self.name, None)
+
+
+def _split7(payload):
+	# Firmata sends every SysEx payload byte as two 7-bit bytes, LSB first
+	data = []
+	for b in payload:
+		data += [b & 0x7F, b >> 7]
+	return data
+
+
+def _decode_float(data):
+	packed = data[0] | (data[1] << 7) | (data[2] << 14) | (data[3] << 21)
+	value = (packed & 0x7FFFFF) * 10.0**(((packed >> 23) & 0x0F) - 11)
+	return -value if packed >> 27 else value
+
+
+# ============================== MFCS-EZ, dll interface ==============================
+class FakeMFCSLib:
+	simulated = True	# mfcs.exit_mfcs does not unload a dll for it
+
+	def __init__(self, tau = 5, noise = 0.3):
+		self.sim = reactor()
+		self.tau = tau		# s, time constant of the pressure response
+		self.noise = noise	# mbar
+		self._lock = threading.Lock()
+		start = self.sim.pressures()
+		now = self.sim.clock.time()
+		# channel: (pressure at the last set point change, set point, time of the change)
+		self._state = {chan: (start[chan], start[chan], now) for chan in range(1, 5)}
+		self.sim.mfcs = self
+
+	def pressures(self, t = None):
+		t = self.sim.clock.time() if t is None else t
+		with self._lock:
+			return {chan: target + (p0 - target) * math.exp(-(t - t0) / self.tau)
+					for chan, (p0, target, t0) in self._state.items()}
+
+	def mfcsez_initialisation(self, index):
+		return 1
+
+	def mfcs_get_serial(self, handle, serial):
+		serial._obj.value = 1234
+		return 0
+
+	def mfcs_set_alpha(self, handle, channel, alpha):
+		return 0
+
+	def mfcs_get_status(self, handle, status):
+		status._obj.value = b'\x00'		# reset: nothing to switch on in the simulation
+		return 0
+
+	def mfcs_read_chan(self, handle, channel, pressure, chrono):
+		chan = ord(channel.value)
+		value = self.pressures()[chan]
+		with self.sim._lock:
+			value += self.sim.rng.normal(0, self.noise)
+		pressure._obj.value = value
+		chrono._obj.value = int(self.sim.clock.time() * 10) % 65536
+		return 0
+
+	def mfcs_set_auto(self, handle, channel, value):
+		chan = ord(channel.value)
+		target = getattr(value, 'value', value)
+		now = self.sim.clock.time()
+		current = self.pressures(now)[chan]
+		with self._lock:
+			self._state[chan] = (current, float(target), now)
+		return 0
+
+	def mfcs_close(self, handle):
+		return True
@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+"""
+******************************************************************************
+hardware		: --
+language		: python
+requirement		: numpy, h5py
+author			: Ricki Chairil, Chemical Engineering, University of Southern California
+function		: append-only HDF5 archive for long unattended runs.
+				  one file holds every pass as chunked, compressed
+				  time x channel x pixel datasets plus per-pass metadata
+				  (pressures, integration times, timestamps), instead of one
+				  pickled .npy dict per pass.
+				  the spectra of a pass are kept in memory and written once per
+				  pass by flush(): a compressed chunk rewritten spectrum by
+				  spectrum leaves its old copies in the file as dead space.
+******************************************************************************
+"""
+import time
+import numpy as np
+import h5py
+
+
+class SpectraArchive:
+	# filename: .h5 file, created if missing, appended to otherwise
+	# spectra: names of the spectrum datasets, e.g. ['PL', 'Abs']
+	# scalars: names of per-channel values, e.g. ['peak', 'fwhm']
+	# meta: names of per-pass values, e.g. ['P1', 'P3', 'P4', 'PL_time']
+	# chunk_passes: passes per chunk along the time axis, the file grows by this many rows at once
+	def __init__(self, filename, spectra = ('PL', 'Abs'), scalars = ('peak', 'fwhm'), meta = (),
+				n_chan = 16, n_pixel = 2048, chunk_passes = 16, compression = 'gzip'):
+		self.filename = filename
+		self.n_chan = n_chan
+		self.n_pixel = n_pixel
+		self.chunk_passes = chunk_passes
+		self.f = h5py.File(filename, 'a', libver = 'latest')
+
+		# datasets are resizable along time only; a spectrum chunk is one channel of one pass, written
+		# once, and reading a single channel over days of history touches only that channel's chunks
+		for name in spectra:
+			self._create(name, (n_chan, n_pixel), np.float32, (1, 1, n_pixel), compression)
+			self._create(name + '_time', (n_chan,), np.float64, (chunk_passes, n_chan), None)
+		for name in scalars:
+			self._create(name, (n_chan,), np.float64, (chunk_passes, n_chan), None)
+		self._create('pass_time', (), np.float64, (chunk_passes,), None)
+		for name in meta:
+			self._create('meta/' + name, (), np.float64, (chunk_passes,), None)
+
+		if 'n_passes' not in self.f:
+			self.f.create_dataset('n_passes', data = [0], dtype = np.int64)	# attributes are frozen in SWMR mode
+		self.n_passes = int(self.f['n_passes'][0])
+		self.spectra = list(spectra)
+		self._row = {}		# spectra of the current pass, name: n_chan x n_pixel
+		self._written = {}	# name: channels written since the last flush
+		self.f.swmr_mode = True		# readers may open the file while the run is writing
+
+	def _create(self, name, shape, dtype, chunks, compression):
+		if name in self.f:
+			return
+		opts = {}
+		if compression is not None:
+			opts = {'compression': compression, 'shuffle': True}
+		self.f.create_dataset(name, shape = (0,) + shape, maxshape = (None,) + shape,
+							dtype = dtype, chunks = chunks, fillvalue = np.nan, **opts)
+
+	def _datasets(self):
+		datasets = []
+		def visit(name, obj):
+			if isinstance(obj, h5py.Dataset) and name != 'n_passes':
+				datasets.append(obj)
+		self.f.visititems(visit)
+		return datasets
+
+	def new_pass(self, meta = None, t = None):
+		# start a new row along the time axis; the file is only resized once per chunk_passes passes
+		self._write_row()
+		self._row = {name: np.full((self.n_chan, self.n_pixel), np.nan, np.float32) for name in self.spectra}
+		row = self.n_passes
+		if row >= self.f['pass_time'].shape[0]:
+			for ds in self._datasets():
+				ds.resize(row + self.chunk_passes, axis = 0)
+		self.f['pass_time'][row] = time.time() if t is None else t
+		if meta:
+			for key, value in meta.items():
+				self.f['meta/' + key][row] = value
+		self.n_passes += 1
+		self.f['n_passes'][0] = self.n_passes
+		return row
+
+	def write(self, name, chan, spec, t = None):
+		# store one spectrum of the current pass, in the file with the next flush()
+		row = self.n_passes - 1
+		self._row[name][chan] = spec
+		self._written.setdefault(name, set()).add(chan)
+		self.f[name + '_time'][row, chan] = time.time() if t is None else t
+
+	def write_value(self, name, chan, value):
+		self.f[name][self.n_passes - 1, chan] = value
+
+	def _write_row(self):
+		# the buffered spectra of the current pass, each chunk once (again after a re-measurement)
+		row = self.n_passes - 1
+		for name, chans in self._written.items():
+			for chan in sorted(chans):
+				self.f[name][row, chan, :] = self._row[name][chan]
+		self._written = {}
+
+	def flush(self):
+		# once per pass, after all its spectra
+		self._write_row()
+		self.f.flush()
+
+	def close(self):
+		self._write_row()
+		self.f.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		self.close()
+
+
+# ========================= reading an archive =========================
+def open_archive(filename):
+	# read-only handle that can be opened while the run is still appending
+	return h5py.File(filename, 'r', libver = 'latest', swmr = True)
+
+def read_channel(f, name, chan, start = 0, stop = None):
+	# spectra of one channel over passes start:stop (passes x pixel), only its chunks are read
+	f['n_passes'].refresh()
+	n_passes = int(f['n_passes'][0])
+	if stop is None or stop > n_passes:
+		stop = n_passes
+	f[name].refresh()
+	f[name + '_time'].refresh()
+	return f[name][start:stop, chan, :], f[name + '_time'][start:stop, chan]
+
+def read_meta(f):
+	# per-pass metadata as a dict of arrays, including 'pass_time'
+	f['n_passes'].refresh()
+	n_passes = int(f['n_passes'][0])
+	f['pass_time'].refresh()
+	meta = {'pass_time': f['pass_time'][:n_passes]}
+	if 'meta' in f:
+		for key in f['meta']:
+			f['meta'][key].refresh()
+			meta[key] = f['meta'][key][:n_passes]
+	return meta
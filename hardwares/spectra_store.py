@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+"""
+******************************************************************************
+hardware		: --
+language		: python
+requirement		: numpy
+author			: Ricki Chairil, Chemical Engineering, University of Southern California
+function		: in-memory channel x pixel store for the spectra of one pass.
+				  flame_s fills one row per channel in place, and the whole pass
+				  is written to disk once as binary .npy files instead of
+				  re-reading and re-writing a CSV for every channel.
+******************************************************************************
+"""
+import os
+import numpy as np
+
+
+class SpectraStore:
+	# n_chan: number of reactor channels (rows)
+	# n_pixel: number of spectrometer pixels (columns)
+	# names: one buffer per acquisition type, e.g. 'PL_spectra', 'Abs_spectra_100ms'
+	def __init__(self, n_chan, n_pixel, names):
+		self.n_chan = n_chan
+		self.n_pixel = n_pixel
+		self.buffers = {}
+		for name in names:
+			self.buffers[name] = np.full((n_chan, n_pixel), np.nan)
+
+	def clear(self, name = None):
+		# unfilled channels stay 'nan' so a partial pass is obvious in the file
+		if name is None:
+			for buf in self.buffers.values():
+				buf.fill(np.nan)
+		else:
+			self.buffers[name].fill(np.nan)
+
+	def fill(self, name, chan, spec):
+		# copy the spectrum into the preallocated row, no new array is created
+		self.buffers[name][chan, :] = spec
+
+	def get(self, name):
+		return self.buffers[name]
+
+	def flush(self, directory = ''):
+		# write every buffer as <name>.npy, pixel x channel like the old CSV files
+		# (one column per channel), load with np.load(filename)
+		filenames = []
+		for name, buf in self.buffers.items():
+			filename = os.path.join(directory, name + '.npy')
+			np.save(filename, buf.T)
+			filenames.append(filename)
+		return filenames
@@ -1,15 +1,9 @@
-import serial
+# run from the repository folder: python -m hardwares.stage
 import time
-from serial.tools.list_ports import comports
-from pyfirmata import ArduinoMega
+from hardwares.board_registry import registry
  
-for comport in comports():
-	SN = comport.serial_number
-	if SN == '55739323637351517151':
-		board_port = comport.device 
- 
-# Create the Serial port for ArduinoMega board
-board = ArduinoMega(board_port) 
+# The stage ArduinoMega board (Mega_2), found by its serial number in arduino_boards.py
+board = registry.get('Mega_2') 
 # Wait for 2 seconds for the communication to get established
 time.sleep(2) 
  
@@ -30,21 +24,22 @@ direct = input('Which direction to move? \n0. Away from motor\n1. Towards motor\
 # start moving the stage for one block
 numOfSteps = block_steps*1 # one block
 
-if int(direct) == 0:
-	print('away from motor for '+str(block_steps)+' blocks')
-	PinDir.write(0) # away from the motor
-	for n in range (numOfSteps):
-		PinStep.write(1)
-		time.sleep(pulseWidthSec)
-		PinStep.write(0)
-		time.sleep(SecBetweenSteps)
-elif int(direct) == 1:        
-	print('approach to the motor for '+str(block_steps)+' blocks')        
-	PinDir.write(1) # approaching to the motor
-	for n in range (numOfSteps):
-		PinStep.write(1)
-		time.sleep(pulseWidthSec)
-		PinStep.write(0)
-		time.sleep(SecBetweenSteps)
- 
-board.exit()
\ No newline at end of file
+with registry.lock('Mega_2'): # the whole pulse train, the rule for every user of the board
+	if int(direct) == 0:
+		print('away from motor for '+str(block_steps)+' blocks')
+		PinDir.write(0) # away from the motor
+		for n in range (numOfSteps):
+			PinStep.write(1)
+			time.sleep(pulseWidthSec)
+			PinStep.write(0)
+			time.sleep(SecBetweenSteps)
+	elif int(direct) == 1:        
+		print('approach to the motor for '+str(block_steps)+' blocks')        
+		PinDir.write(1) # approaching to the motor
+		for n in range (numOfSteps):
+			PinStep.write(1)
+			time.sleep(pulseWidthSec)
+			PinStep.write(0)
+			time.sleep(SecBetweenSteps)
+ 
+registry.close_all()
\ No newline at end of file
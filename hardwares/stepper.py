@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+"""
+******************************************************************************
+hardware		: Arduino Mega (Mega_2, linear stage) with a step/direction driver
+language		: python
+requirement		: pyfirmata, the stage board flashed with ConfigurableFirmata
+				  including AccelStepperFirmata (the ConfigurableFirmata example
+				  sketch from the Arduino IDE library manager)
+author			: Ricki Chairil, Chemical Engineering, University of Southern California
+function		: hardware-timed stage moves. the board generates the step pulses
+				  with AccelStepper (speed and acceleration ramp), python only sends
+				  one 'move N steps' SysEx and waits for the 'move complete' reply,
+				  instead of two serial writes per step.
+				  an iterator thread (pyfirmata.util.Iterator) must be running
+				  so that the replies are processed.
+******************************************************************************
+"""
+import math
+import threading
+
+ACCELSTEPPER_DATA = 0x62	# SysEx command of AccelStepperFirmata
+
+# sub-commands
+CONFIG = 0x00
+ZERO = 0x01
+STEP = 0x02
+ENABLE = 0x04
+STOP = 0x05
+REPORT_POSITION = 0x06
+SET_ACCELERATION = 0x08
+SET_SPEED = 0x09
+MOVE_COMPLETE = 0x0A
+
+DRIVER = 0x10		# interface byte: step + direction driver, whole steps, no enable pin
+
+
+# signed 32-bit integer as 5 7-bit bytes, LSB first, sign in bit 3 of the last byte
+def encode_int(value):
+	mag = abs(int(value))
+	return [mag & 0x7F, (mag >> 7) & 0x7F, (mag >> 14) & 0x7F, (mag >> 21) & 0x7F,
+			((mag >> 28) & 0x07) | (0x08 if value < 0 else 0)]
+
+def decode_int(data):
+	mag = data[0] | (data[1] << 7) | (data[2] << 14) | (data[3] << 21) | ((data[4] & 0x07) << 28)
+	return -mag if data[4] & 0x08 else mag
+
+
+# AccelStepperFirmata float: value = significand * 10^(exponent - 11),
+# 23-bit significand, 4-bit exponent, sign bit, as 4 7-bit bytes LSB first
+def encode_float(value):
+	sign = 1 if value < 0 else 0
+	value = abs(value)
+	exponent = 11
+	while value and value * 10 < 2**23 and exponent > 0 and value != int(value):
+		value *= 10
+		exponent -= 1
+	while value >= 2**23 and exponent < 15:
+		value /= 10
+		exponent += 1
+	packed = (int(round(value)) & 0x7FFFFF) | (exponent << 23) | (sign << 27)
+	return [packed & 0x7F, (packed >> 7) & 0x7F, (packed >> 14) & 0x7F, (packed >> 21) & 0x7F]
+
+
+class FirmataStepper:
+	# board: pyfirmata board, device: stepper number on the board (0-9)
+	# max_speed in steps/s, acceleration in steps/s^2
+	def __init__(self, board, step_pin, dir_pin, device = 0, max_speed = 4000, acceleration = 16000):
+		self.board = board
+		self.device = device
+		self.max_speed = max_speed
+		self.acceleration = acceleration
+		self.position = None	# steps, as last reported by the board
+		self._done = threading.Event()
+		self._reply = threading.Event()
+		board.add_cmd_handler(ACCELSTEPPER_DATA, self._handler)
+		self._send(CONFIG, [DRIVER, step_pin, dir_pin])
+		self.set_speed(max_speed)
+		self.set_acceleration(acceleration)
+
+	def _send(self, command, data = ()):
+		self.board.send_sysex(ACCELSTEPPER_DATA, [command, self.device] + list(data))
+
+	def _handler(self, *data):
+		command, device = data[0], data[1]
+		if device != self.device or command not in (MOVE_COMPLETE, REPORT_POSITION):
+			return
+		self.position = decode_int(data[2:7])
+		self._reply.set()
+		if command == MOVE_COMPLETE:
+			self._done.set()
+
+	def set_speed(self, max_speed):
+		self.max_speed = max_speed
+		self._send(SET_SPEED, encode_float(max_speed))
+
+	def set_acceleration(self, acceleration):
+		self.acceleration = acceleration
+		self._send(SET_ACCELERATION, encode_float(acceleration))
+
+	def probe(self, timeout = 1):
+		# True if the firmware answers a position request (StandardFirmata ignores it)
+		return self.report_position(timeout) is not None
+
+	def report_position(self, timeout = 1):
+		self._reply.clear()
+		self._send(REPORT_POSITION)
+		if not self._reply.wait(timeout):
+			return None
+		return self.position
+
+	def zero(self):
+		self._send(ZERO)
+		self.position = 0
+
+	def move_time(self, steps):
+		# duration (s) of a trapezoidal (or triangular) speed profile over |steps|
+		steps = abs(steps)
+		ramp_steps = self.max_speed**2 / self.acceleration		# steps to accelerate and brake
+		if steps < ramp_steps:
+			return 2 * math.sqrt(steps / self.acceleration)
+		return self.max_speed / self.acceleration + steps / self.max_speed
+
+	def start_move(self, steps):
+		# relative move, positive steps drive the direction pin high
+		self._done.clear()
+		self._send(STEP, encode_int(steps))
+
+	def wait(self, timeout = None):
+		if not self._done.wait(timeout):
+			self.stop()
+			raise TimeoutError('stage move not completed in '+str(timeout)+' s')
+		return self.position
+
+	def move(self, steps, timeout = None):
+		# blocks until the board reports the move complete, returns the position in steps
+		if steps == 0:
+			return self.position
+		if timeout is None:
+			timeout = 2 * self.move_time(steps) + 2
+		self.start_move(steps)
+		return self.wait(timeout)
+
+	def stop(self):
+		# decelerates to a stop, the board then reports move complete
+		self._send(STOP)
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+"""
+******************************************************************************
+language		: python
+requirement		: numpy
+authors			: Ricki Chairil, Chemical Engineering, University of Southern California
+function		: droplet analysis of the IR channels.
+				  droplet_stats() works on all channels at once (channel x sample
+				  arrays) with the same definitions as the per-channel loop that
+				  used to be in mrf_405.ir_mux; DropletStream updates the same
+				  estimates chunk by chunk while samples are still arriving.
+******************************************************************************
+"""
+import numpy as np
+
+
+def _with_time(times, n_chan):
+	times = np.asarray(times, dtype = float)
+	if times.ndim == 1: # one time axis shared by all the channels
+		times = np.broadcast_to(times, (n_chan, len(times)))
+	return times
+
+
+# times: (n_chan, n_samples) or (n_samples,) in s, volts: (n_chan, n_samples)
+# cut: threshold as a fraction of the signal depth, a droplet is where the signal
+#      drops further than this below its maximum
+# returns a dict of per-channel arrays:
+#   freq		droplet frequency (Hz)
+#   duty		fraction of samples inside a droplet
+#   drops		samples per droplet (ms/drop at the nominal 1 ms sampling, as before)
+#   drop_length	droplet length in s, from the real sampling time
+def droplet_stats(times, volts, cut = 0.3):
+	volts = np.asarray(volts, dtype = float)
+	times = _with_time(times, len(volts))
+
+	rel_ir = volts.max(axis = 1, keepdims = True) - volts
+	cut_height = cut * rel_ir.max(axis = 1, keepdims = True)
+	crossings = (np.diff(np.sign(rel_ir - cut_height), axis = 1) != 0).sum(axis = 1)
+	liquid = (rel_ir > cut_height).sum(axis = 1)
+	return _stats(crossings, liquid, volts.shape[1], times[:, -1] - times[:, 0])
+
+
+def _stats(crossings, liquid, n_samples, duration):
+	peak_numbs = crossings / 2
+	with np.errstate(divide = 'ignore', invalid = 'ignore'):
+		freq = peak_numbs / duration # unit Hz
+		drops = liquid / peak_numbs
+		duty = liquid / n_samples
+		drop_length = duty * duration / peak_numbs
+	return {'freq': freq, 'duty': duty, 'drops': drops, 'drop_length': drop_length}
+
+
+class DropletStream:
+	# Incremental version of droplet_stats for samples arriving in chunks, with the same
+	# results as droplet_stats on all the samples so far. The threshold follows the running
+	# minimum and maximum of each channel; while they stay put only the new chunk is counted,
+	# when they move the channel's buffered samples are counted again with the new threshold,
+	# so crossings of a threshold that was still inside the noise are not kept.
+	def __init__(self, n_chan, cut = 0.3):
+		self.n_chan = n_chan
+		self.cut = cut
+		self.v_max = np.full(n_chan, -np.inf)
+		self.v_min = np.full(n_chan, np.inf)
+		self.last_sign = np.zeros(n_chan)
+		self.crossings = np.zeros(n_chan, dtype = np.int64)
+		self.liquid = np.zeros(n_chan, dtype = np.int64)
+		self.n_samples = 0
+		self.t_first = np.full(n_chan, np.nan)
+		self.t_last = np.full(n_chan, np.nan)
+		self._chunks = []	# volts of every update, for the recounts
+
+	def _signs(self, volts, chans):
+		# same test as droplet_stats: max - v against cut * (max - min)
+		rel_ir = self.v_max[chans, None] - volts
+		cut_height = self.cut * (self.v_max - self.v_min)[chans, None]
+		return np.sign(rel_ir - cut_height), rel_ir > cut_height
+
+	def update(self, times, volts):
+		volts = np.asarray(volts, dtype = float)
+		times = _with_time(times, self.n_chan)
+		if volts.shape[1] == 0:
+			return self.stats()
+		v_max = np.maximum(self.v_max, volts.max(axis = 1))
+		v_min = np.minimum(self.v_min, volts.min(axis = 1))
+		moved = (v_max != self.v_max) | (v_min != self.v_min)
+		self.v_max, self.v_min = v_max, v_min
+		self._chunks.append(volts)
+		if self.n_samples == 0:
+			self.t_first = times[:, 0].copy()
+		self.t_last = times[:, -1].copy()
+		self.n_samples += volts.shape[1]
+
+		if moved.any(): # new threshold: count all the samples of these channels again
+			sign, liquid = self._signs(np.concatenate([chunk[moved] for chunk in self._chunks], axis = 1), moved)
+			self.crossings[moved] = (np.diff(sign, axis = 1) != 0).sum(axis = 1)
+			self.liquid[moved] = liquid.sum(axis = 1)
+			self.last_sign[moved] = sign[:, -1]
+		same = ~moved
+		if same.any(): # same threshold: only the new samples, a crossing can sit right on the chunk boundary
+			sign, liquid = self._signs(volts[same], same)
+			self.crossings[same] += (np.diff(sign, axis = 1) != 0).sum(axis = 1) + (sign[:, 0] != self.last_sign[same])
+			self.liquid[same] += liquid.sum(axis = 1)
+			self.last_sign[same] = sign[:, -1]
+		return self.stats()
+
+	def stats(self):
+		return _stats(self.crossings, self.liquid, self.n_samples, self.t_last - self.t_first)
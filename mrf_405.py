@@ -10,215 +10,313 @@ authors			: Lu Wang, Chemical Engineering, University of Southern California
 				: Ricki Chairil, Chemical Engineering, University of Southern California
 function		: script performing routine IR and/or fluorescent spectral analysis and automatic stage movement of product photoluminescent properties
 				  in CsPbBr3 millifluidic reactor
-				: note pressure optimization will not be performed in this script. For pressure optimization, refer to mrf_feedback_control.py
+				: with use_mfcs and optimize set in the main script, the FWHM confidence of every pass drives the MFCS pressures
+				  through the optimizers package (Nelder-Mead or Bayesian optimisation); with n_groups > 1 the
+				  channel groups run different conditions in the same pass (optimizers/campaign.py)
 ******************************************************************************
 """
 
 import datetime
-import time
-import threading
 import logging
 import numpy as np
 import tkinter
 from tkinter import filedialog
 import os
-import serial
-import pandas as pd
-from serial.tools.list_ports import comports
-from pyfirmata import ArduinoMega 
-from pyfirmata import util
+import tempfile
+from functools import partial
 
 # files created by LuWang
 from hardwares import flame_s
 from hardwares import arduino_control as ard_contr
 from hardwares import mfcs
 from hardwares import multiplexer as mux
-# import nelder_mead as nm
+from hardwares.board_registry import registry
+from hardwares import simulated # MRF_SIMULATE=1 runs this script on simulated hardware
+from hardwares.simulated import clock # time()/sleep(), on the simulated clock under MRF_SIMULATE=1
+from hardwares.spectra_archive import SpectraArchive
+from hardwares.ir_burst import BurstReader
+from sequencer import Sequencer, Step
+from runner import PassRunner
+import settling
+from fwhm_stats import FWHMStats
+import ir_analysis
+from optimizers.nelder_mead import NelderMead
+from optimizers.bayesian import BayesianOptimizer
+from optimizers.loop import PressureLoop
+from optimizers.campaign import Campaign, channel_groups
+
+# the hardware is only connected by the main script below, importing this file has no side effects
+file_dir = '' # folder for all the data, chosen at the start of the run
 
 # ====================== Check status of all the hardwares ===========================
-
-
-# ------- locate the Arduino board for IR reading ------
-for comport in comports():
-		SN = comport.serial_number
-		if SN == '95530343235351605281':
-			ir_port = comport.device # e.g. 'COM5'
-if ir_port:
-	print('The port of IR Arduino board (Mega_1) is :', ir_port)
-else:
-	input('The IR Arduino board (Mega_1) is not available, please terminate here!')
-
-
-# ----- ensure linear stage is at initial position -----
-stage_initial = input('Is linear stage at initial position? [y/n]')
-if stage_initial in ['n','N','No','NO']:
-	ard_contr.custom_move_stage()
-
-# ------ initialize MFCS-EZ Fluigent pressure unit ------
-#mfcs.init_mfcs() # 'MFCS is normal' means it's normal, START light is green on the unit
-				 # 'MFCS is reset' means the valve is closed, STOP light is red
-#read pressure in each channel
-#mfcs.read_pressure()
+# use_mfcs: the pressures are set through the MFCS, its readbacks are then polled in the background
+def check_hardware(use_mfcs = False):
+	# ------- connect to the spectrometer and the control boards ------
+	flame_s.connect()
+	ard_contr.connect()
+
+	# ------- locate the Arduino board for IR reading ------
+	# the serial ports were already enumerated once by the board registry (arduino_control)
+	if 'Mega_1' in registry.discover():
+		print('The port of IR Arduino board (Mega_1) is :', registry.port('Mega_1'))
+	else:
+		input('The IR Arduino board (Mega_1) is not available, please terminate here!')
+
+
+	# ----- ensure linear stage is at initial position -----
+	if simulated.enabled(): # the simulated stage starts there
+		stage_initial = 'y'
+	else:
+		stage_initial = input('Is linear stage at initial position? [y/n]')
+	if stage_initial in ['n','N','No','NO']:
+		ard_contr.custom_move_stage()
+	ard_contr.stage_set_home() # stage positions are tracked from here
+
+	# ------ initialize MFCS-EZ Fluigent pressure unit ------
+	#mfcs.init_mfcs() # 'MFCS is normal' means it's normal, START light is green on the unit
+					 # 'MFCS is reset' means the valve is closed, STOP light is red
+	#read pressure in each channel
+	#mfcs.read_pressure()
+	if use_mfcs: # pressures sampled in the background, read with mfcs.controller().latest() without a dll call
+		mfcs.controller().start_polling(10)
 
 
 # ============== choose a folder to save all the data ==================
-root = tkinter.Tk()
-root.withdraw() #use to hide tkinter window
-file_dir = filedialog.askdirectory(parent=root, # initialdir=currdir, 
-					title='Please select a directory to save data')
-print(file_dir)
+def choose_folder():
+	if simulated.enabled(): # unattended: MRF_DATA_DIR or a new temporary folder
+		folder = os.environ.get('MRF_DATA_DIR') or tempfile.mkdtemp(prefix = 'mrf_sim_')
+		print(folder)
+		return folder
+	root = tkinter.Tk()
+	root.withdraw() #use to hide tkinter window
+	folder = filedialog.askdirectory(parent=root, # initialdir=currdir, 
+						title='Please select a directory to save data')
+	print(folder)
+	return folder
 
 
-# ================ logging format ===================
-logging.basicConfig(level=logging.DEBUG, 
-	format='(%(threadName)-10s) %(message)s')
+# ============== initialize optimization process ================
+# the optimizers start at the current set points, the loop sends every new set of pressures to the MFCS
+def make_optimizer(set_points, method = 'bayesian'):
+	x0 = [set_points[1], set_points[3], set_points[4]]
+	return NelderMead(x0) if method == 'nelder-mead' else BayesianOptimizer(x0)
 
+def pressure_loop(set_points, method = 'bayesian'):
+	return PressureLoop(make_optimizer(set_points, method), target = 35, restart_above = 37.5, expand_to = 400,
+						apply = mfcs.controller().set_pressures)
 
-# ============== initialize optimization process ================
-#method = nm.method
-#x_list = nm.x_list
-#f_list = nm.f_list
-#reach_goal = False
+# a campaign runs one condition per channel group and pass; every group needs its own pressure driver,
+# the MFCS sets the same pressures for all 16 channels, the simulation any per group
+def pressure_campaign(set_points, n_groups, method = 'bayesian'):
+	if not simulated.enabled():
+		raise ValueError('the MFCS drives all the channels at one condition, use n_groups = 1')
+	groups = channel_groups(n_groups)
+	drivers = [simulated.group_driver(group) for group in groups]
+	return Campaign(make_optimizer(set_points, method), groups, drivers, target = 35)
 
 
 
 
 
 # ################################## Function for reading IR signals #####################################
-def ir_mux(ir_name):
+ir = {} # IR board, multiplexer pins and burst reader, set up by the first scan and kept for the next ones
+
+# Mega_1 is shared by the IR worker and the settling probe: every multiplexer select and the reads
+# that follow it are done holding registry.lock('Mega_1')
+def ir_connect():
+	with registry.lock('Mega_1'): # opened once, the Firmata handshake is not repeated per scan
+		if not ir:
+			ir_board = registry.get('Mega_1')
+			# first multiplexer, define switch and signal pins on boards
+			ir['PinS'], ir['PinSig'] = mux.DefinePin(ir_board, [30,31,32,33],3)
+			# second multiplexer, define switch and signal pins on boards
+			ir['PinS2'], ir['PinSig2'] = mux.DefinePin(ir_board, [40,41,42,43],4)
+			# ------ start Iterator to avoid serial overflow -----
+			registry.start_iterator('Mega_1') # need this iteration otherwise pin just reporting 'None'
+			ir['burst'] = BurstReader(ir_board)
+			ir['board'] = ir_board
+			clock.sleep(0.5)
+			logging.debug('connected to IR board')
+	return ir
+
+def ir_mux(ir_name, burst = False):
 	logging.debug('Starting')
 	
 	# ------- connect to IR hardwares --------
-	board_port = ir_port # The port is from the USB port
-	ir_board = ArduinoMega(board_port) # Creat the Serial port for ArduinoMega board
-	# first multiplexer, define switch and signal pins on boards
-	PinS, PinSig = mux.DefinePin(ir_board, [30,31,32,33],3)
-	# second multiplexer, define switch and signal pins on boards
-	PinS2, PinSig2 = mux.DefinePin(ir_board, [40,41,42,43],4)
-	logging.debug('connected to IR board')
+	ir_connect()
+	PinS, PinSig, PinS2, PinSig2 = ir['PinS'], ir['PinSig'], ir['PinS2'], ir['PinSig2']
 
 	# ------- initialize hardwares and variables ------
 	# start switches with connectin to channel 0
-	mux.SwitchMUX(PinS, 0)	
-	mux.SwitchMUX(PinS2, 0)
+	with registry.lock('Mega_1'):
+		mux.SwitchMUX(PinS, 0)	
+		mux.SwitchMUX(PinS2, 0)
 	Data = {} # Creat an empty dictionary
 	num_of_data = 2000
 
-	# ------ start Iterator to avoid serial overflow -----
-	it = util.Iterator(ir_board) # need this iteration otherwise pin just reporting 'None'
-	it.start()
-	time.sleep(0.5)
-
 	# ------ start collect data ------
-	for n in range(32):
-		# logging.debug('IR channel '+str(n+1)+'...')
-		print("IR channel "+str(n+1)+"...")
-		t = []
-		v = []
-		t0 = time.time()
-		if n<16:	# It's on the first mutiplexer
-			mux.SwitchMUX(PinS,n)
-			time.sleep(0.1)
-			for m in range(num_of_data):
-				t.append(time.time()-t0)
-				v.append(float(mux.Read(PinSig))) # mux returns a string, need to transfer to float number
-				time.sleep(0.000001)
-			Data['Time'+str(n+1)] = t
-			Data['Chan'+str(n+1)] = v
-			
-		else:		# switch to the second mutiplexer, need to re-define channel number
-			m = n-16
-			mux.SwitchMUX(PinS2,m)
-			time.sleep(0.1)
-			for m in range(num_of_data):
-				t.append(time.time()-t0)
-				v.append(float(mux.Read(PinSig2))) # MUX returns a string, need to transfer to float number
-				time.sleep(0.000001)
-			Data['Time'+str(n+1)] = t
-			Data['Chan'+str(n+1)] = v
-					
-	ir_board.exit()
+	if burst: # the board samples 2000 points per channel on its own clock (1 ms period), see hardwares/ir_burst.py
+		with registry.lock('Mega_1'): # the burst requests and their replies
+			times, volts = ir['burst'].read_all(num_of_data, 1000)
+		for n in range(32):
+			Data['Time'+str(n+1)] = times[n]
+			Data['Chan'+str(n+1)] = volts[n]
+	else:
+		volts = np.empty((32, num_of_data)) # preallocated, read_n fills the rows in place
+		stamps = np.empty((32, num_of_data), dtype = np.int64)
+		# both multiplexers switch together, channel n and n+16 are sampled at the same time
+		for n in range(16):
+			# logging.debug('IR channel '+str(n+1)+'...')
+			print("IR channels "+str(n+1)+" and "+str(n+17)+"...")
+			with registry.lock('Mega_1'): # no other thread switches the multiplexers until the reads are done
+				mux.SwitchMUX(PinS,n)
+				mux.SwitchMUX(PinS2,n)
+				clock.sleep(0.1)
+				mux.read_pair_n(PinSig, PinSig2, num_of_data, volts[n], volts[n+16], stamps[n], period_ns = 1000000) # one reading per ms
+			stamps[n+16] = stamps[n]
+		for n in range(32):
+			Data['Time'+str(n+1)] = (stamps[n] - stamps[n,0]) / 1e9 # s
+			Data['Chan'+str(n+1)] = volts[n]
+
 	np.save(os.path.join(file_dir,ir_name), Data) # use np.load(filename) to read data, and dict will be in .item()
 	
-	freq = []
-	drops = []
-	for i in range(32):
-		time_title = 'Time'+str(i+1)
-		chan_title = 'Chan'+str(i+1)
-		time_stamp = Data[time_title]
-		ir = Data[chan_title]
-		ir = np.array(ir) # convert list to array, for the following process
-		
-		rel_ir = -1*ir+ max(ir)
-		cut_height = 0.3* max(rel_ir)
-		spec_cut_half = rel_ir -cut_height
-		fwhm_index = np.where(np.diff(np.sign(spec_cut_half)))[0]
-		peak_numbs = len(fwhm_index)/2
-		# time lapse between reading is 1ms, the unit below is ms
-		liq_total_time = sum(counter > cut_height for counter in rel_ir)
-		
-		freq.append(peak_numbs/(time_stamp[-1]-time_stamp[0])) # unit Hz
-		drops.append(liq_total_time/peak_numbs) # unit: ms/drop
+	# all 32 channels at once, time lapse between readings is about 1ms
+	times = np.array([Data['Time'+str(i+1)] for i in range(32)])
+	volts = np.array([Data['Chan'+str(i+1)] for i in range(32)])
+	droplets = ir_analysis.droplet_stats(times, volts)
+	freq = droplets['freq'] # unit Hz
+	drops = droplets['drops'] # unit: ms/drop
 		
 	print('########### Droplet frequency is  '+str(np.mean(freq))+'  Hz ##############')
 	print('########### Droplet size is  '+str(np.mean(drops))+'  ms/drop ##############')
 
 	logging.debug('Exiting')
+	return droplets
+
+
+# Quick droplet frequency (Hz) of IR channels 1 and 17, about n ms, for the settling detector
+def ir_probe(n = 1000):
+	ir_connect()
+	volts = np.empty((2, n))
+	stamps = np.empty(n, dtype = np.int64)
+	with registry.lock('Mega_1'):
+		mux.SwitchMUX(ir['PinS'], 0)
+		mux.SwitchMUX(ir['PinS2'], 0)
+		mux.read_pair_n(ir['PinSig'], ir['PinSig2'], n, volts[0], volts[1], stamps, period_ns = 1000000)
+	droplets = ir_analysis.droplet_stats((stamps - stamps[0]) / 1e9, volts)
+	return float(np.nanmean(droplets['freq']))
 
 
 
 
 # ###################################### PL-UV-vis spectra function #####################################
-def pl_abs(pl_name, abs_name):
+# channels: any subset of 0-15, measured in the order of least stage travel
+# previous: result of an earlier pl_abs of the same pass, to re-measure some channels into it
+# stats: fwhm_stats.FWHMStats, gets every FWHM as soon as it is measured
+# stop_when: callable taking the running stats summary after every channel, True ends the pass early
+# abort: threading.Event, e.g. PassRunner.abort, set on Ctrl-C: the pass stops and nothing more is written
+def pl_abs(archive, pass_meta, peak_name, fwhm_name, channels = range(16), previous = None, stats = None,
+			stop_when = None, abort = None):
 	logging.debug('Starting')
 	
-	peaks = [] 
-	fwhms = [] 
-	pl_info = {} 
-	abs_info = {}
-
-	# start to read spectra
-	for chan in range(16):
-							
-		ard_contr.choose_chan(chan)
-		
-		print('=====================\nPL channel '+str(chan+1))
-		ard_contr.light_source("LED")
-		flame_s.get_PL(chan) # obtain PL spectral data for channel
-		time.sleep(1)
-		pl_time, pl_spec, peak_wave, fwhm = flame_s.read_pl()
-		
-		pl_info['Time'+str(chan+1)] = pl_time
-		pl_info['Chan'+str(chan+1)] = pl_spec
-		print('peak wave: ', peak_wave)
-		print('FWHM: ', fwhm)
-
-		ard_contr.light_source(None)
-		time.sleep(1)
-
-		print('Abs channel '+str(chan+1))
-		ard_contr.light_source("UV-vis")
-		flame_s.get_abs(chan) # obtain Abs spectral data for channel
-		time.sleep(1)
-		abs_time, abs_spec = flame_s.read_abs(chan)
-		abs_info['Time'+str(chan+1)] = abs_time
-		abs_info['Chan'+str(chan+1)] = abs_spec
-
-		ard_contr.light_source(None)	# turn off both lights
-		time.sleep(1)
-		ard_contr.optical_switch(chan,0)	# let solenoid rest
-		
-		
-		peaks.append(peak_wave) 
-		fwhms.append(fwhm)
-							
-	
-	np.save(os.path.join(file_dir,pl_name), pl_info) # load with np.load(filename), dict will be in .item()
-	np.save(os.path.join(file_dir,abs_name), abs_info) # load with np.load(filename), dict will be in .item()
+	if previous is None:
+		peaks = [float('nan')] * 16
+		fwhms = [float('nan')] * 16
+		archive.new_pass(pass_meta) # one new row in the archive for this pass
+		flame_s.clear_spectra()
+		if stats is not None:
+			stats.new_pass()
+	else: # same archive row and spectra buffers, only the given channels are replaced
+		peaks = list(previous['peaks'])
+		fwhms = list(previous['fwhms'])
+
+	seq = Sequencer(abort = abort)
+	steps = {}
+	def add(step):
+		steps[step.name] = step
+
+	def record_pl(chan):
+		pl_time, pl_spec = steps['PL_spectra'+str(chan)].result
+		peak_wave, fwhm = steps['fwhm'+str(chan)].result
+		archive.write('PL', chan, pl_spec, pl_time)
+		archive.write_value('peak', chan, peak_wave)
+		archive.write_value('fwhm', chan, fwhm)
+		print('PL channel '+str(chan+1)+', peak wave: '+str(peak_wave)+', FWHM: '+str(fwhm))
+		peaks[chan] = peak_wave
+		fwhms[chan] = fwhm
+		if stats is not None: # running confidence of the pass, no reload of the fwhms file
+			summary = stats.add(chan, fwhm)
+			if stop_when is not None and stop_when(summary):
+				seq.stop() # the lamp still goes off and the solenoids rest
+
+	def analyse_pl(chan):
+		_, pl_spec = steps['PL_spectra'+str(chan)].result
+		return flame_s.FWHM(pl_spec)
+
+	def record_abs(chan): # the 150 ms spectrum is kept in flame_s.store
+		abs_time, abs_spec = steps['Abs_spectra_100ms'+str(chan)].result
+		archive.write('Abs', chan, abs_spec, abs_time)
+
+	# visit the channels in one sweep from the current stage block (serpentine across passes)
+	route, travel = ard_contr.plan_channels(channels)
+	print('channels: '+str([chan+1 for chan in route])+', stage travel: '+str(travel)+' blocks')
+	# order the exposures so that the integration time and lamp carry over between channels
+	plan, itime_report = flame_s.plan_exposures(route)
+	print('integration time changes this pass: '+str(itime_report['planned'])+' (saved '+str(itime_report['saved'])+')')
+
+	# each step waits only for what it physically needs, e.g. the next channel's lamp
+	# turns on and its solenoid switches while the current spectra are being written
+	light = None
+	last = None	# step name of the previous exposure
+	rest = None	# step name of the previous solenoid rest
+	block = ard_contr.stage_block()
+	for chan, order in plan:
+		c = str(chan)
+		if chan // 4 != block: # stage moves to the channel's block
+			block = chan // 4
+			add(Step('switch'+c, partial(ard_contr.goto_chan, chan), after = [rest],
+					settle = ard_contr.STAGE_SETTLE, resources = ['mega_2', 'mega_3'], kind = 'stage'))
+		else:
+			add(Step('switch'+c, partial(ard_contr.goto_chan, chan), after = [rest],
+					settle = ard_contr.SOLENOID_SETTLE, resources = ['mega_2', 'mega_3'], kind = 'solenoid'))
+
+		for name in order:
+			exposure = name+c
+			after = ['switch'+c, last]
+			if flame_s.exposures[name][1] != light:
+				light = flame_s.exposures[name][1]
+				settle = ard_contr.LED_SETTLE if light == 'LED' else ard_contr.UV_VIS_SETTLE
+				add(Step('light_'+exposure, partial(ard_contr.light_source, light), after = [last],
+						settle = settle, resources = ['mega_3'], kind = 'lamp'))
+				after.append('light_'+exposure)
+			# one exposure per spectrum, stored and analysed from the same array
+			add(Step(exposure, partial(flame_s.acquire, chan, name), after = after, resources = ['flames'], kind = 'acquire'))
+			last = exposure
+
+			if name == 'PL_spectra':
+				add(Step('fwhm'+c, partial(analyse_pl, chan), after = [exposure], kind = 'analysis'))
+				add(Step('pl_record'+c, partial(record_pl, chan), after = ['fwhm'+c], resources = ['archive'], kind = 'io'))
+			elif name == 'Abs_spectra_100ms':
+				add(Step('abs_record'+c, partial(record_abs, chan), after = [exposure], resources = ['archive'], kind = 'io'))
+
+		rest = 'rest'+c
+		add(Step(rest, partial(ard_contr.optical_switch, chan, 0), after = [last], # let solenoid rest
+				resources = ['mega_3'], kind = 'solenoid', always = True))
+	add(Step('lights_off', partial(ard_contr.light_source, None), after = [last], resources = ['mega_3'], kind = 'lamp',
+			always = True))
+
+	seq.run(steps.values())
+	if abort is not None and abort.is_set():
+		raise RuntimeError('pass aborted')
+	seq.report()
+
+	flame_s.flush_spectra(file_dir) # write the PL/Abs spectra of all 16 channels once per pass (and after a re-measurement)
+	archive.flush() # read back with spectra_archive.open_archive() and read_channel()
 	np.savetxt(os.path.join(file_dir,peak_name), peaks)
 	np.savetxt(os.path.join(file_dir,fwhm_name), fwhms)
 
 	logging.debug('Exiting')
+	return {'peaks': peaks, 'fwhms': fwhms, 'channels': route, 'timings': seq.timings(), 'stopped': bool(seq.skipped)}
 
 
 
@@ -227,102 +325,122 @@ def pl_abs(pl_name, abs_name):
 
 # ######################################### Main script #############################################
 if __name__ == "__main__":
+	use_mfcs = False # set True when the pressures are set through mfcs, the settling then watches their readbacks
+	check_hardware(use_mfcs)
+	file_dir = choose_folder()
+
+	# ================ logging format ===================
+	logging.basicConfig(level=logging.DEBUG, 
+		format='(%(threadName)-10s) %(message)s')
+
+	# all the spectra of this run go into one append-only archive in the data folder
+	archive = SpectraArchive(os.path.join(file_dir, 'spectra_archive.h5'),
+				meta = ('P1', 'P3', 'P4', 'PL_time', 'Cs1_int_time', 'Cs4_int_time'), n_pixel = len(flame_s.wave))
+	# one worker per instrument: FlameS with the Mega_2/Mega_3 optics, and the IR board (Mega_1)
+	runner = PassRunner()
+	use_ir = False # set True to monitor IR droplets alongside the PL/UV-vis scans
+	ir_burst = False # set True if the IR board runs hardwares/firmware/ir_burst (board-timed sampling)
+	remeasure = True # measure the channels without a FWHM once more, without a full sweep
+	stats = FWHMStats() # FWHM statistics within and across the passes, with drift detection
+	stats.listeners.append(lambda chan, s: logging.debug('confidence after '+str(s['measured'])+' channels: '+str(s['confidence'])))
+	optimize = 'bayesian' # with use_mfcs: 'bayesian', 'nelder-mead' or None to keep the set points
+	n_groups = 1 # with optimize: conditions per pass, each on its own group of channels
+	set_points = {1: 300, 3: 200, 4: 300} # MFCS pressures used (mbar), P[Cs-Pb], P[gas], P[Br]
+	loop = None
+	campaign = None
 	try:
-		# [p1_set,p3_set,p4_set] = nm.x_list[0]
-		
-		# mfcs.set_pressure(1,p1_set)		# P[Cs-Pb]
-		# mfcs.set_pressure(3,p3_set)		# P[gas]
-		# mfcs.set_pressure(4,p4_set)		# P[Br]
+		if use_mfcs and optimize and n_groups > 1:
+			campaign = pressure_campaign(set_points, n_groups, optimize)
+			campaign.plan() # sends the first conditions
+		elif use_mfcs and optimize:
+			loop = pressure_loop(set_points, optimize) # sends the first set points
+			set_points = loop.set_points
+		elif use_mfcs:
+			# P[Cs-Pb], P[gas], P[Br] in one batch, queued to the MFCS poller
+			mfcs.controller().set_pressures(set_points)
 		
 		
-		time.sleep(60) # wait for liquid to reach detector modules
+		# wait for liquid to reach detector modules: until the pressures (and droplets) are steady,
+		# at most 60 s, which is also the wait when neither is watched; a campaign's group pressures
+		# do not go through the MFCS, so there are no readbacks to watch
+		settle = settling.wait_settled(mfcs.controller() if use_mfcs and campaign is None else None, set_points,
+										ir_probe if use_ir else None, min_wait = 10, max_wait = 60)
+		print('flow settled: '+str(settle['settled'])+' after '+str(round(settle['waited'], 1))+' s')
+		flame_s.start_streaming() # FlameS reads on its own thread from here on
 			
 		for _ in range(1): # number of passes to make
 			t_now = datetime.datetime.now()
 			
 			# assign file names
 			time_str = str(t_now.hour).zfill(2)+str(t_now.minute).zfill(2)
-			npy_extension = time_str+'_'+"PA=300"+'_'+"PB=200"+'_'+"PC=300"+'.npy' # name files according to MFCS pressures used; convert to .npy array 
-			out_extension = time_str+'_'+"PA=300"+'_'+"PB=200"+'_'+"PC=300"+'.out'  # name files according to MFCS pressures used; convert to .out file
-			pl_name = 'PL_'+ npy_extension
-			abs_name = 'Abs_'+ npy_extension 
+			p_str = "PA="+str(round(set_points[1]))+'_'+"PB="+str(round(set_points[3]))+'_'+"PC="+str(round(set_points[4]))
+			if campaign is not None: # the pressures of every channel go into conditions_*.out
+				p_str = 'campaign'+str(campaign.passes)
+			npy_extension = time_str+'_'+p_str+'.npy' # name files according to MFCS pressures used; convert to .npy array 
+			out_extension = time_str+'_'+p_str+'.out'  # name files according to MFCS pressures used; convert to .out file
 			ir_name = 'IR_'+ npy_extension
 			peak_name = 'peaks_'+ out_extension
 			fwhm_name = 'fwhms_1'+ out_extension
 			
-			pl_abs(pl_name, abs_name) # call this alone if IR not used
-			'''
-			# activate lines 254-264 if multithreading IR module as well
-			# define then start ir_mux thread and pl_abs thread
-			t1 = threading.Thread(name = 'IR', target = ir_mux, args = ([ir_name]))
-			t2 = threading.Thread(name = 'PL-UV-vis', target = pl_abs, args = (pl_name, abs_name))
-				
-			t1.start()
-			t2.start()
-			
-			t1.join()
-			print(threading.enumerate())
-			t2.join()
-			print(threading.enumerate())
-			'''
-			# process PL data in real-time					
-			fwhms = np.loadtxt(os.path.join(file_dir,fwhm_name))
-						
-			fwhm_nansize = (np.isnan(fwhms)).sum(0) # count numbers of fwhms that are 'nan'
-			fwhm_size = len(fwhms) - fwhm_nansize
-			if fwhm_nansize > 2:
-				fwhms = [60 if np.isnan(x) else x for x in fwhms]
-				fwhm_size = 16
-			averg_width = np.nanmean(fwhms)
-			stand_err = np.nanstd(fwhms)/np.sqrt(fwhm_size)
-			confidence = averg_width + 1.96 * stand_err # upper endpoint of 95% confidence interval
+			pass_meta = {'P1': set_points[1], 'P3': set_points[3], 'P4': set_points[4], # MFCS pressures used (mbar)
+						'PL_time': flame_s.PL_time, 'Cs1_int_time': flame_s.Cs1_int_time, 'Cs4_int_time': flame_s.Cs4_int_time}
+			if campaign is not None: # no single condition this pass, see conditions_*.out
+				pass_meta.update(P1 = np.nan, P3 = np.nan, P4 = np.nan)
+			# with the closed loop, a pass that is clearly above the target ends early
+			stop_when = loop.clearly_bad if loop is not None else None
+			jobs = {'PL-UV-vis': ('optics', pl_abs, (archive, pass_meta, peak_name, fwhm_name, range(16), None, stats, stop_when, runner.abort))}
+			monitors = {}
+			if use_ir: # IR droplet scans repeat on their own worker for as long as the optical scan runs
+				monitors['IR'] = ('ir', lambda k: ir_mux('IR_'+str(k)+'_'+npy_extension, ir_burst))
+			pass_record = runner.run_pass(jobs, monitors)
+			print('pass took '+str(round(pass_record['duration'], 1))+' s, IR scans: '+str(len(pass_record['monitors'].get('IR', []))))
+			for name, error in pass_record['monitor_errors'].items():
+				print(name+' scans stopped by an error: '+repr(error))
+			result = pass_record['jobs']['PL-UV-vis']['result']
+			failed = [chan for chan in range(16) if np.isnan(result['fwhms'][chan])]
+			if result['stopped']:
+				print('pass ended early, confidence clearly above the target')
+			elif remeasure and failed:
+				print('re-measuring channels '+str([chan+1 for chan in failed]))
+				pass_record = runner.run_pass({'PL-UV-vis': ('optics', pl_abs, (archive, pass_meta, peak_name, fwhm_name, failed, result, stats, None, runner.abort))})
+				result = pass_record['jobs']['PL-UV-vis']['result']
+			# process PL data in real-time: the statistics were updated with every channel
+			fwhms = np.array(result['fwhms'])
+			summary = stats.end_pass()
+			averg_width, stand_err, confidence = summary['mean'], summary['stand_err'], summary['confidence']
 			
 			
 			print('##################### FWHM is: '+ str(averg_width)+'+/-'+str(stand_err) +' ######################')
 			print('confidence: ', confidence)
-			'''
-			if confidence >35: 
-				if reach_goal == True: # had previously reached goal, should start to optimize again
-					reach_goal = False
-					if confidence > 37.5: # big deviation, probably confronting a disturbance, start a new optimation
-						method = None
-						# define a new nm.x_list based on current pressures
-						nm.new_x_list(p1_set, p3_set, p4_set, confidence)
-					# else: # resume the optimization without setting the new nm.x_list, as this is just a small deviation.
-	
-				method, [p1_set,p3_set,p4_set] = nm.simplex(method,confidence)
-				mfcs.set_pressure(1, p1_set)
-				mfcs.set_pressure(3, p3_set)
-				mfcs.set_pressure(4, p4_set)
-				
-				# move stage back to position 0 and wait till pressures stablize.
-				print('move back to position 0')
-				ard_contr.stage_return()
-				time.sleep(30)
-			else:
-				if min(p1_set, p4_set) < 398: # increase all the pressures to increase throughput
-					[p1_set,p3_set,p4_set] = nm.expand_pressure(p1_set,p3_set,p4_set,400)
-					mfcs.set_pressure(1, p1_set)
-					mfcs.set_pressure(3, p3_set)
-					mfcs.set_pressure(4, p4_set)
-					# move stage back to position 0.
-					print('move back to position 0')
-					ard_contr.stage_return()
-					reach_goal = True
-					print('reach_goal? ', reach_goal)
-					# fwhm narrow enough, can decrease the frequency of detection.
-					print('## desired product, but need to increase pressure ##')
-					time.sleep(30)
-				else:
-					# move stage back to position 0, must wait after 16 channel processes are done.
-					print('move back to position 0')
-					ard_contr.stage_return()
-					reach_goal = True
-					print('reach_goal? ', reach_goal)
+			if summary['drift']:
+				print('FWHM drift since the pressures were last set, EWMA: '+str(summary['ewma']))
+			if campaign is not None: # every group scored on its own FWHMs, then the next batch of conditions
+				channel_set_points = campaign.channel_set_points()
+				np.savetxt(os.path.join(file_dir, 'conditions_'+out_extension),
+						[[channel_set_points[chan][k] for k in (1, 3, 4)] for chan in range(16)])
+				for group in campaign.record(fwhms, result['peaks']):
+					print('group '+str(group['group'])+' '+str(group['set_points'])+': confidence '+str(group['confidence']))
+				campaign.plan()
+				stats.reset_drift() # every group has new set points
+			if loop is not None: # closed loop: the confidence picks the next pressures
+				action = loop.step(confidence, summary['drift'])
+				if action != 'hold': # new set points, new drift reference
+					stats.reset_drift()
+				set_points = loop.set_points
+				print('pressures: '+str(set_points)+' ('+action+')')
+				# the next pass starts where this one ended (serpentine), wait till pressures stabilize
+				if action == 'hold':
 					# fwhm narrow enough, can decrease the frequency of detection.
 					print('######################### desired product, wait for 60s till next detection ##########################')
-					time.sleep(60)
-		'''	
+					clock.sleep(60)
+				else:
+					if action == 'expand':
+						print('## desired product, but need to increase pressure ##')
+					settling.wait_settled(mfcs.controller(), set_points, ir_probe if use_ir else None, max_wait = 30)
+		if loop is not None:
+			print('optimization: '+str(loop.report()))
+		if campaign is not None:
+			print('campaign: '+str(campaign.report()))
 				
 
 	except KeyboardInterrupt:
@@ -330,6 +448,16 @@ if __name__ == "__main__":
 		
 	finally:
 		print('Finally module')
+		runner.shutdown(wait = False) # after Ctrl-C the pass in flight is aborted, not waited for
+		flame_s.stop_streaming()
+		archive.close()
+		if ard_contr.connected: # the stage goes home once, at the end of the run
+			print('move back to position 0')
+			ard_contr.stage_return()
+		registry.close_all() # exit every Arduino board that was opened
+		if use_mfcs:
+			mfcs.controller().stop_polling()
+			mfcs.exit_mfcs()
 
 		# export intensities as csvs (this will only do one iteration)
 		# spectrum = flames.intensities()
@@ -337,5 +465,4 @@ if __name__ == "__main__":
 		# df.to_csv("PL_spectra.csv") # print intensity data for blank to a csv file via Pandas
 		
 		# ard_contr.exit_boards()
-		# mfcs.exit_mfcs()
 		# ir_board.exit()
\ No newline at end of file
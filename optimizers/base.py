@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+"""
+******************************************************************************
+language		: python
+requirement		: numpy
+authors			: Ricki Chairil, Chemical Engineering, University of Southern California
+function		: common ask/tell interface of the pressure optimizers.
+				  ask() gives the next MFCS set points to try as [P1, P3, P4]
+				  (mbar), tell(x, f) returns the FWHM confidence measured there
+				  (smaller is better). observe(x, f) adds a measurement the
+				  optimizer did not ask for, restart(x0, f0) starts a new search
+				  around x0 after a disturbance. ask_batch(q)/tell_batch() do the
+				  same for q conditions measured in one pass (channel groups).
+******************************************************************************
+"""
+import numpy as np
+
+PRESSURE_CHANNELS = (1, 3, 4)	# MFCS channels of P[Cs-Pb], P[gas], P[Br]
+PRESSURE_BOUNDS = ((100, 400), (50, 400), (100, 400))	# mbar, per channel above
+
+
+class Optimizer:
+	def __init__(self, x0, bounds = PRESSURE_BOUNDS):
+		self.bounds = np.array(bounds, dtype = float)
+		self.x0 = self.clip(x0)
+		self.X = []			# every measured point, in order
+		self.F = []			# and its objective value
+		self.n_restarts = 0
+
+	def clip(self, x):
+		return np.clip(np.asarray(x, dtype = float), self.bounds[:, 0], self.bounds[:, 1])
+
+	def ask(self):
+		raise NotImplementedError
+
+	def tell(self, x, f):
+		# f measured at x, the point of the last ask()
+		self.X.append(np.array(x, dtype = float))
+		self.F.append(float(f))
+
+	def observe(self, x, f):
+		# f measured at a point that was not asked for, e.g. after expanding the pressures
+		self.X.append(np.array(x, dtype = float))
+		self.F.append(float(f))
+
+	def ask_batch(self, q):
+		# q points for one pass; an optimizer that can only propose one point at a time
+		# gets it measured q times over, the replicates are averaged by tell_batch()
+		return [self.ask() for _ in range(q)]
+
+	def tell_batch(self, X, F):
+		# values of the points of the last ask_batch(), in the same order
+		pending = self.ask()
+		same = [f for x, f in zip(X, F) if np.allclose(x, pending)]
+		for x, f in zip(X, F):
+			if not np.allclose(x, pending):
+				self.observe(x, f)
+		if same:
+			self.tell(pending, np.mean(same))
+
+	def restart(self, x0, f0 = None):
+		# forget the search and start again around x0, f0: the value already measured there
+		self.n_restarts += 1
+		self.x0 = self.clip(x0)
+		if f0 is not None:
+			self.observe(x0, f0)
+
+	def best(self):
+		if not self.F:
+			return None, None
+		k = int(np.argmin(self.F))
+		return self.X[k], self.F[k]
+
+	@property
+	def n_evals(self):
+		return len(self.F)
@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+"""
+******************************************************************************
+language		: python
+requirement		: numpy
+authors			: Ricki Chairil, Chemical Engineering, University of Southern California
+function		: Bayesian optimisation of the MFCS pressures, for fewer reactor
+				  passes than the simplex. a Gaussian process (squared exponential
+				  kernel, length scale and noise picked by marginal likelihood
+				  from a small grid) models the FWHM confidence over the scaled
+				  pressures, and the next pass goes where the expected improvement
+				  is largest among random and near-best candidate points.
+				  the first n_init passes are x0 and a Latin hypercube design.
+				  ask_batch(q) proposes q points for one pass (kriging believer:
+				  each chosen point is taken to measure its predicted mean while
+				  the next one is chosen, so the batch spreads out).
+				  a restart after a disturbance drops the old measurements, they
+				  describe a reactor that no longer exists.
+******************************************************************************
+"""
+import math
+import numpy as np
+
+from optimizers.base import Optimizer, PRESSURE_BOUNDS
+
+LENGTH_SCALES = (0.1, 0.2, 0.35, 0.6, 1.0)	# in units of the pressure ranges
+NOISE_LEVELS = (1e-3, 1e-2, 0.1, 0.3)		# variance, in units of the standardised confidence
+
+_erf = np.vectorize(math.erf)
+
+
+def norm_cdf(z):
+	return 0.5 * (1 + _erf(z / math.sqrt(2)))
+
+def norm_pdf(z):
+	return np.exp(-0.5 * z**2) / math.sqrt(2 * math.pi)
+
+
+class BayesianOptimizer(Optimizer):
+	# n_init: passes of the initial design, x0 included
+	# n_candidates: points the expected improvement is evaluated at per ask
+	# xi: improvement (in confidence units) a point must promise beyond the best
+	def __init__(self, x0, bounds = PRESSURE_BOUNDS, n_init = 4, design_radius = 0.25, n_candidates = 2000, xi = 0.01, seed = 0):
+		super().__init__(x0, bounds)
+		self.n_init = n_init
+		self.design_radius = design_radius
+		self.n_candidates = n_candidates
+		self.xi = xi
+		self.rng = np.random.default_rng(seed)
+		self.data_X = []	# measurements of the current search
+		self.data_F = []
+		self.length_scale = None
+		self.noise = None
+		self._design = self._initial_design(self.x0)
+		self._pending = None
+
+	# ------------------------------ scaling ------------------------------
+	def _to_unit(self, X):
+		lo, hi = self.bounds[:, 0], self.bounds[:, 1]
+		return (np.asarray(X, dtype = float) - lo) / (hi - lo)
+
+	def _from_unit(self, Z):
+		lo, hi = self.bounds[:, 0], self.bounds[:, 1]
+		return lo + np.asarray(Z) * (hi - lo)
+
+	def _initial_design(self, x0, n = None):
+		# x0 first, then a Latin hypercube in a box of +/- design_radius (fraction of the ranges) around it
+		n = self.n_init - 1 if n is None else n
+		dim = len(self.bounds)
+		Z = (np.array([self.rng.permutation(n) for _ in range(dim)]).T + self.rng.random((n, dim))) / n
+		Z = np.clip(self._to_unit(x0) + self.design_radius * (2 * Z - 1), 0, 1)
+		return [x0] + list(self._from_unit(Z))
+
+	# ------------------------------ Gaussian process ------------------------------
+	@staticmethod
+	def _kernel(A, B, length_scale):
+		d2 = ((A[:, None, :] - B[None, :, :])**2).sum(-1)
+		return np.exp(-0.5 * d2 / length_scale**2)
+
+	def _fit(self):
+		Z = self._to_unit(self.data_X)
+		F = np.array(self.data_F)
+		self._mean, self._scale = F.mean(), F.std() or 1
+		y = (F - self._mean) / self._scale
+		best = None
+		for length_scale in LENGTH_SCALES:
+			K0 = self._kernel(Z, Z, length_scale)
+			for noise in NOISE_LEVELS:
+				try:
+					L = np.linalg.cholesky(K0 + noise * np.eye(len(Z)))
+				except np.linalg.LinAlgError:
+					continue
+				alpha = np.linalg.solve(L.T, np.linalg.solve(L, y))
+				log_lik = -0.5 * y @ alpha - np.log(np.diag(L)).sum()
+				if best is None or log_lik > best[0]:
+					best = (log_lik, length_scale, noise, L, alpha)
+		_, self.length_scale, self.noise, self._L, self._alpha = best
+		self._Z = Z
+
+	def predict(self, X):
+		# mean and standard deviation of the confidence at the points X (mbar)
+		self._fit()
+		return self._predict(self._to_unit(np.atleast_2d(X)))
+
+	def _predict(self, Zs):
+		Ks = self._kernel(Zs, self._Z, self.length_scale)
+		mu = Ks @ self._alpha
+		v = np.linalg.solve(self._L, Ks.T)
+		var = np.maximum(1 - (v**2).sum(0), 1e-12)
+		return self._mean + self._scale * mu, self._scale * np.sqrt(var)
+
+	def expected_improvement(self, Zs):
+		mu, sd = self._predict(Zs)
+		improvement = min(self.data_F) - mu - self.xi
+		z = improvement / sd
+		return improvement * norm_cdf(z) + sd * norm_pdf(z)
+
+	def _candidates(self):
+		dim = len(self.bounds)
+		n_local = self.n_candidates // 2
+		best = self._to_unit(self.data_X[int(np.argmin(self.data_F))])
+		local = np.clip(best + 0.05 * self.rng.standard_normal((n_local, dim)), 0, 1)
+		return np.vstack([self.rng.random((self.n_candidates - n_local, dim)), local])
+
+	# ------------------------------ ask/tell ------------------------------
+	def _next_point(self):
+		self._fit()
+		Zs = self._candidates()
+		return self.clip(self._from_unit(Zs[int(np.argmax(self.expected_improvement(Zs)))]))
+
+	def ask(self):
+		if self._pending is None:
+			self._pending = self.clip(self._design[0]) if self._design else self._next_point()
+		return self._pending.copy()
+
+	def ask_batch(self, q):
+		if not self.data_F and len(self._design) < q: # nothing measured yet: a larger initial design
+			self._design = self._initial_design(self.x0, q - 1)
+		batch = [self.clip(x) for x in self._design[:q]]
+		self._design = self._design[q:]
+		data = (list(self.data_X), list(self.data_F))
+		try:
+			for x in batch: # the believed values of the design points
+				if self.data_F:
+					self._fit()
+					self.data_X.append(x)
+					self.data_F.append(float(self._predict(self._to_unit(x[None, :]))[0][0]))
+			while len(batch) < q:
+				x = self._next_point()	# fits the data so far
+				self.data_X.append(x)
+				self.data_F.append(float(self._predict(self._to_unit(x[None, :]))[0][0]))
+				batch.append(x)
+		finally:
+			self.data_X, self.data_F = data
+		self._pending = None
+		return [x.copy() for x in batch]
+
+	def tell_batch(self, X, F):
+		for x, f in zip(X, F):
+			Optimizer.tell(self, x, f)
+			self.data_X.append(np.array(x, dtype = float))
+			self.data_F.append(float(f))
+		self._pending = None
+
+	def tell(self, x, f):
+		super().tell(x, f)
+		if self._design:
+			self._design.pop(0)
+		self._pending = None
+		self.data_X.append(np.array(x, dtype = float))
+		self.data_F.append(float(f))
+
+	def observe(self, x, f):
+		super().observe(x, f)
+		self.data_X.append(np.array(x, dtype = float))
+		self.data_F.append(float(f))
+
+	def restart(self, x0, f0 = None):
+		self.data_X, self.data_F = [], []
+		super().restart(x0, f0)		# observes (x0, f0)
+		self._design = self._initial_design(self.x0)
+		if f0 is not None:
+			self._design.pop(0)		# x0 already measured
+		self._pending = None
@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+"""
+******************************************************************************
+language		: python
+requirement		: numpy
+authors			: Ricki Chairil, Chemical Engineering, University of Southern California
+function		: multi-condition campaigns over the 16 reactor channels.
+				  the channels are split into groups, every group runs its own
+				  pressure condition, and one pass measures all the conditions
+				  at once: plan() asks the optimizer for a batch of one condition
+				  per group and sends each to its group's pressure driver,
+				  record() scores every group from its own FWHMs (same confidence
+				  rule as the whole-reactor pass) and tells the optimizer.
+				  each group needs a driver that sets its pressures: the one
+				  MFCS-EZ feeds all 16 channels, so on the reactor as built a
+				  campaign has a single group, more groups need a pressure
+				  controller per group (or simulated.group_driver).
+				  once a condition is found, PressureLoop holds it on the reactor.
+				  python -m optimizers.campaign compares the passes to the target
+				  with one condition per pass and with 4 groups.
+******************************************************************************
+"""
+import numpy as np
+
+from optimizers.base import PRESSURE_CHANNELS
+
+
+def channel_groups(n_groups, channels = range(16), interleave = False):
+	# contiguous groups (one stage block each for 4 groups), or interleaved (0, 4, 8, 12 ...)
+	# so that a trend along the channels is shared by all the groups
+	channels = list(channels)
+	if interleave:
+		return [channels[k::n_groups] for k in range(n_groups)]
+	return [list(group) for group in np.array_split(channels, n_groups)]
+
+
+def group_confidence(fwhms):
+	# mean, standard error and mean + 1.96 SE (upper end of the 95% confidence interval)
+	# of a set of channels; more than 2 channels without a FWHM count as 60 nm
+	fwhms = np.asarray(fwhms, dtype = float)
+	n_nan = int(np.isnan(fwhms).sum())
+	if n_nan > 2:
+		fwhms = np.where(np.isnan(fwhms), 60, fwhms)
+	n = len(fwhms) - int(np.isnan(fwhms).sum())
+	if n == 0:
+		return float('nan'), float('nan'), float('nan')
+	mean = np.nanmean(fwhms)
+	stand_err = np.nanstd(fwhms) / np.sqrt(n)
+	return mean, stand_err, mean + 1.96 * stand_err
+
+
+class Campaign:
+	# optimizer: optimizers.base.Optimizer, proposes the conditions
+	# groups: lists of channels (0-15), one condition per group and pass
+	# drivers: one callable per group taking {MFCS channel: mbar}, None to only plan
+	def __init__(self, optimizer, groups, drivers = None, target = 35):
+		if drivers is not None and len(drivers) != len(groups):
+			raise ValueError('one pressure driver per channel group is needed')
+		self.optimizer = optimizer
+		self.groups = [list(group) for group in groups]
+		self.drivers = drivers
+		self.target = target
+		self.conditions = None			# [P1, P3, P4] per group, of the pass being measured
+		self.passes = 0
+		self.passes_to_target = None	# passes until one group first met the target
+		self.history = []				# per pass: list of the group statistics
+
+	@staticmethod
+	def set_points(x):
+		return {chan: round(float(p), 1) for chan, p in zip(PRESSURE_CHANNELS, x)}
+
+	def plan(self):
+		# conditions of the next pass, sent to the groups; returns {channel: set points}
+		self.conditions = self.optimizer.ask_batch(len(self.groups))
+		if self.drivers is not None:
+			for driver, x in zip(self.drivers, self.conditions):
+				driver(self.set_points(x))
+		return self.channel_set_points()
+
+	def channel_set_points(self):
+		return {chan: self.set_points(x) for group, x in zip(self.groups, self.conditions) for chan in group}
+
+	def record(self, fwhms, peaks = None):
+		# fwhms (and peaks) of all 16 channels of the pass; returns the group statistics
+		self.passes += 1
+		stats = []
+		for k, (group, x) in enumerate(zip(self.groups, self.conditions)):
+			mean, stand_err, confidence = group_confidence([fwhms[chan] for chan in group])
+			stats.append({'group': k, 'channels': group, 'set_points': self.set_points(x),
+						'fwhm': float(mean), 'stand_err': float(stand_err), 'confidence': float(confidence),
+						'peak': None if peaks is None else float(np.nanmean([peaks[chan] for chan in group]))})
+		measured = [(x, s['confidence']) for x, s in zip(self.conditions, stats) if not np.isnan(s['confidence'])]
+		if measured:
+			self.optimizer.tell_batch([x for x, _ in measured], [f for _, f in measured])
+		if self.passes_to_target is None and any(s['confidence'] <= self.target for s in stats):
+			self.passes_to_target = self.passes
+		self.history.append(stats)
+		return stats
+
+	def best(self):
+		# statistics of the best condition measured so far
+		return min((s for stats in self.history for s in stats if not np.isnan(s['confidence'])),
+				key = lambda s: s['confidence'], default = None)
+
+	def report(self):
+		best = self.best()
+		return {'optimizer': type(self.optimizer).__name__, 'groups': len(self.groups), 'passes': self.passes,
+				'conditions': self.passes * len(self.groups), 'passes_to_target': self.passes_to_target,
+				'best': None if best is None else best['set_points'],
+				'best_confidence': None if best is None else best['confidence']}
+
+
+# ------------------------------ comparison on the simulated reactor ------------------------------
+def simulate(n_groups, seed = 0, passes = 30, fwhm_noise = 0.8, target = 27, interleave = False):
+	# a campaign on SimReactor without the instruments, optimum at random pressures as in
+	# optimizers.loop.simulate; returns the campaign
+	from hardwares import simulated
+	from optimizers.bayesian import BayesianOptimizer
+	rng = np.random.default_rng(seed + 1000)
+	best = {1: rng.uniform(200, 380), 3: rng.uniform(100, 350), 4: rng.uniform(200, 380)}
+	sim = simulated.SimReactor(simulated.SimClock(1), seed = seed, best_pressures = best)
+	campaign = Campaign(BayesianOptimizer([300, 200, 300], seed = seed), channel_groups(n_groups, interleave = interleave),
+						target = target)
+	for _ in range(passes):
+		channel_set_points = campaign.plan()
+		fwhms = [sim.product(chan, channel_set_points[chan])[1] + fwhm_noise * rng.standard_normal() for chan in range(16)]
+		campaign.record(fwhms)
+		if campaign.passes_to_target is not None:
+			break
+	return campaign
+
+
+if __name__ == "__main__":
+	import argparse
+	parser = argparse.ArgumentParser(description = 'passes to reach the FWHM target with channel groups')
+	parser.add_argument('--seeds', type = int, default = 20)
+	parser.add_argument('--passes', type = int, default = 30)
+	parser.add_argument('--target', type = float, default = 27, help = 'FWHM confidence target (nm)')
+	parser.add_argument('--groups', type = int, nargs = '+', default = [1, 2, 4])
+	parser.add_argument('--interleave', action = 'store_true', help = 'interleaved instead of contiguous groups')
+	args = parser.parse_args()
+
+	results = {}
+	for n_groups in args.groups:
+		reached = [simulate(n_groups, seed, args.passes, target = args.target, interleave = args.interleave).passes_to_target
+					or args.passes for seed in range(args.seeds)]
+		results[n_groups] = np.mean(reached)
+		print('%2i group(s) of %2i channels: %5.1f passes to target (mean of %i seeds)'
+			%(n_groups, 16 // n_groups, results[n_groups], args.seeds))
+	base = results[min(results)]
+	for n_groups, passes in results.items():
+		if n_groups != min(results):
+			print('%i groups save %.1f passes' %(n_groups, base - passes))
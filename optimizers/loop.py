@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+"""
+******************************************************************************
+language		: python
+requirement		: numpy (mfcs to drive the pressures)
+authors			: Ricki Chairil, Chemical Engineering, University of Southern California
+function		: closed-loop pressure control of mrf_405. after every pass the
+				  FWHM confidence goes to step(), which tells the optimizer and
+				  sends the next set points to the MFCS:
+				  - above target: keep optimising; if the goal had been reached,
+				    a confidence above restart_above (or a drift reported by
+				    fwhm_stats) is a disturbance and the search restarts around
+				    the current pressures
+				  - on target: raise all the pressures towards expand_to at the
+				    same ratios for throughput, then hold them
+				  the passes until the target is first reached are counted.
+				  clearly_bad() looks at the running FWHM statistics during a pass,
+				  so mrf_405 can end a pass whose outcome is already certain.
+				  python -m optimizers.loop compares the optimizers on the
+				  simulated reactor and reports the passes saved.
+******************************************************************************
+"""
+import numpy as np
+
+from optimizers.base import PRESSURE_CHANNELS
+
+
+# Raise all the pressures by one factor so that the larger of P1 and P4 reaches limit:
+# the ratios, and so the composition, stay the same while the throughput goes up.
+def expand_pressure(x, limit = 400):
+	x = np.asarray(x, dtype = float)
+	return x * (limit / max(x[0], x[2]))
+
+
+class PressureLoop:
+	# optimizer: an optimizers.base.Optimizer started at the current set points
+	# apply: callable taking {MFCS channel: mbar}, e.g. mfcs.controller().set_pressures,
+	#        None to only compute the set points
+	def __init__(self, optimizer, target = 35, restart_above = 37.5, expand_to = 400, apply = None):
+		self.optimizer = optimizer
+		self.target = target
+		self.restart_above = restart_above
+		self.expand_to = expand_to
+		self.apply = apply
+		self.reach_goal = False
+		self.passes = 0
+		self.passes_to_target = None	# passes until the confidence first met the target
+		self.history = []				# (pass, [P1, P3, P4], confidence, action)
+		self.x = optimizer.ask()
+		self._asked = True				# self.x came from optimizer.ask()
+		self._send()
+
+	@property
+	def set_points(self):
+		return {chan: round(float(p), 1) for chan, p in zip(PRESSURE_CHANNELS, self.x)}
+
+	def _send(self):
+		if self.apply is not None:
+			self.apply(self.set_points)
+
+	def step(self, confidence, drift = False):
+		# confidence measured at the current set points, drift: fwhm_stats found a shift since
+		# they were set; returns the action taken: 'search', 'resume', 'restart', 'expand' or 'hold'
+		self.passes += 1
+		x = self.x
+		if self._asked:
+			self.optimizer.tell(x, confidence)
+		if confidence > self.target:
+			action = 'search'
+			if self.reach_goal: # had previously reached goal, should start to optimize again
+				self.reach_goal = False
+				if confidence > self.restart_above or drift: # big deviation, probably a disturbance: new search from here
+					self.optimizer.restart(x, confidence)
+					action = 'restart'
+				else: # small deviation, resume the search
+					self.optimizer.observe(x, confidence)
+					action = 'resume'
+			self.x = self.optimizer.ask()
+			self._asked = True
+		else:
+			if self.passes_to_target is None:
+				self.passes_to_target = self.passes
+			self.reach_goal = True
+			self._asked = False
+			if max(x[0], x[2]) < self.expand_to - 2: # increase all the pressures to increase throughput
+				self.x = expand_pressure(x, self.expand_to)
+				action = 'expand'
+			else:
+				action = 'hold'
+		self.history.append((self.passes, [float(p) for p in x], float(confidence), action))
+		if action != 'hold':
+			self._send()
+		return action
+
+	def clearly_bad(self, summary, min_channels = 8):
+		# summary: fwhm_stats running summary of the pass so far. True once at least min_channels
+		# are measured and even the lower bound of the confidence (mean - 1.96 SE) is above
+		# restart_above: the remaining channels would not change the action of step()
+		if summary['measured'] < min_channels:
+			return False
+		return summary['mean'] - 1.96 * summary['stand_err'] > self.restart_above
+
+	def report(self):
+		best_x, best_f = self.optimizer.best()
+		return {'optimizer': type(self.optimizer).__name__, 'passes': self.passes,
+				'passes_to_target': self.passes_to_target, 'restarts': self.optimizer.n_restarts,
+				'best': None if best_x is None else [float(p) for p in best_x], 'best_confidence': best_f}
+
+
+# ------------------------------ comparison on the simulated reactor ------------------------------
+def simulate(make_optimizer, seed = 0, passes = 40, disturb_at = None, shift = (-60, 40, -50),
+			fwhm_noise = 0.8, target = 35):
+	# runs the loop against SimReactor without the instruments, with the optimum at random
+	# pressures: every pass gives 16 noisy FWHMs of the product there, scored like mrf_405.
+	# returns (loop, passes to recover after the disturbance or None)
+	from hardwares import simulated
+	from optimizers.campaign import group_confidence
+	rng = np.random.default_rng(seed + 1000)
+	best = {1: rng.uniform(200, 380), 3: rng.uniform(100, 350), 4: rng.uniform(200, 380)}	# optimum of this seed
+	sim = simulated.SimReactor(simulated.SimClock(1), seed = seed, best_pressures = best)
+	x0 = [300, 200, 300]	# starting pressures of mrf_405
+	loop = PressureLoop(make_optimizer(x0, seed), target = target)
+	recovered = None
+	for k in range(passes):
+		if k == disturb_at: # e.g. a precursor concentration drift moves the optimum
+			sim.best_pressures = {chan: sim.best_pressures[chan] + d for chan, d in zip(PRESSURE_CHANNELS, shift)}
+		fwhms = np.array([sim.product(chan, loop.set_points)[1] + fwhm_noise * rng.standard_normal() for chan in range(16)])
+		_, _, confidence = group_confidence(fwhms)
+		loop.step(confidence)
+		if disturb_at is not None and k >= disturb_at and recovered is None and confidence <= target:
+			recovered = k - disturb_at + 1
+	return loop, recovered
+
+
+if __name__ == "__main__":
+	import argparse
+	from optimizers.nelder_mead import NelderMead
+	from optimizers.bayesian import BayesianOptimizer
+
+	parser = argparse.ArgumentParser(description = 'passes to reach the FWHM target on the simulated reactor')
+	parser.add_argument('--seeds', type = int, default = 10)
+	parser.add_argument('--passes', type = int, default = 40)
+	parser.add_argument('--disturb', type = int, default = 25, help = 'pass that moves the optimum, -1 for none')
+	parser.add_argument('--target', type = float, default = 35, help = 'FWHM confidence target (nm)')
+	args = parser.parse_args()
+
+	optimizers = {'nelder-mead': lambda x0, seed: NelderMead(x0),
+				'bayesian': lambda x0, seed: BayesianOptimizer(x0, seed = seed)}
+	disturb_at = None if args.disturb < 0 else args.disturb
+	results = {}
+	for name, make in optimizers.items():
+		reached, recovered = [], []
+		for seed in range(args.seeds):
+			loop, rec = simulate(make, seed, args.passes, disturb_at, target = args.target)
+			reached.append(loop.passes_to_target or args.passes)
+			recovered.append(rec or args.passes - (disturb_at or 0))
+		results[name] = (np.mean(reached), np.mean(recovered))
+		print('%-12s passes to target %5.1f   to recover %5.1f   (mean of %i seeds)'
+			%(name, results[name][0], results[name][1], args.seeds))
+	base, other = results['nelder-mead'], results['bayesian']
+	print('bayesian saves %.1f passes to the target and %.1f after the disturbance' %(base[0] - other[0], base[1] - other[1]))
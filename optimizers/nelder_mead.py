@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+"""
+******************************************************************************
+language		: python
+requirement		: numpy
+authors			: Ricki Chairil, Chemical Engineering, University of Southern California
+function		: Nelder-Mead simplex over the MFCS pressures, one reactor pass
+				  per evaluation. the simplex steps are a generator that yields
+				  the next point and receives its confidence, so ask/tell can
+				  be called across passes. restart() builds a new simplex around
+				  the current pressures and keeps the confidence already measured
+				  there, instead of spending a pass on it again. a simplex that
+				  has shrunk below min_step is re-expanded around its best vertex,
+				  the measurements are too noisy to resolve smaller steps.
+******************************************************************************
+"""
+import numpy as np
+
+from optimizers.base import Optimizer, PRESSURE_BOUNDS
+
+
+class NelderMead(Optimizer):
+	# step: mbar, edge of the initial simplex
+	# alpha, gamma, rho, sigma: reflection, expansion, contraction and shrink coefficients
+	def __init__(self, x0, bounds = PRESSURE_BOUNDS, step = 50, min_step = 5, f0 = None,
+				alpha = 1, gamma = 2, rho = 0.5, sigma = 0.5):
+		super().__init__(x0, bounds)
+		self.step = step
+		self.min_step = min_step
+		self.alpha = alpha
+		self.gamma = gamma
+		self.rho = rho
+		self.sigma = sigma
+		self.simplex = None		# vertices, best first after every step
+		self.values = None
+		self.method = None		# step in progress, e.g. 'reflect'
+		self._start(self.x0, f0)
+
+	def _start(self, x0, f0):
+		self._search = self._steps(x0, f0)
+		self._pending = next(self._search)
+
+	def ask(self):
+		return self._pending.copy()
+
+	def tell(self, x, f):
+		super().tell(x, f)
+		self._pending = self._search.send(float(f))
+
+	def restart(self, x0, f0 = None):
+		super().restart(x0, f0)
+		self._start(self.x0, f0)
+
+	def _initial_simplex(self, x0):
+		# x0 and one vertex step away along every pressure, inwards at a bound
+		vertices = [x0]
+		for k in range(len(x0)):
+			x = x0.copy()
+			x[k] += self.step if x0[k] + self.step <= self.bounds[k, 1] else -self.step
+			vertices.append(self.clip(x))
+		return vertices
+
+	def _steps(self, x0, f0):
+		simplex = self._initial_simplex(x0)
+		self.method = 'initial'
+		values = [f0 if f0 is not None else (yield simplex[0])]
+		for x in simplex[1:]:
+			values.append((yield x))
+
+		while True:
+			order = np.argsort(values)
+			simplex = [simplex[k] for k in order]
+			values = [values[k] for k in order]
+			self.simplex, self.values = simplex, values
+			if max(np.abs(x - simplex[0]).max() for x in simplex[1:]) < self.min_step:
+				self.method = 'initial'	# collapsed: new simplex around the best vertex
+				best, f_best = simplex[0], values[0]
+				simplex = self._initial_simplex(best)
+				values = [f_best]
+				for x in simplex[1:]:
+					values.append((yield x))
+				continue
+
+			centroid = np.mean(simplex[:-1], axis = 0)
+			worst = simplex[-1]
+			self.method = 'reflect'
+			xr = self.clip(centroid + self.alpha * (centroid - worst))
+			fr = yield xr
+			if values[0] <= fr < values[-2]:
+				simplex[-1], values[-1] = xr, fr
+				continue
+			if fr < values[0]:
+				self.method = 'expand'
+				xe = self.clip(centroid + self.gamma * (xr - centroid))
+				fe = yield xe
+				simplex[-1], values[-1] = (xe, fe) if fe < fr else (xr, fr)
+				continue
+			if fr < values[-1]:	# outside contraction
+				self.method = 'contract'
+				xc = self.clip(centroid + self.rho * (xr - centroid))
+				fc = yield xc
+				if fc <= fr:
+					simplex[-1], values[-1] = xc, fc
+					continue
+			else:				# inside contraction
+				self.method = 'contract'
+				xc = self.clip(centroid + self.rho * (worst - centroid))
+				fc = yield xc
+				if fc < values[-1]:
+					simplex[-1], values[-1] = xc, fc
+					continue
+			self.method = 'shrink'
+			for k in range(1, len(simplex)):
+				simplex[k] = self.clip(simplex[0] + self.sigma * (simplex[k] - simplex[0]))
+				values[k] = yield simplex[k]
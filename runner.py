@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+"""
+******************************************************************************
+language		: python
+requirement		: --
+authors			: Ricki Chairil, Chemical Engineering, University of Southern California
+function		: concurrent runner for one reactor pass.
+				  every instrument gets its own single-thread worker, so calls to
+				  one instrument stay in order while different instruments run
+				  at the same time. jobs run once per pass (PL/UV-vis scan),
+				  monitors repeat on their worker until the jobs are done
+				  (IR droplet scans), and everything is joined into one pass
+				  record with timing. when a job fails or the pass is interrupted
+				  (Ctrl-C), PassRunner.abort is set for the jobs that watch it.
+******************************************************************************
+"""
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+class InstrumentWorker:
+	def __init__(self, name):
+		self.name = name
+		self.executor = ThreadPoolExecutor(max_workers = 1, thread_name_prefix = name)
+
+	def submit(self, fn, *args):
+		# returns a future of (start, end, result), times from time.time()
+		def timed():
+			start = time.time()
+			result = fn(*args)
+			return start, time.time(), result
+		return self.executor.submit(timed)
+
+	def shutdown(self, wait = True):
+		# wait = False: return at once and drop the queued calls, the running one ends on its own
+		self.executor.shutdown(wait = wait, cancel_futures = not wait)
+
+
+class Monitor:
+	# calls fn(k), k = 0, 1, 2..., back to back on the worker until stop() is called
+	def __init__(self, worker, fn):
+		self.worker = worker
+		self.fn = fn
+		self.records = []
+		self._stop = threading.Event()
+		self._future = None
+
+	def _loop(self):
+		k = 0
+		while not self._stop.is_set():
+			start = time.time()
+			result = self.fn(k)
+			self.records.append({'start': start, 'end': time.time(), 'result': result})
+			k += 1
+		return self.records
+
+	def start(self):
+		self._stop.clear()
+		self._future = self.worker.executor.submit(self._loop)
+
+	def stop(self, wait = True):
+		# lets the running call finish, re-raises an error from the monitor;
+		# wait = False only asks the loop to end after the running call
+		self._stop.set()
+		if wait and self._future is not None:
+			self._future.result()
+		return self.records
+
+
+class PassRunner:
+	def __init__(self, instruments = ('optics', 'ir')):
+		self.workers = {}
+		for name in instruments:
+			self.workers[name] = InstrumentWorker(name)
+		self.abort = threading.Event()	# set when a pass fails or is interrupted, e.g. for Sequencer(abort)
+
+	# jobs: {name: (instrument, fn, args)} run once
+	# monitors: {name: (instrument, fn)} fn(k) repeated while the jobs run
+	# a failed job is re-raised; errors of monitors are in record['monitor_errors'] ({name: exception})
+	def run_pass(self, jobs, monitors = None):
+		record = {'start': time.time(), 'jobs': {}, 'monitors': {}}
+		self.abort.clear()
+		running = {}
+		for name, (instrument, fn) in (monitors or {}).items():
+			running[name] = Monitor(self.workers[instrument], fn)
+			running[name].start()
+
+		futures = {}
+		for name, (instrument, fn, args) in jobs.items():
+			futures[name] = self.workers[instrument].submit(fn, *args)
+
+		job_error = None
+		try:
+			for name, future in futures.items():
+				start, end, result = future.result()
+				record['jobs'][name] = {'start': start, 'end': end, 'duration': end - start, 'result': result}
+		except BaseException as e: # e.g. KeyboardInterrupt, the monitors are still stopped below
+			job_error = e
+			self.abort.set() # the other jobs stop early instead of finishing the pass
+
+		# every monitor is stopped, also when a job or another monitor failed;
+		# an interrupt does not wait for the running monitor calls
+		interrupted = job_error is not None and not isinstance(job_error, Exception)
+		record['monitor_errors'] = {}
+		for name, monitor in running.items():
+			try:
+				record['monitors'][name] = monitor.stop(wait = not interrupted)
+			except Exception as e:
+				record['monitors'][name] = monitor.records
+				record['monitor_errors'][name] = e
+		if job_error is not None: # the job error first, the monitor errors go with it
+			job_error.monitor_errors = record['monitor_errors']
+			raise job_error
+
+		record['end'] = time.time()
+		record['duration'] = record['end'] - record['start']
+		return record
+
+	def shutdown(self, wait = True):
+		for worker in self.workers.values():
+			worker.shutdown(wait)
@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+"""
+******************************************************************************
+language		: python
+requirement		: --
+authors			: Ricki Chairil, Chemical Engineering, University of Southern California
+function		: event-driven step sequencer for the reactor pass.
+				  each step (stage move, solenoid, lamp, acquisition, analysis,
+				  file write) declares what it waits for and how long the hardware
+				  needs to settle after it. a step starts as soon as its
+				  dependencies are done and settled and its hardware is free, so
+				  independent steps overlap instead of sitting in fixed sleeps.
+				  stop() ends a run early: the running steps finish, and of the
+				  pending ones only those marked 'always' (e.g. lamp off) still run,
+				  once nothing else is on the hardware. they also run when a step
+				  fails, before its error is raised.
+				  an abort event, e.g. PassRunner.abort, stops the run the same way.
+******************************************************************************
+"""
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+
+class Step:
+	# name: unique name, used by 'after' of other steps
+	# action: callable without arguments, its return value is kept in step.result
+	# after: names of the steps that must be finished (and settled) first
+	# settle: seconds the hardware needs after this step before dependents may start
+	# resources: names of devices this step uses, steps sharing one never run together
+	# kind: category for the timing report, e.g. 'stage', 'solenoid', 'lamp', 'acquire', 'analysis', 'io'
+	# always: still runs after stop() or a failed step, e.g. to rest the hardware; after stop() it waits
+	#         for its remaining dependencies and for the running steps that are not 'always' themselves
+	def __init__(self, name, action, after = (), settle = 0, resources = (), kind = None, always = False):
+		self.name = name
+		self.action = action
+		self.after = [a for a in after if a is not None]
+		self.settle = settle
+		self.resources = set(resources)
+		self.kind = kind
+		self.always = always
+		self.result = None
+		self.ready = None	# earliest allowed start, seconds from the start of the run
+		self.start = None
+		self.end = None
+
+
+class Sequencer:
+	# abort: optional threading.Event of the caller, setting it stops the run like stop()
+	def __init__(self, max_workers = 4, abort = None):
+		self.max_workers = max_workers
+		self.abort = abort
+		self.steps = []
+		self.duration = 0
+		self.skipped = []	# names of the steps dropped by stop()
+		self._stop = threading.Event()
+
+	def stop(self):
+		# end the run early, callable from a step: no new steps start except the 'always' ones
+		self._stop.set()
+
+	def stopping(self):
+		return self._stop.is_set() or (self.abort is not None and self.abort.is_set())
+
+	def run(self, steps):
+		self.steps = list(steps)
+		self.skipped = []
+		self._stop.clear()
+		pending = list(self.steps)
+		done = {}
+		running = {}	# future: step
+		busy = set()
+		stopped = False
+		t0 = time.perf_counter()
+
+		with ThreadPoolExecutor(max_workers = self.max_workers) as pool:
+			try:
+				while pending or running:
+					if self.stopping() and not stopped:
+						stopped = True
+						self.skipped = [step.name for step in pending if not step.always]
+						pending = [step for step in pending if step.always]
+					# after stop(), e.g. the lamp only goes off once the exposure in progress is done
+					cleaning = stopped and all(step.always for step in running.values())
+					now = time.perf_counter() - t0
+					next_ready = None
+					for step in list(pending):
+						after = [name for name in step.after if name not in self.skipped]
+						if any(name not in done for name in after):
+							continue
+						if stopped and not cleaning:
+							continue
+						step.ready = max([done[name].end + done[name].settle for name in after], default = 0)
+						if step.ready > now:
+							next_ready = step.ready if next_ready is None else min(next_ready, step.ready)
+							continue
+						if step.resources & busy:
+							continue
+						busy |= step.resources
+						step.start = now
+						running[pool.submit(step.action)] = step
+						pending.remove(step)
+
+					if not running and next_ready is None:
+						if not pending: # the rest was dropped by stop()
+							break
+						names = [step.name for step in pending]
+						raise RuntimeError('steps waiting for unknown or failed steps: ' + str(names))
+
+					timeout = None if next_ready is None else max(next_ready - (time.perf_counter() - t0), 0)
+					if not running:
+						time.sleep(timeout)	# only settling left, nothing to wait on
+						continue
+					finished, _ = wait(list(running), timeout, FIRST_COMPLETED)
+					for future in finished:
+						step = running.pop(future)
+						step.end = time.perf_counter() - t0
+						busy -= step.resources
+						step.result = future.result()	# re-raises an error from the step
+						done[step.name] = step
+			except BaseException:
+				# let the steps already on the hardware finish, start nothing new but the 'always' steps
+				for future in running:
+					future.cancel()
+				wait(list(running))
+				self._clean_up(pending)
+				raise
+
+		self.duration = time.perf_counter() - t0
+		return {step.name: step.result for step in self.steps}
+
+	def _clean_up(self, pending):
+		# the 'always' steps of a failed run, one after the other in the given order
+		for step in pending:
+			if step.always:
+				try:
+					step.result = step.action()
+				except Exception as e: # the error of the failed step is the one raised
+					print('clean-up step '+step.name+' failed: '+repr(e))
+
+	def timings(self):
+		# one record per step: name, kind, start, end, duration and time spent waiting after it was ready
+		records = []
+		for step in self.steps:
+			if step.start is None or step.end is None:
+				continue
+			records.append({'name': step.name, 'kind': step.kind, 'start': step.start, 'end': step.end,
+							'duration': step.end - step.start, 'wait': step.start - step.ready})
+		return records
+
+	def report(self):
+		# print the time spent per kind of step and the total pass duration
+		per_kind = {}
+		for rec in self.timings():
+			per_kind[rec['kind']] = per_kind.get(rec['kind'], 0) + rec['duration']
+		print('------------- pass timing -------------')
+		for kind, t in sorted(per_kind.items(), key = lambda item: -item[1]):
+			print('%-10s %8.2f s' %(kind, t))
+		print('%-10s %8.2f s (steps overlap, so the sum above can be larger)' %('total', self.duration))
+		return per_kind
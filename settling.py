@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+"""
+******************************************************************************
+language		: python
+requirement		: numpy
+authors			: Ricki Chairil, Chemical Engineering, University of Southern California
+function		: settling detection after MFCS set point changes.
+				  instead of a fixed 30-60 s sleep, the pressure readbacks (and
+				  optionally the IR droplet frequency) are watched, and the wait
+				  ends as soon as every reading has stayed within tolerance for a
+				  hold window. max_wait bounds the wait, so without any readings
+				  it falls back to the old fixed wait.
+******************************************************************************
+"""
+import numpy as np
+from hardwares.simulated import clock	# time()/sleep(), on the simulated clock under MRF_SIMULATE=1
+
+
+class SettlingDetector:
+	# targets: {MFCS channel: set point in mbar}, tolerance in mbar
+	# hold: s all the readings must stay within tolerance
+	# ir_tolerance: largest relative spread of the droplet frequency over the hold window
+	# min_wait: s before settling can be declared, e.g. for liquid to reach the detectors
+	# use_ir: the droplet frequency (update_ir) must be steady as well
+	def __init__(self, targets = None, tolerance = 3, hold = 5, ir_tolerance = 0.1, min_wait = 0, use_ir = False):
+		self.targets = dict(targets or {})
+		self.use_ir = use_ir
+		self.tolerance = tolerance
+		self.hold = hold
+		self.ir_tolerance = ir_tolerance
+		self.min_wait = min_wait
+		self.start = None
+		self.in_tolerance_since = None	# pressures
+		self.ir_samples = []			# (time, droplet frequency)
+		self.settled_at = None
+
+	def reset(self, targets = None, t = None):
+		if targets is not None:
+			self.targets = dict(targets)
+		self.start = clock.time() if t is None else t
+		self.in_tolerance_since = None
+		self.ir_samples = []
+		self.settled_at = None
+
+	def pressure_ok(self, pressures):
+		return all(abs(pressures[chan] - target) <= self.tolerance for chan, target in self.targets.items())
+
+	def update_pressures(self, t, pressures):
+		if self.start is None:
+			self.start = t
+		if self.pressure_ok(pressures):
+			if self.in_tolerance_since is None:
+				self.in_tolerance_since = t
+		else:
+			self.in_tolerance_since = None
+		return self.settled(t)
+
+	def update_ir(self, t, freq):
+		if self.start is None:
+			self.start = t
+		self.ir_samples.append((t, freq))
+		return self.settled(t)
+
+	def ir_ok(self, t):
+		# droplets present and the frequency steady over the last hold seconds: the scans in the
+		# window plus the last one before it, so that slow scans still cover the whole window
+		if not self.ir_samples or self.ir_samples[0][0] > t - self.hold:
+			return False	# not watched for a whole hold window yet
+		first = max(k for k, (ts, _) in enumerate(self.ir_samples) if ts <= t - self.hold)
+		window = np.array([f for _, f in self.ir_samples[first:]])
+		if len(window) < 2:
+			return False
+		if not np.all(window > 0):
+			return False
+		return (window.max() - window.min()) / window.mean() <= self.ir_tolerance
+
+	def settled(self, t):
+		# pressures are checked when there are targets, the droplets when use_ir is set
+		if self.settled_at is not None:
+			return True
+		if t - self.start < self.min_wait or not (self.targets or self.use_ir):
+			return False
+		ok = True
+		if self.targets:
+			ok = self.in_tolerance_since is not None and t - self.in_tolerance_since >= self.hold
+		if self.use_ir:
+			ok = ok and self.ir_ok(t)
+		if ok:
+			self.settled_at = t
+		return ok
+
+
+# Block until the flow has settled or max_wait has passed.
+# controller: mfcs.MFCSController (polled samples are used when its poller runs) or None
+# ir_probe: callable returning the current mean droplet frequency (Hz), or None
+# returns {'settled', 'waited' (s), 'pressures', 'ir_freq'}
+def wait_settled(controller = None, targets = None, ir_probe = None, tolerance = 3, hold = 5,
+				ir_tolerance = 0.1, min_wait = 0, max_wait = 60, period = 0.5):
+	use_pressure = controller is not None and bool(targets)
+	use_ir = ir_probe is not None
+	detector = SettlingDetector(targets if use_pressure else None, tolerance, hold, ir_tolerance, min_wait, use_ir)
+	start = clock.time()
+	detector.reset(t = start)
+	pressures = None
+	freq = None
+	while True:
+		t = clock.time()
+		if use_pressure:
+			if controller.polling():
+				sample = controller.wait_for_sample(timeout = max(period, 1))
+			else:
+				sample = (t, controller.read_all())
+			if sample is not None:	# None: no new sample from the poller within the timeout
+				t, pressures = sample
+				detector.update_pressures(t, pressures)
+		if use_ir:
+			freq = ir_probe()
+			t = clock.time()
+			detector.update_ir(t, freq)
+
+		if detector.settled(t):
+			break
+		if t - start >= max_wait:
+			break
+		if not use_ir:	# the IR probe already takes its own time
+			clock.sleep(min(period, max(start + max_wait - clock.time(), 0)))
+	return {'settled': detector.settled_at is not None, 'waited': clock.time() - start,
+			'pressures': pressures, 'ir_freq': freq}
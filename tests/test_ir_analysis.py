@@ -0,0 +1,32 @@
+import numpy as np
+
+import ir_analysis
+
+
+def droplet_trace(rng, n_chan = 4, n_samples = 4000, period = 350, noise = 0.05):
+	# 1 ms samples: a noise-only lead-in, then droplets that pull the signal 1 V down
+	t = np.arange(n_samples) * 1e-3
+	volts = 4 + noise * rng.standard_normal((n_chan, n_samples))
+	for chan in range(n_chan):
+		phase = (np.arange(n_samples) + 37 * chan) % period
+		volts[chan, 300:] -= (phase[300:] < period // 2)
+	return t, volts
+
+
+def test_chunks_match_droplet_stats():
+	t, volts = droplet_trace(np.random.default_rng(0))
+	stream = ir_analysis.DropletStream(len(volts))
+	for start in range(0, volts.shape[1], 50):
+		streamed = stream.update(t[start:start + 50], volts[:, start:start + 50])
+	batch = ir_analysis.droplet_stats(t, volts)
+	for key in ('freq', 'duty', 'drops', 'drop_length'):
+		assert np.allclose(streamed[key], batch[key]), key
+
+
+def test_every_chunk_matches_the_samples_so_far():
+	t, volts = droplet_trace(np.random.default_rng(1), n_samples = 1500)
+	stream = ir_analysis.DropletStream(len(volts))
+	for end in range(100, volts.shape[1] + 1, 100):
+		streamed = stream.update(t[end - 100:end], volts[:, end - 100:end])
+		batch = ir_analysis.droplet_stats(t[:end], volts[:, :end])
+		assert np.allclose(streamed['freq'], batch['freq'])
@@ -0,0 +1,27 @@
+import os
+import signal
+import threading
+import time
+
+import pytest
+
+from runner import PassRunner
+from sequencer import Sequencer, Step
+
+
+def test_interrupt_aborts_the_pass_in_flight():
+	runner = PassRunner()
+	ran = []
+	def scan(abort):	# a pass of 20 steps of 0.1 s on the optics worker
+		seq = Sequencer(abort = abort)
+		seq.run(Step('step'+str(k), lambda k = k: (time.sleep(0.1), ran.append(k)), after = ['step'+str(k - 1)] if k else [])
+				for k in range(20))
+		return seq.skipped
+	threading.Timer(0.25, os.kill, (os.getpid(), signal.SIGINT)).start()	# Ctrl-C during the pass
+	start = time.perf_counter()
+	with pytest.raises(KeyboardInterrupt):
+		runner.run_pass({'scan': ('optics', scan, (runner.abort,))})
+	runner.shutdown(wait = False)
+	assert time.perf_counter() - start < 1
+	time.sleep(0.3)	# the step on the hardware finishes, nothing after it starts
+	assert len(ran) < 5
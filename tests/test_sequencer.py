@@ -0,0 +1,42 @@
+import threading
+import time
+
+import pytest
+
+from sequencer import Sequencer, Step
+
+
+def test_stop_runs_the_always_steps_after_the_running_ones():
+	seq = Sequencer()
+	events = []
+	def log(name, duration = 0):
+		events.append((name, 'start'))
+		time.sleep(duration)
+		events.append((name, 'end'))
+	def record():
+		log('record0')
+		seq.stop()
+	steps = [Step('acquire0', lambda: log('acquire0', 0.05), resources = ['flames']),
+			Step('record0', record, after = ['acquire0']),
+			Step('acquire1', lambda: log('acquire1', 0.2), after = ['acquire0'], resources = ['flames']),
+			Step('record1', lambda: log('record1'), after = ['acquire1']),
+			Step('acquire2', lambda: log('acquire2'), after = ['acquire1'], resources = ['flames']),
+			Step('lights_off', lambda: log('lights_off'), after = ['acquire2'], resources = ['mega_3'], always = True)]
+	seq.run(steps)
+	assert seq.skipped == ['record1', 'acquire2']
+	# the exposure in progress when the pass stopped still ends before the lamp goes off
+	assert events.index(('acquire1', 'end')) < events.index(('lights_off', 'start'))
+
+
+def test_failed_step_still_runs_the_always_steps():
+	seq = Sequencer()
+	ran = []
+	def fail():
+		raise ValueError('no spectrum')
+	steps = [Step('light', lambda: ran.append('light'), resources = ['mega_3']),
+			Step('acquire', fail, after = ['light'], resources = ['flames']),
+			Step('record', lambda: ran.append('record'), after = ['acquire']),
+			Step('lights_off', lambda: ran.append('lights_off'), after = ['acquire'], resources = ['mega_3'], always = True)]
+	with pytest.raises(ValueError):
+		seq.run(steps)
+	assert ran == ['light', 'lights_off']
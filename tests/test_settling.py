@@ -0,0 +1,26 @@
+import settling
+
+
+class SilentController:
+	# polling MFCS controller whose poller never delivers a sample
+	def __init__(self):
+		self.waits = 0
+
+	def polling(self):
+		return True
+
+	def wait_for_sample(self, since = None, timeout = None):
+		self.waits += 1
+		return None
+
+	def read_all(self):
+		raise AssertionError('read_all must not be called while polling')
+
+
+def test_wait_settled_without_samples_times_out():
+	controller = SilentController()
+	result = settling.wait_settled(controller, {1: 300}, max_wait = 0.05, period = 0.01)
+	assert controller.waits >= 1
+	assert not result['settled']
+	assert result['pressures'] is None
+	assert result['waited'] >= 0.05
@@ -0,0 +1,48 @@
+import os
+import numpy as np
+
+from hardwares.spectra_archive import SpectraArchive, open_archive, read_channel
+
+
+def spectrum(rng, n_pixel, peak):
+	# detector counts: a PL peak on a dark level, with shot noise
+	x = np.arange(n_pixel)
+	return rng.poisson(1500 + 20000 * np.exp(-0.5 * ((x - peak) / 30)**2)).astype(np.float32)
+
+
+def test_archive_smaller_than_raw_data(tmp_path):
+	rng = np.random.default_rng(0)
+	n_passes, n_chan, n_pixel = 48, 16, 2048
+	filename = str(tmp_path / 'archive.h5')
+	last = None
+	with SpectraArchive(filename, meta = ('P1',), n_chan = n_chan, n_pixel = n_pixel) as archive:
+		for k in range(n_passes):
+			archive.new_pass({'P1': 300})
+			for chan in range(n_chan):	# one spectrum at a time, as pl_abs does
+				for name in ('PL', 'Abs'):
+					last = spectrum(rng, n_pixel, 1000 + chan)
+					archive.write(name, chan, last)
+				archive.write_value('fwhm', chan, 20)
+			archive.flush()
+	raw = n_passes * 2 * n_chan * n_pixel * 4
+	assert os.path.getsize(filename) < 0.5 * raw
+
+	with open_archive(filename) as f:
+		spectra, times = read_channel(f, 'Abs', n_chan - 1)
+	assert spectra.shape == (n_passes, n_pixel)
+	assert np.array_equal(spectra[-1], last)
+
+
+def test_remeasured_spectrum_replaces_the_first(tmp_path):
+	rng = np.random.default_rng(1)
+	filename = str(tmp_path / 'archive.h5')
+	with SpectraArchive(filename, n_chan = 4, n_pixel = 64) as archive:
+		archive.new_pass()
+		for chan in range(4):
+			archive.write('PL', chan, spectrum(rng, 64, 30))
+		archive.flush()
+		again = spectrum(rng, 64, 40)
+		archive.write('PL', 2, again)
+	with open_archive(filename) as f:
+		spectra, _ = read_channel(f, 'PL', 2)
+	assert np.array_equal(spectra[0], again)